@@ -0,0 +1,92 @@
+"""Compare the size and the cost of the edit payloads: html form, compact
+payload and their gzip compressed version according to the document size.
+
+Usage: python benchmarks/compression.py [number of elements ...]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import xmltool
+
+from waxe.xml import form
+from waxe.xml.compression import gzip_compress
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ELEMENT test (question, answer)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT answer (#PCDATA)>
+'''
+
+REPEAT = 5
+
+
+def create_file(path, nb):
+    open(os.path.join(path, 'exercise.dtd'), 'w').write(DTD_CONTENT)
+    filename = os.path.join(path, 'file.xml')
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<!DOCTYPE Exercise SYSTEM "exercise.dtd">',
+           '<Exercise><number>1</number>']
+    for i in range(nb):
+        xml += ['<test><question>Question %s</question>'
+                '<answer>Answer %s</answer></test>' % (i, i)]
+    xml += ['</Exercise>']
+    open(filename, 'w').write('\n'.join(xml))
+    return filename
+
+
+def timeit(func):
+    durations = []
+    result = None
+    for i in range(REPEAT):
+        start = time.time()
+        result = func()
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2] * 1000, result
+
+
+def bench(nb):
+    path = tempfile.mkdtemp()
+    try:
+        filename = create_file(path, nb)
+        obj = xmltool.load(filename)
+
+        def html():
+            return json.dumps({
+                'content': xmltool.generate_form_from_obj(obj),
+                'jstree_data': obj.to_jstree_dict(),
+            })
+
+        def compact():
+            return json.dumps({'compact': form.compact_obj(obj)},
+                              separators=(',', ':'))
+
+        html_ms, html_body = timeit(html)
+        compact_ms, compact_body = timeit(compact)
+        gzip_ms, html_gz = timeit(lambda: gzip_compress(html_body))
+        compact_gz = gzip_compress(compact_body)
+        return (len(html_body), len(html_gz), len(compact_body),
+                len(compact_gz), html_ms, compact_ms, gzip_ms)
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or [10, 100, 1000, 10000]
+    print '%8s %10s %10s %10s %10s %10s %10s %10s' % (
+        'elements', 'html', 'html.gz', 'compact', 'compact.gz',
+        'html(ms)', 'compact(ms)', 'gzip(ms)')
+    for nb in sizes:
+        print '%8d %10d %10d %10d %10d %10.1f %10.1f %10.1f' % (
+            (nb,) + bench(nb))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,58 @@
+"""Cost of building a previous version of a document: reverting 10 element
+changes with the journal compared to loading the document, according
+to the document size. diff is the cost added to a full save to get its
+changes.
+
+Usage: python benchmarks/journal.py [number of elements ...]
+"""
+import sys
+import shutil
+import tempfile
+
+import xmltool
+
+from waxe.xml import delta, journal
+
+from compression import create_file, timeit
+
+
+CHANGES = 10
+
+
+def bench(nb):
+    path = tempfile.mkdtemp()
+    try:
+        filename = create_file(path, nb)
+        obj = xmltool.load(filename)
+        doc_journal = journal.DocumentJournal()
+        for i in range(CHANGES):
+            str_id = 'Exercise:list__test:%d:test:question' % (i % nb)
+            modified, undo = delta.apply_changes(
+                obj, {str_id: {'_value': 'Version %s' % i}})
+            doc_journal.record(i, i + 1, journal.JournalEntry(
+                journal.get_changes(undo)))
+
+        def revert():
+            values = doc_journal.get_revert(0)
+            modified, changes = journal.apply_values(obj, values)
+            journal.cancel_changes(obj, changes)
+
+        revert_ms, _ = timeit(revert)
+        load_ms, _ = timeit(lambda: xmltool.load(filename))
+        old = xmltool.load(filename)
+        diff_ms, _ = timeit(lambda: journal.diff_objs(old, obj))
+        return revert_ms, load_ms, diff_ms
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or [10, 100, 1000, 10000]
+    print '%8s | %10s %10s %10s' % ('elements', 'revert ms', 'load ms',
+                                    'diff ms')
+    for nb in sizes:
+        print '%8d | %10.2f %10.2f %10.2f' % ((nb,) + bench(nb))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+"""Compare the jstree data (to_jstree_dict) with the compact outline
+(form.outline_obj): memory used by the python objects, build time and size
+of the JSON according to the document size.
+
+Usage: python benchmarks/outline.py [number of elements ...]
+"""
+import sys
+import json
+import shutil
+import tempfile
+
+import xmltool
+
+from waxe.xml import form
+from waxe.xml.compression import gzip_compress
+
+from compression import create_file, timeit
+
+
+def get_size(value):
+    """The memory used by value and the objects it contains, in bytes
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum([get_size(k) + get_size(v) for k, v in value.items()])
+    elif isinstance(value, (list, tuple)):
+        size += sum([get_size(v) for v in value])
+    return size
+
+
+def bench(nb):
+    path = tempfile.mkdtemp()
+    try:
+        obj = xmltool.load(create_file(path, nb))
+        results = []
+        for func in (obj.to_jstree_dict, lambda: form.outline_obj(obj)):
+            ms, data = timeit(func)
+            body = json.dumps(data, separators=(',', ':'))
+            results += [get_size(data), ms, len(body),
+                        len(gzip_compress(body))]
+        return tuple(results)
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or [10, 100, 1000, 10000]
+    print '%8s | %10s %8s %10s %8s | %10s %8s %10s %8s' % (
+        'elements', 'jstree mem', 'ms', 'json', 'json.gz',
+        'outline mem', 'ms', 'json', 'json.gz')
+    for nb in sizes:
+        print '%8d | %10d %8.1f %10d %8d | %10d %8.1f %10d %8d' % (
+            (nb,) + bench(nb))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
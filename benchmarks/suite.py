@@ -0,0 +1,440 @@
+"""Benchmark of the editor endpoints according to the document size.
+
+Synthetic documents valid against a generated dtd are created for each
+size, the dtd is served by a local HTTP server to have the same code path
+as the remote dtds. The endpoints are called through WebTest with the
+application used by the functional tests.
+
+For each endpoint and size we report the latency percentiles, the memory
+allocated during the calls and the peak RSS of the process. The sizes are
+run in ascending order, so the peak RSS of a size is the one of the
+biggest document loaded so far.
+
+The memory allocations are measured with tracemalloc when it's available
+(pytracemalloc on python 2), otherwise we report the number of objects
+tracked by the garbage collector retained after the calls.
+
+Usage:
+
+    # Store a baseline
+    python benchmarks/suite.py --save baseline.json
+    # Compare with the baseline, exit with 1 if there is a regression
+    python benchmarks/suite.py --compare baseline.json --tolerance 0.2
+"""
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import threading
+import SimpleHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+import xmltool
+from xmltool.utils import prefixes_to_str
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from waxe.core.tests.testing import WaxeTestCase, login_user, SETTINGS
+from waxe.xml.cache import (
+    dtd_cache,
+    form_cache,
+    document_cache,
+    element_cache,
+)
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ELEMENT test (question, answer)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT answer (#PCDATA)>
+'''
+
+KB = 1024
+MB = 1024 * KB
+DEFAULT_SIZES = [KB, 10 * KB, 100 * KB, MB, 10 * MB, 50 * MB]
+# Number of calls by endpoint, reduced for the big documents
+DEFAULT_REPEAT = 20
+MIN_REPEAT = 3
+# The repeat is divided by 2 each time the size is multiplied by this factor
+REPEAT_FACTOR = 10
+DEFAULT_TOLERANCE = 0.2
+# The regressions are checked on these metrics
+COMPARED_METRICS = ['p50', 'p90']
+# Don't report the regressions of the very fast calls: the noise is bigger
+# than the difference
+MIN_COMPARED_MS = 1
+
+ENDPOINTS = [
+    'edit',
+    'new',
+    'update',
+    'add_element_json',
+    'copy_json',
+    'paste_json',
+    'get_tags',
+]
+
+TEST_XML = ('<test><question>Question %(i)s lorem ipsum '
+            'dolor sit amet</question><answer>Answer %(i)s consectetur '
+            'adipiscing elit</answer></test>')
+
+
+def generate_file(path, size, dtd_url):
+    """Write a document of about size bytes valid against DTD_CONTENT.
+
+    :return: the number of test elements
+    """
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<!DOCTYPE Exercise SYSTEM "%s">\n'
+              '<Exercise><number>1</number>\n') % dtd_url
+    footer = '</Exercise>\n'
+    f = open(path, 'w')
+    try:
+        f.write(header)
+        written = len(header) + len(footer)
+        nb = 0
+        while not nb or written < size:
+            line = TEST_XML % {'i': nb} + '\n'
+            f.write(line)
+            written += len(line)
+            nb += 1
+        f.write(footer)
+    finally:
+        f.close()
+    return nb
+
+
+def get_repeat(size, repeat=DEFAULT_REPEAT):
+    """The number of calls for the documents of the given size
+    """
+    step = KB
+    while step < size:
+        step *= REPEAT_FACTOR
+        repeat //= 2
+    return max(repeat, MIN_REPEAT)
+
+
+def get_form_params(obj):
+    """The params submitted by the form for obj
+    """
+    params = {
+        '_xml_dtd_url': obj.dtd_url,
+        '_xml_encoding': obj.encoding,
+    }
+    for elt in obj.walk():
+        if isinstance(elt, xmltool.elements.TextElement):
+            key = prefixes_to_str(elt.prefixes_no_cache + ['_value'])
+            params[key] = elt.text
+    return params
+
+
+def percentile(values, p):
+    """The p percentile (0 <= p <= 100) of the sorted values, with a linear
+    interpolation.
+    """
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def get_rss():
+    """The peak RSS of the process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * KB
+
+
+class Allocations(object):
+    """Measure the memory allocated between start and stop
+    """
+
+    def start(self):
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+            self.unit = 'bytes'
+        else:
+            self.objects = len(gc.get_objects())
+            self.unit = 'objects'
+
+    def stop(self):
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak
+        gc.collect()
+        return len(gc.get_objects()) - self.objects
+
+
+class DTDServer(object):
+    """Serve the files of path over HTTP in a thread
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(handler, p):
+                return os.path.join(path, p.split('?')[0].lstrip('/'))
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = SocketServer.TCPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def clear_caches():
+    """Each call should do the real work, not return a cached payload
+    """
+    form_cache.invalidate()
+    document_cache.invalidate()
+    element_cache.invalidate()
+
+
+class Bench(WaxeTestCase):
+    """Use the application of the functional tests
+    """
+
+    def __init__(self, path, dtd_url, repeat=DEFAULT_REPEAT):
+        super(Bench, self).__init__('runTest')
+        self.path = path
+        self.dtd_url = dtd_url
+        self.repeat = repeat
+
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        self.settings = SETTINGS.copy()
+        self.settings['waxe.editors'] = 'waxe.xml.views.editor'
+        super(Bench, self).setUp()
+        self.user_bob.config.root_path = self.path
+
+    def _get_calls(self, filename, nb):
+        url = '/api/1/account/Bob/xml/%s'
+        params = get_form_params(xmltool.load(os.path.join(self.path,
+                                                           filename)))
+        params['_xml_filename'] = filename
+        elt_id = 'Exercise:list__test:%s:test' % (nb // 2)
+        elt_params = dict([(k, v) for k, v in params.items()
+                           if k.startswith(elt_id + ':')])
+        copy_params = dict(elt_params, elt_id=elt_id)
+        paste_params = dict(elt_params,
+                            elt_id='Exercise:list__test:%s:test' % nb,
+                            _xml_dtd_url=self.dtd_url)
+
+        return {
+            'edit': lambda: self.testapp.get(
+                url % 'edit.json', params={'path': filename}, status=200),
+            'new': lambda: self.testapp.get(
+                url % 'new.json',
+                params={'dtd_url': self.dtd_url, 'dtd_tag': 'Exercise'},
+                status=200),
+            'update': lambda: self.testapp.post(
+                url % 'update.json', params=params, status=200),
+            'add_element_json': lambda: self.testapp.get(
+                url % 'add-element.json',
+                params={'dtd_url': self.dtd_url, 'elt_id': elt_id},
+                status=200),
+            'copy_json': lambda: self.testapp.post(
+                url % 'copy.json', params=copy_params, status=200),
+            'paste_json': lambda: self.testapp.post(
+                url % 'paste.json', params=paste_params, status=200),
+            'get_tags': lambda: self.testapp.get(
+                url % 'get-tags.json', params={'dtd_url': self.dtd_url},
+                status=200),
+        }
+
+    def measure(self, func):
+        # The first call loads the dtd and the templates
+        func()
+        durations = []
+        allocations = Allocations()
+        allocations.start()
+        for i in range(self.repeat):
+            clear_caches()
+            start = time.time()
+            func()
+            durations.append((time.time() - start) * 1000)
+        allocated = allocations.stop()
+        durations.sort()
+        return {
+            'calls': len(durations),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p99': percentile(durations, 99),
+            'max': durations[-1],
+            'allocated': allocated,
+            'allocated_unit': allocations.unit,
+            'peak_rss': get_rss(),
+        }
+
+    @login_user('Bob')
+    def run_endpoints(self):
+        calls = self._get_calls(self.filename, self.nb)
+        results = {}
+        for endpoint in self.endpoints:
+            results[endpoint] = self.measure(calls[endpoint])
+        return results
+
+    def run(self, filename, nb, endpoints):
+        self.filename = filename
+        self.nb = nb
+        self.endpoints = endpoints
+        self.setUp()
+        try:
+            return self.run_endpoints()
+        finally:
+            self.tearDown()
+
+
+def run_suite(sizes, endpoints=None, repeat=DEFAULT_REPEAT, out=None):
+    """Run the benchmarks, returns {'size': {'endpoint': metrics}}
+    """
+    endpoints = endpoints or ENDPOINTS
+    path = tempfile.mkdtemp()
+    server = DTDServer(path)
+    server.start()
+    try:
+        open(os.path.join(path, 'exercise.dtd'), 'w').write(DTD_CONTENT)
+        dtd_url = server.url + '/exercise.dtd'
+        results = {}
+        for size in sorted(sizes):
+            filename = 'file-%s.xml' % size
+            nb = generate_file(os.path.join(path, filename), size, dtd_url)
+            bench = Bench(path, dtd_url, get_repeat(size, repeat))
+            dtd_cache.invalidate()
+            res = bench.run(filename, nb, endpoints)
+            results[str(size)] = res
+            if out is not None:
+                write_results(out, {str(size): res})
+        return results
+    finally:
+        server.stop()
+        shutil.rmtree(path)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Returns the list of the regressions of results compared to baseline:
+    [(size, endpoint, metric, baseline value, value), ...]
+    """
+    regressions = []
+    for size, endpoints in sorted(results.items(), key=lambda t: int(t[0])):
+        for endpoint, metrics in sorted(endpoints.items()):
+            expected = baseline.get(size, {}).get(endpoint)
+            if not expected:
+                continue
+            for metric in COMPARED_METRICS:
+                value = metrics[metric]
+                ref = expected[metric]
+                if max(value, ref) < MIN_COMPARED_MS:
+                    continue
+                if value > ref * (1 + tolerance):
+                    regressions.append((size, endpoint, metric, ref, value))
+    return regressions
+
+
+def format_size(size):
+    size = int(size)
+    if size >= MB:
+        return '%sMB' % (size // MB)
+    if size >= KB:
+        return '%sKB' % (size // KB)
+    return '%sB' % size
+
+
+def write_results(out, results):
+    for size, endpoints in sorted(results.items(), key=lambda t: int(t[0])):
+        for endpoint, m in sorted(endpoints.items()):
+            out.write('%8s %-18s %6d %10.1f %10.1f %10.1f %10.1f %12d %10d\n'
+                      % (format_size(size), endpoint, m['calls'], m['p50'],
+                         m['p90'], m['p99'], m['max'], m['allocated'],
+                         m['peak_rss'] // MB))
+    out.flush()
+
+
+def parse_size(s):
+    s = s.strip().upper()
+    for suffix, factor in [('MB', MB), ('KB', KB), ('B', 1)]:
+        if s.endswith(suffix):
+            return int(float(s[:-len(suffix)]) * factor)
+    return int(s)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--sizes',
+                      default=','.join(map(format_size, DEFAULT_SIZES)),
+                      help='comma separated sizes of the documents '
+                           '[default: %default]')
+    parser.add_option('-e', '--endpoints', default=','.join(ENDPOINTS),
+                      help='comma separated endpoints [default: %default]')
+    parser.add_option('-r', '--repeat', type='int', default=DEFAULT_REPEAT,
+                      help='number of calls for the smallest documents '
+                           '[default: %default]')
+    parser.add_option('--save', help='write the results in this JSON file')
+    parser.add_option('--compare', help='compare with this JSON baseline')
+    parser.add_option('-t', '--tolerance', type='float',
+                      default=DEFAULT_TOLERANCE,
+                      help='allowed slowdown ratio [default: %default]')
+    options, args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in options.sizes.split(',')]
+    endpoints = options.endpoints.split(',')
+    for endpoint in endpoints:
+        if endpoint not in ENDPOINTS:
+            parser.error('Unknown endpoint %s' % endpoint)
+
+    sys.stdout.write('%8s %-18s %6s %10s %10s %10s %10s %12s %10s\n' % (
+        'size', 'endpoint', 'calls', 'p50(ms)', 'p90(ms)', 'p99(ms)',
+        'max(ms)', 'allocated', 'rss(MB)'))
+    results = run_suite(sizes, endpoints, options.repeat, out=sys.stdout)
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.compare:
+        baseline = json.load(open(options.compare))
+        regressions = compare(results, baseline, options.tolerance)
+        for size, endpoint, metric, ref, value in regressions:
+            sys.stdout.write('REGRESSION %s %s %s: %.1f -> %.1f ms\n' % (
+                format_size(size), endpoint, metric, ref, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Compare the save latency of xmltool.update (full form) with the delta
+update according to the document size.
+
+Usage: python benchmarks/update.py [number of elements ...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import xmltool
+from xmltool.utils import prefixes_to_str
+
+from waxe.xml import delta, writer
+from waxe.xml.cache import DTDCache, DocumentCache
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ELEMENT test (question, answer)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT answer (#PCDATA)>
+'''
+
+REPEAT = 5
+
+
+def create_file(path, nb):
+    open(os.path.join(path, 'exercise.dtd'), 'w').write(DTD_CONTENT)
+    filename = os.path.join(path, 'file.xml')
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<!DOCTYPE Exercise SYSTEM "exercise.dtd">',
+           '<Exercise><number>1</number>']
+    for i in range(nb):
+        xml += ['<test><question>Question %s</question>'
+                '<answer>Answer %s</answer></test>' % (i, i)]
+    xml += ['</Exercise>']
+    open(filename, 'w').write('\n'.join(xml))
+    return filename
+
+
+def get_form_params(obj):
+    """The params submitted by the form for obj
+    """
+    params = {
+        '_xml_dtd_url': obj.dtd_url,
+        '_xml_encoding': obj.encoding,
+    }
+    for elt in obj.walk():
+        if isinstance(elt, xmltool.elements.TextElement):
+            key = prefixes_to_str(elt.prefixes_no_cache + ['_value'])
+            params[key] = elt.text
+    return params
+
+
+def timeit(func):
+    durations = []
+    for i in range(REPEAT):
+        start = time.time()
+        func(i)
+        durations.append(time.time() - start)
+    durations.sort()
+    return durations[len(durations) // 2] * 1000
+
+
+def bench(nb):
+    path = tempfile.mkdtemp()
+    try:
+        filename = create_file(path, nb)
+        size = os.path.getsize(filename)
+        params = get_form_params(xmltool.load(filename))
+
+        def full_update(i):
+            data = params.copy()
+            data['Exercise:number:_value'] = str(i)
+            xmltool.update(filename, data)
+
+        dtd_cache = DTDCache()
+        document_cache = DocumentCache()
+        dtd_entry = dtd_cache.get(os.path.join(path, 'exercise.dtd'))
+
+        def delta_update(i):
+            doc = document_cache.load(filename)
+            changes = delta.parse_changes(
+                {'Exercise:number:_value': str(i)})
+            modified, undo = delta.apply_changes(doc.obj, changes)
+            delta.validate_elements(modified, dtd_entry)
+            writer.write_obj(doc.obj, filename)
+            document_cache.set(filename, doc)
+
+        return size, timeit(full_update), timeit(delta_update)
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or [10, 100, 1000, 10000]
+    print '%10s %12s %12s %12s' % ('elements', 'bytes', 'full (ms)',
+                                   'delta (ms)')
+    for nb in sizes:
+        size, full, dlt = bench(nb)
+        print '%10d %12d %12.1f %12.1f' % (nb, size, full, dlt)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,51 @@
+"""Compare the validation of the XML files saved as text: the full xmltool
+load with the tiered validation (lxml + cached dtd) according to the
+document size.
+
+Usage: python benchmarks/validation.py [number of elements ...]
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+import xmltool
+
+from waxe.xml.cache import DTDCache
+
+from update import create_file, timeit
+
+
+def bench(nb):
+    path = tempfile.mkdtemp()
+    try:
+        filename = create_file(path, nb)
+        filecontent = open(filename).read()
+        size = len(filecontent)
+        # The dtd url should be resolved by xmltool.load_string
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            full = timeit(lambda i: xmltool.load_string(filecontent))
+        finally:
+            os.chdir(cwd)
+
+        dtd_cache = DTDCache()
+        tiered = timeit(lambda i: dtd_cache.validate_string(filecontent,
+                                                             path))
+        return size, full, tiered
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or [10, 100, 1000, 10000]
+    print '%10s %12s %12s %12s' % ('elements', 'bytes', 'full (ms)',
+                                   'tiered (ms)')
+    for nb in sizes:
+        size, full, tiered = bench(nb)
+        print '%10d %12d %12.1f %12.1f' % (nb, size, full, tiered)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
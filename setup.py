@@ -31,5 +31,7 @@ setup(name='waxe.xml',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      waxe-xml-validate = waxe.xml.validation:main
       """,
       )
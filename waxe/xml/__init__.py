@@ -1,2 +1,30 @@
 ROUTE_PREFIX = 'xml'
 EXTENSIONS = ['.xml']
+
+# The routes of the editor: (name, pattern)
+EDITOR_ROUTES = [
+    ('edit_json', '/edit.json'),
+    ('edit_stream_json', '/edit-stream.json'),
+    ('edit_batch_json', '/edit-batch.json'),
+    ('edit_lazy_json', '/edit-lazy.json'),
+    ('get_element_json', '/get-element.json'),
+    ('new_json', '/new.json'),
+    ('update_json', '/update.json'),
+    ('update_delta_json', '/update-delta.json'),
+    ('add_element_json', '/add-element.json'),
+    ('get_comment_modal_json', '/get-comment-modal.json'),
+    ('copy_json', '/copy.json'),
+    ('paste_json', '/paste.json'),
+    ('history_json', '/history.json'),
+    ('revert_json', '/revert.json'),
+    ('get_tags_json', '/get-tags.json'),
+    ('validate_json', '/validate.json'),
+]
+EDITOR_ROUTE_NAMES = set([name for name, pattern in EDITOR_ROUTES])
+
+# The routes to look at the metrics and the profiles of the editor
+MONITORING_ROUTES = [
+    ('metrics_json', '/metrics.json'),
+    ('profiles_json', '/profiles.json'),
+    ('get_profile', '/profile'),
+]
@@ -0,0 +1,699 @@
+import os
+import copy
+import time
+import json
+import hashlib
+import logging
+import threading
+from StringIO import StringIO
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from lxml import etree
+
+import xmltool
+from xmltool import dtd, dtd_parser
+
+from waxe.xml.metrics import phase
+from waxe.xml.fetcher import dtd_fetcher, is_remote
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DTD_CACHE_SIZE = 50
+DEFAULT_PREFETCH_WORKERS = 4
+# The rendered forms are not cached by default
+DEFAULT_FORM_CACHE_SIZE = 0
+DEFAULT_DOCUMENT_CACHE_SIZE = 10
+DEFAULT_ELEMENT_CACHE_SIZE = 200
+DEFAULT_RENDERER_CACHE_SIZE = 100
+
+# The placeholders of the element id in the element templates, they can't be
+# in a valid HTML
+ID_PLACEHOLDER = u'\x00id\x00'
+ESCAPED_ID_PLACEHOLDER = u'\x00escaped_id\x00'
+PREFIX_PLACEHOLDER = u'\x00prefix%d\x00'
+ESCAPED_PREFIX_PLACEHOLDER = u'\x00escaped_prefix%d\x00'
+
+
+def get_file_stamp(path):
+    """Returns a stamp which changes when the file is modified.
+    """
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+
+def resolve_dtd_url(url, path=None):
+    """Returns the url of the dtd as xmltool resolves it for a file located
+    in path.
+    """
+    return dtd.DTD(url, path)._get_dtd_url()
+
+
+class LRUCache(object):
+    """Thread-safe mapping which drops the least recently used values when it
+    is full.
+
+    The size of each value is given by get_size, by default each value counts
+    for 1 so max_size is the number of entries we keep.
+    """
+
+    def __init__(self, max_size, get_size=None):
+        self.max_size = max_size
+        self._get_size = get_size or (lambda value: 1)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        with self._lock:
+            return self._data.keys()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move the key at the end: it's the most recently used
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self._get_size(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                # Too big to be cached
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                k, (v, s) = self._data.popitem(last=False)
+                self.size -= s
+                self.evictions += 1
+
+    def _pop(self, key):
+        value, size = self._data.pop(key, (None, 0))
+        self.size -= size
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class DTDEntry(object):
+    """A parsed dtd with the sorted list of its tags.
+    """
+
+    def __init__(self, url, content, elements):
+        self.url = url
+        self.content = content
+        self.fingerprint = hashlib.md5(content).hexdigest()
+        self.elements = elements
+        self._validator = None
+        self._validator_lock = threading.Lock()
+        self.tags = []
+        self.text_tags = []
+        for tag, cls in elements.items():
+            if issubclass(cls, xmltool.elements.TextElement):
+                self.text_tags.append(tag)
+            else:
+                self.tags.append(tag)
+        self.tags.sort()
+        self.text_tags.sort()
+
+    @property
+    def validator(self):
+        """The lxml DTD object used to validate the XML
+        """
+        if self._validator is None:
+            self._validator = etree.DTD(StringIO(self.content))
+        return self._validator
+
+    def validate(self, tree):
+        """Validate the given XML tree.
+
+        :raise etree.DocumentInvalid: if the tree is not valid
+        """
+        # The validator keeps its error log, don't share it between threads
+        with self._validator_lock:
+            self.validator.assertValid(tree)
+
+
+class DTDCache(object):
+    """Process-wide cache of the parsed dtds.
+
+    The entries are keyed by url and by a stamp of the dtd: the modification
+    time and the size for the dtds on the filesystem, the fingerprint of the
+    content given by the fetcher for the remote dtds.
+    """
+
+    def __init__(self, max_size=DEFAULT_DTD_CACHE_SIZE):
+        self.entries = LRUCache(max_size)
+        # DTDDiskCache shared by the processes
+        self.disk_cache = None
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.entries.max_size = int(max_size)
+
+    def _get_stamp(self, url):
+        if is_remote(url):
+            # The fetcher revalidates the dtd, a new content gives a new
+            # entry
+            return dtd_fetcher.get(url).fingerprint
+        return get_file_stamp(url)
+
+    def _get_content(self, url):
+        if is_remote(url):
+            return dtd_fetcher.fetch(url)
+        f = open(url, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _save_dtd_dict(self, url, fingerprint, dtd_dict):
+        try:
+            self.disk_cache.set_dtd_dict(url, fingerprint, dtd_dict)
+        except (IOError, OSError), e:
+            log.warning("Can't write %s in the disk cache: %s", url, e)
+
+    def _parse(self, url, fingerprint, content):
+        """Validate and parse content once, the dict is saved in the disk
+        cache and the lxml DTD is kept as validator.
+        """
+        validator = etree.DTD(StringIO(content))
+        if validator.error_log:
+            raise dtd.ValidationError(validator.error_log)
+        dtd_dict = dtd_parser.dtd_to_dict_v2(content)
+        # The classes creation modifies the dict
+        saved_dict = copy.deepcopy(dtd_dict)
+        # It raises an exception if an element is not defined
+        entry = DTDEntry(url, content, dtd_parser._create_classes(dtd_dict))
+        entry._validator = validator
+        if self.disk_cache is not None:
+            self._save_dtd_dict(url, fingerprint, saved_dict)
+        return entry
+
+    def _load(self, url):
+        with phase('dtd'):
+            content = self._get_content(url)
+            fingerprint = hashlib.md5(content).hexdigest()
+            if self.disk_cache is None:
+                return self._parse(url, fingerprint, content)
+
+            # The dtd has been validated and parsed by another process, we
+            # only have to create the classes.
+            dtd_dict = self.disk_cache.get_dtd_dict(url, fingerprint)
+            if dtd_dict is None:
+                with self.disk_cache.lock(url):
+                    dtd_dict = self.disk_cache.get_dtd_dict(url, fingerprint)
+                    if dtd_dict is None:
+                        return self._parse(url, fingerprint, content)
+            return DTDEntry(url, content,
+                            dtd_parser._create_classes(dtd_dict))
+
+    def get(self, url):
+        """Get the DTDEntry for the given url, the dtd is parsed if needed.
+        """
+        key = (url, self._get_stamp(url))
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._load(url)
+            self.entries.set(key, entry)
+        return entry
+
+    def parse(self, url):
+        """Same as dtd.DTD(url).parse() but cached
+        """
+        return self.get(url).elements
+
+    def load(self, filename):
+        """Same as xmltool.load but the dtd comes from the cache.
+        """
+        parser = etree.XMLParser(strip_cdata=False)
+        tree = etree.parse(filename, parser=parser)
+        dtd_url = tree.docinfo.system_url
+        entry = self.get(resolve_dtd_url(dtd_url, os.path.dirname(filename)))
+        entry.validate(tree)
+        root = tree.getroot()
+        obj = entry.elements[root.tag]()
+        obj.load_from_xml(root)
+        obj.filename = filename
+        obj.dtd_url = dtd_url
+        obj.encoding = tree.docinfo.encoding
+        return obj
+
+    def validate_string(self, xml_str, path=None):
+        """Same as xmltool.load_string but no object is created: the string
+        is parsed by lxml and validated against the cached dtd. The dtd url
+        is resolved in path.
+
+        :return: the lxml tree
+        """
+        if isinstance(xml_str, unicode):
+            xml_str = xml_str.encode('utf-8')
+        with phase('parse'):
+            parser = etree.XMLParser(strip_cdata=False)
+            tree = etree.parse(StringIO(xml_str), parser=parser)
+        dtd_url = tree.docinfo.system_url
+        if not dtd_url:
+            raise ValueError('No dtd defined')
+        entry = self.get(resolve_dtd_url(dtd_url, path))
+        with phase('validate'):
+            entry.validate(tree)
+        return tree
+
+    def get_tags(self, url, text=False):
+        entry = self.get(url)
+        if text:
+            return list(entry.text_tags)
+        return list(entry.tags)
+
+    def _prefetch_one(self, url):
+        start = time.time()
+        try:
+            self.get(url)
+        except Exception, e:
+            log.error('Prefetching dtd %s failed after %.3fs: %s',
+                      url, time.time() - start, e)
+            return url, e
+        log.info('Prefetched dtd %s in %.3fs', url, time.time() - start)
+        return url, None
+
+    def prefetch(self, urls, workers=DEFAULT_PREFETCH_WORKERS):
+        """Fetch and parse the given dtd urls concurrently.
+
+        :return: the list of (url, exception) for the dtds which can't be
+            loaded
+        """
+        urls = list(urls)
+        if not urls:
+            return []
+        pool = ThreadPool(max(1, min(int(workers), len(urls))))
+        try:
+            results = pool.map(self._prefetch_one, urls)
+        finally:
+            pool.close()
+            pool.join()
+        return [(url, e) for url, e in results if e is not None]
+
+    def invalidate(self, url=None):
+        """Remove the given url from the cache, if no url is given the cache
+        is cleared.
+        """
+        if url is None:
+            self.entries.clear()
+            return
+        for key in self.entries.keys():
+            if key[0] == url:
+                self.entries.invalidate(key)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+def _get_payload_size(entry):
+    return entry[2]
+
+
+class FormCache(object):
+    """Cache of the payloads returned when editing a file.
+
+    The entries are keyed by the absolute path of the file, its stamp and a
+    key identifying the rendering (renderer, form attributes, ...). The
+    fingerprint of the dtd is checked before returning a payload. max_size is
+    the memory budget in bytes, 0 disables the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_FORM_CACHE_SIZE, dtd_cache=None):
+        self.entries = LRUCache(max_size, get_size=_get_payload_size)
+        self.dtd_cache = dtd_cache
+
+    @property
+    def enabled(self):
+        return self.entries.max_size > 0
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.entries.max_size = int(max_size)
+
+    def get(self, path, stamp, key):
+        entry = self.entries.get((path, stamp, key))
+        if entry is None:
+            return None
+        dtd_url, fingerprint, size, payload = entry
+        if self.dtd_cache.get(dtd_url).fingerprint != fingerprint:
+            self.entries.invalidate((path, stamp, key))
+            return None
+        return payload
+
+    def set(self, path, stamp, key, dtd_url, payload):
+        """Cache the payload of the file path.
+
+        stamp should be computed before loading the file to be sure we never
+        cache an old payload with a new stamp.
+        """
+        fingerprint = self.dtd_cache.get(dtd_url).fingerprint
+        # The outline payloads have no jstree_data
+        tree = payload.get('outline', payload.get('jstree_data'))
+        size = len(payload['content']) + len(json.dumps(tree))
+        self.entries.set((path, stamp, key),
+                         (dtd_url, fingerprint, size, payload))
+
+    def invalidate(self, path=None):
+        """Remove all the payloads of the given path, if no path is given
+        the cache is cleared.
+        """
+        if path is None:
+            self.entries.clear()
+            return
+        for key in self.entries.keys():
+            if key[0] == path:
+                self.entries.invalidate(key)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class CachedDocument(object):
+    """A loaded xmltool object.
+
+    The rendering modifies the object (html_renderer, auto added elements) so
+    lock should be acquired when using obj.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.lock = threading.Lock()
+
+
+class DocumentCache(object):
+    """Cache of the xmltool objects loaded from the files.
+
+    The entries are keyed by the absolute path of the file and its stamp.
+    max_size is the number of documents we keep, 0 disables the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_DOCUMENT_CACHE_SIZE, dtd_cache=None):
+        self.entries = LRUCache(max_size)
+        self.dtd_cache = dtd_cache
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.entries.max_size = int(max_size)
+
+    def load(self, path):
+        """Returns the CachedDocument of path, the file is loaded if needed.
+        """
+        stamp = get_file_stamp(path)
+        entry = self.entries.get((path, stamp))
+        if entry is None:
+            if self.dtd_cache is None:
+                obj = xmltool.load(path)
+            else:
+                obj = self.dtd_cache.load(path)
+            entry = CachedDocument(obj)
+            self.entries.set((path, stamp), entry)
+        return entry
+
+    def set(self, path, entry, stamp=None):
+        """Cache entry for the current version of path. It should be used
+        when entry.obj has been written in path.
+
+        :param stamp: the stamp of the file when entry.obj has been written,
+            the current one by default.
+        """
+        self.invalidate(path)
+        if stamp is None:
+            stamp = get_file_stamp(path)
+        self.entries.set((path, stamp), entry)
+
+    def invalidate(self, path=None):
+        """Remove the given path from the cache, if no path is given the
+        cache is cleared.
+        """
+        if path is None:
+            self.entries.clear()
+            return
+        for key in self.entries.keys():
+            if key[0] == path:
+                self.entries.invalidate(key)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+def _replace_in(value, old, new):
+    """Returns a copy of value (string, list or dict) where old is replaced
+    by new in all the strings.
+    """
+    if isinstance(value, basestring):
+        return value.replace(old, new)
+    if isinstance(value, list):
+        return [_replace_in(v, old, new) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, _replace_in(v, old, new))
+                     for k, v in value.items()])
+    return value
+
+
+def get_str_id_prefixes(str_id):
+    """The prefixes of str_id ending with an index, the longest first. The
+    ids of the siblings (choice options) and of the children of the element
+    start with them.
+    """
+    splitted = str_id.split(':')
+    return [':'.join(splitted[:i + 1]) + ':'
+            for i in reversed(range(len(splitted) - 1))
+            if splitted[i].isdigit()]
+
+
+def _get_replacements(str_id):
+    """The (value, placeholder) to replace in the template of str_id, the
+    escaped values are replaced first since they contain the other ones.
+    """
+    escape = xmltool.elements.escape_attr
+    escaped = [(escape(str_id), ESCAPED_ID_PLACEHOLDER)]
+    values = [(str_id, ID_PLACEHOLDER)]
+    for i, prefix in enumerate(get_str_id_prefixes(str_id)):
+        escaped.append((escape(prefix), ESCAPED_PREFIX_PLACEHOLDER % i))
+        values.append((prefix, PREFIX_PLACEHOLDER % i))
+    return escaped + values
+
+
+class ElementTemplate(object):
+    """The HTML and the jstree data of a new element where the element id
+    and the prefixes of the ids ending with an index are replaced by
+    placeholders.
+    """
+
+    def __init__(self, str_id, html, jstree_data):
+        replacements = _get_replacements(str_id)
+        for value, placeholder in replacements:
+            html = html.replace(value, placeholder)
+        self.html = html
+        # The li_attr of the element depends on its parent, it's computed
+        # for each element.
+        jstree_data = dict(jstree_data, li_attr=None)
+        for value, placeholder in replacements:
+            jstree_data = _replace_in(jstree_data, value, placeholder)
+        self.jstree_data = jstree_data
+
+    def render(self, str_id):
+        """Returns the HTML and the jstree data of the element str_id
+        """
+        html = self.html
+        jstree_data = self.jstree_data
+        for value, placeholder in _get_replacements(str_id):
+            html = html.replace(placeholder, value)
+            jstree_data = _replace_in(jstree_data, placeholder, value)
+        return html, jstree_data
+
+
+def get_obj_from_str_id(dtd_elements, str_id):
+    """Same as xmltool.factory._get_obj_from_str_id but using the classes of
+    a parsed dtd.
+    """
+    splitted = str_id.split(':')
+    obj = dtd_elements[splitted.pop(0)]()
+    index = None
+    while splitted:
+        s = splitted.pop(0)
+        obj = obj.get_or_add(s, index=index)
+        if len(splitted) > 0:
+            index = None
+        if isinstance(obj, list):
+            index = int(splitted.pop(0))
+
+    if isinstance(obj, xmltool.elements.TextElement) and obj.text is None:
+        obj.set_text('')
+    return obj
+
+
+def get_str_id_shape(str_id):
+    """The str_id without the indexes of the lists: the elements with the
+    same shape have the same template.
+    """
+    return tuple([None if s.isdigit() else s for s in str_id.split(':')])
+
+
+class ElementTemplateCache(object):
+    """Cache of the HTML and jstree data of the new elements.
+
+    A new element is rendered once by dtd, tag path and renderer, the id of
+    the element is substituted for each request. The entries are keyed by
+    the fingerprint of the dtd so they are not used when the dtd changes.
+    max_size is the number of templates we keep, 0 disables the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_ELEMENT_CACHE_SIZE, dtd_cache=None):
+        self.entries = LRUCache(max_size)
+        self.dtd_cache = dtd_cache
+
+    @property
+    def enabled(self):
+        return self.entries.max_size > 0
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.entries.max_size = int(max_size)
+
+    def get_data(self, str_id, dtd_url, html_renderer, renderer_key=None):
+        """Same as xmltool.factory.get_data_from_str_id_for_html_display
+
+        :param renderer_key: hashable value identifying html_renderer
+        """
+        dtd_entry = self.dtd_cache.get(dtd_url)
+        obj = get_obj_from_str_id(dtd_entry.elements, str_id)
+        key = (dtd_url, dtd_entry.fingerprint, get_str_id_shape(str_id),
+               renderer_key)
+        template = self.entries.get(key)
+        if template is None:
+            obj.root.html_renderer = html_renderer
+            jstree_data = obj.to_jstree_dict()
+            previous = obj.get_previous_js_selectors()
+            html = obj.to_html()
+            elt_id = ':'.join(obj.prefixes)
+            self.entries.set(key, ElementTemplate(elt_id, html, jstree_data))
+        else:
+            previous = obj.get_previous_js_selectors()
+            elt_id = ':'.join(obj.prefixes)
+            html, jstree_data = template.render(elt_id)
+            jstree_data['li_attr'] = obj._get_jstree_attrs()
+
+        return {
+            'jstree_data': jstree_data,
+            'previous': previous,
+            'html': html,
+            'elt_id': elt_id,
+        }
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+
+_missing = object()
+
+
+class RendererCache(object):
+    """Cache of the renderers created by the renderer function for each
+    user.
+
+    The renderer function should always return the same renderer for a
+    given login. max_size is the number of renderers we keep, 0 disables the
+    cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_RENDERER_CACHE_SIZE):
+        self.entries = LRUCache(max_size)
+
+    def configure(self, max_size=None):
+        if max_size is not None:
+            self.entries.max_size = int(max_size)
+
+    def get(self, func, login):
+        """Returns func(login), the result is cached
+        """
+        key = (func, login)
+        renderer = self.entries.get(key, _missing)
+        if renderer is _missing:
+            renderer = func(login)
+            self.entries.set(key, renderer)
+        return renderer
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+
+dtd_cache = DTDCache()
+form_cache = FormCache(dtd_cache=dtd_cache)
+document_cache = DocumentCache(dtd_cache=dtd_cache)
+element_cache = ElementTemplateCache(dtd_cache=dtd_cache)
+renderer_cache = RendererCache()
+
+_xmltool_parse = dtd.DTD.parse
+_xmltool_validate_xml = dtd.DTD.validate_xml
+
+
+def _parse(self):
+    if self.url is None:
+        return _xmltool_parse(self)
+    if not self._parsed_dict:
+        self._parsed_dict = dtd_cache.parse(self._get_dtd_url())
+    return self._parsed_dict
+
+
+def _validate_xml(self, xml_obj):
+    if self.url is None:
+        return _xmltool_validate_xml(self, xml_obj)
+    dtd_cache.get(self._get_dtd_url()).validate(xml_obj)
+    return True
+
+
+def install():
+    """Make xmltool parse the dtds and validate the XML with dtd_cache, so
+    the dtds loaded by xmltool itself (update, new elements, ...) are parsed
+    once and can come from the disk cache.
+    """
+    dtd.DTD.parse = _parse
+    dtd.DTD.validate_xml = _validate_xml
+
+
+def uninstall():
+    dtd.DTD.parse = _xmltool_parse
+    dtd.DTD.validate_xml = _xmltool_validate_xml
@@ -0,0 +1,137 @@
+"""Storage of the elements copied by the users.
+
+The default store keeps the parsed data in memory, it only works if the
+copy and the paste are handled by the same process. SharedClipboardStore can
+be used with a memcached-like client when there are many processes or
+nodes.
+"""
+import json
+import time
+
+from waxe.xml.cache import LRUCache
+
+
+DEFAULT_MAX_USERS = 1000
+# Max size in bytes of the data copied by a user
+DEFAULT_MAX_SIZE = 1024 * 1024
+# In seconds
+DEFAULT_TTL = 60 * 60 * 24
+
+
+class ClipboardTooBigError(Exception):
+    pass
+
+
+def get_data_size(data):
+    """Estimation of the size of the data returned by getElementData without
+    serializing it.
+    """
+    if isinstance(data, dict):
+        return sum([len(k) + get_data_size(v) for k, v in data.items()])
+    if isinstance(data, list):
+        return sum([get_data_size(v) for v in data])
+    if isinstance(data, basestring):
+        return len(data)
+    return 4
+
+
+class ClipboardEntry(object):
+
+    def __init__(self, elt_id, data, size, expire):
+        self.elt_id = elt_id
+        self.data = data
+        self.size = size
+        self.expire = expire
+
+
+class MemoryClipboardStore(object):
+    """Keep the last copied element of each user in memory.
+
+    The least recently used clipboards are dropped when there are more than
+    max_users clipboards.
+    """
+
+    def __init__(self, max_users=DEFAULT_MAX_USERS, max_size=DEFAULT_MAX_SIZE,
+                 ttl=DEFAULT_TTL):
+        self.entries = LRUCache(max_users)
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def set(self, user, elt_id, data):
+        """Put data in the clipboard of user
+
+        :raise ClipboardTooBigError: if the data is bigger than max_size
+        """
+        size = get_data_size(data)
+        if size > self.max_size:
+            raise ClipboardTooBigError(
+                'The element is too big to be copied')
+        self.entries.set(user, ClipboardEntry(elt_id, data, size,
+                                              time.time() + self.ttl))
+
+    def get(self, user):
+        """Returns the ClipboardEntry of user or None if there is nothing
+        in its clipboard.
+        """
+        entry = self.entries.get(user)
+        if entry is None:
+            return None
+        if entry.expire < time.time():
+            self.entries.invalidate(user)
+            return None
+        return entry
+
+    def delete(self, user):
+        self.entries.invalidate(user)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class SharedClipboardStore(object):
+    """Keep the clipboards in a store shared by the processes.
+
+    :param client: object with the get(key), set(key, value, time) and
+        delete(key) methods, like a memcache client.
+    """
+    key_prefix = 'waxe.xml.clipboard.'
+
+    def __init__(self, client, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _get_key(self, user):
+        key = self.key_prefix + user
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    def set(self, user, elt_id, data):
+        value = json.dumps({'elt_id': elt_id, 'data': data})
+        if len(value) > self.max_size:
+            raise ClipboardTooBigError(
+                'The element is too big to be copied')
+        self.client.set(self._get_key(user), value, int(self.ttl))
+
+    def get(self, user):
+        value = self.client.get(self._get_key(user))
+        if value is None:
+            return None
+        dic = json.loads(value)
+        return ClipboardEntry(dic['elt_id'], dic['data'], len(value), None)
+
+    def delete(self, user):
+        self.client.delete(self._get_key(user))
+
+    def stats(self):
+        return {}
+
+
+def memory_store_factory(settings):
+    return MemoryClipboardStore(
+        max_users=int(settings.get('waxe.xml.clipboard.max_users',
+                                   DEFAULT_MAX_USERS)),
+        max_size=int(settings.get('waxe.xml.clipboard.max_size',
+                                  DEFAULT_MAX_SIZE)),
+        ttl=int(settings.get('waxe.xml.clipboard.ttl', DEFAULT_TTL)))
@@ -0,0 +1,71 @@
+"""The comment modal rendered once per application.
+
+comment_modal.mak is rendered with a marker in place of the comment, the
+requests only escape the comment and put it between the two parts. The
+JSON body of the empty comment, the most common one, is kept as is.
+"""
+import os
+import json
+
+from mako.filters import html_escape
+from pyramid.renderers import RendererHelper
+
+import waxe.xml
+from waxe.xml.cache import get_file_stamp
+
+
+TEMPLATE_NAME = 'comment_modal.mak'
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(waxe.xml.__file__), 'templates', TEMPLATE_NAME)
+MARKER = u'__waxe_xml_comment__'
+
+
+def get_body(content):
+    """The JSON body of the modal, the same as the json renderer
+    """
+    return json.dumps({'content': content})
+
+
+class CommentModal(object):
+
+    def __init__(self, registry):
+        renderer = RendererHelper(name=TEMPLATE_NAME, package=waxe.xml,
+                                  registry=registry).renderer
+        self.template = renderer.template
+        self.stamp = get_file_stamp(TEMPLATE_PATH)
+        filters = self.template.lookup.template_args.get(
+            'default_filters') or []
+        self.escape = html_escape if 'h' in filters else unicode
+        content = self.template.render_unicode(comment=MARKER)
+        # The marker should appear once to be replaced by the comment
+        self.parts = None
+        if content.count(MARKER) == 1:
+            self.parts = content.split(MARKER)
+        self.empty_body = get_body(self.render(u''))
+
+    def render(self, comment):
+        if self.parts is None:
+            return self.template.render_unicode(comment=comment)
+        return self.parts[0] + unicode(self.escape(comment)) + self.parts[1]
+
+    def get_body(self, comment):
+        if not comment:
+            return self.empty_body
+        return get_body(self.render(comment))
+
+
+def get_comment_modal(registry):
+    """The CommentModal of the application, it's rendered again when the
+    template is modified.
+    """
+    modal = getattr(registry, 'xml_comment_modal', None)
+    if modal is None or modal.stamp != get_file_stamp(TEMPLATE_PATH):
+        modal = registry.xml_comment_modal = CommentModal(registry)
+    return modal
+
+
+def warm_comment_modal(event):
+    """Compile and render the template when the application is created, the
+    first request doesn't pay for it.
+    """
+    get_comment_modal(event.app.registry)
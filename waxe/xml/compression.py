@@ -0,0 +1,160 @@
+"""Content-negotiated compression of the editor responses.
+
+The responses of the editor routes bigger than the threshold are compressed
+with brotli (if the brotli module is installed) or gzip, according to the
+Accept-Encoding header of the request. The streamed responses are never
+compressed.
+"""
+import gzip
+from StringIO import StringIO
+
+from pyramid.settings import asbool
+
+from waxe.xml.conditional import ETAG_SUFFIXES
+from waxe.xml.metrics import phase
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+DEFAULT_THRESHOLD = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 5
+
+# The editor routes (waxe.xml.EDITOR_ROUTES) returning the big payloads
+COMPRESSED_ROUTES = set([
+    'edit_json',
+    'edit_batch_json',
+    'edit_lazy_json',
+    'get_element_json',
+    'new_json',
+    'add_element_json',
+    'paste_json',
+    'get_tags_json',
+    'get_comment_modal_json',
+])
+
+
+def get_encodings():
+    """The supported encodings in order of preference
+    """
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def choose_encoding(accept_encoding, encodings=None):
+    """Returns the encoding to use according to the Accept-Encoding header or
+    None if the response should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    if encodings is None:
+        encodings = get_encodings()
+    qualities = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        qualities[name] = q
+
+    best = None
+    best_q = 0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get('*', 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def gzip_compress(body, level=DEFAULT_GZIP_LEVEL):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=level, mtime=0)
+    try:
+        f.write(body)
+    finally:
+        f.close()
+    return out.getvalue()
+
+
+def compress(body, encoding, level=None):
+    if encoding == 'br':
+        if level is None:
+            level = DEFAULT_BROTLI_QUALITY
+        return brotli.compress(body, quality=level)
+    if level is None:
+        level = DEFAULT_GZIP_LEVEL
+    return gzip_compress(body, level)
+
+
+def _add_vary(response):
+    vary = response.headers.get('Vary')
+    if not vary:
+        response.headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = vary + ', Accept-Encoding'
+
+
+def compress_response(request, response, threshold=DEFAULT_THRESHOLD,
+                      levels=None):
+    """Compress the body of response if it's needed, returns the used
+    encoding.
+    """
+    if response.status_int != 200:
+        return None
+    if response.headers.get('Content-Encoding'):
+        return None
+    if not isinstance(response.app_iter, (list, tuple)):
+        # Don't consume the streamed responses
+        return None
+
+    _add_vary(response)
+    body = response.body
+    if len(body) < threshold:
+        return None
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return None
+
+    with phase('compress'):
+        response.body = compress(body, encoding,
+                                 (levels or {}).get(encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag = response.headers.get('ETag')
+    if etag and etag.endswith('"'):
+        response.headers['ETag'] = etag[:-1] + ETAG_SUFFIXES[encoding] + '"'
+    return encoding
+
+
+def compression_tween_factory(handler, registry):
+    settings = registry.settings or {}
+    if not asbool(settings.get('waxe.xml.compression', True)):
+        return handler
+
+    threshold = int(settings.get('waxe.xml.compression.threshold',
+                                 DEFAULT_THRESHOLD))
+    levels = {
+        'gzip': int(settings.get('waxe.xml.compression.gzip_level',
+                                 DEFAULT_GZIP_LEVEL)),
+        'br': int(settings.get('waxe.xml.compression.brotli_quality',
+                               DEFAULT_BROTLI_QUALITY)),
+    }
+
+    def compression_tween(request):
+        response = handler(request)
+        route = getattr(request, 'matched_route', None)
+        if route is not None and route.name in COMPRESSED_ROUTES:
+            compress_response(request, response, threshold, levels)
+        return response
+
+    return compression_tween
@@ -0,0 +1,67 @@
+"""Helpers for the conditional GET: ETag and Cache-Control headers.
+"""
+import hashlib
+
+
+# Change it when the payloads change for the same input
+ETAG_VERSION = '1'
+
+DEFAULT_MAX_AGE = 3600
+
+# The suffix added to the ETag of a compressed response
+ETAG_SUFFIXES = {
+    'gzip': '-gzip',
+    'br': '-br',
+}
+
+
+def make_etag(*parts):
+    """Returns a strong ETag built from the given parts, they should have a
+    stable repr.
+    """
+    return hashlib.md5(repr((ETAG_VERSION,) + parts)).hexdigest()
+
+
+def parse_if_none_match(value):
+    """Returns the list of the etags of a If-None-Match header, the weak
+    etags are returned without their prefix and the etags of the compressed
+    responses without their suffix.
+    """
+    if not value:
+        return []
+    etags = []
+    for etag in value.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if len(etag) > 1 and etag[0] == etag[-1] == '"':
+            etag = etag[1:-1]
+        for suffix in ETAG_SUFFIXES.values():
+            if etag.endswith(suffix):
+                etag = etag[:-len(suffix)]
+                break
+        if etag:
+            etags.append(etag)
+    return etags
+
+
+def is_not_modified(request, etag):
+    """Returns True if the client already has the version etag
+    """
+    etags = parse_if_none_match(request.headers.get('If-None-Match'))
+    return '*' in etags or etag in etags
+
+
+def get_cache_control(max_age=None, public=False):
+    """The value of the Cache-Control header. Without max_age the client
+    should always revalidate.
+    """
+    scope = 'public' if public else 'private'
+    if max_age is None:
+        return '%s, no-cache' % scope
+    return '%s, max-age=%i' % (scope, max_age)
+
+
+def set_cache_headers(response, etag, cache_control):
+    response.headers['ETag'] = '"%s"' % etag
+    response.headers['Cache-Control'] = cache_control
@@ -0,0 +1,98 @@
+"""Apply the modified values of a form to a loaded xmltool object instead of
+rebuilding the whole object from the submitted form.
+
+Only the values, the comments and the attributes of the existing elements can
+be changed this way, the structural changes need a full update.
+"""
+from xmltool import elements
+
+from waxe.xml.form import get_obj_from_str_id
+
+
+class DeltaError(Exception):
+    pass
+
+
+def parse_changes(params):
+    """Group the submitted params by element.
+
+    :param params: the submitted params like {'Exercise:number:_value': '1'}
+    :return: dict like {'Exercise:number': {'_value': u'1'}}, the attributes
+        are grouped in '_attrs'.
+    """
+    changes = {}
+    for key, value in params.items():
+        if key.startswith('_xml_'):
+            continue
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        if key.endswith(':_value') or key.endswith(':_comment'):
+            str_id, name = key.rsplit(':', 1)
+            changes.setdefault(str_id, {})[name] = value
+        elif ':_attrs:' in key:
+            str_id, name = key.split(':_attrs:', 1)
+            change = changes.setdefault(str_id, {})
+            change.setdefault('_attrs', {})[name] = value
+        else:
+            raise DeltaError('Invalid parameter: %s' % key)
+    return changes
+
+
+def revert(undo):
+    """Cancel the changes made by apply_changes
+    """
+    for elt, attr, value in reversed(undo):
+        setattr(elt, attr, value)
+
+
+def apply_changes(root, changes):
+    """Apply the changes returned by parse_changes to root.
+
+    If a change can't be applied, the object is reverted and the exception is
+    raised.
+
+    :return: the list of the modified elements and the list to give to revert
+        to cancel the changes.
+    """
+    modified = []
+    undo = []
+    try:
+        for str_id, change in changes.items():
+            try:
+                elt = get_obj_from_str_id(root, str_id)
+            except KeyError:
+                raise DeltaError('Element %s not found' % str_id)
+
+            if '_value' in change:
+                if not isinstance(elt, elements.TextElement):
+                    raise DeltaError("Can't set value to %s" % str_id)
+                undo.append((elt, 'text', elt.text))
+                elt.text = change['_value']
+
+            if '_comment' in change:
+                undo.append((elt, 'comment', elt.comment))
+                elt.comment = change['_comment'] or None
+
+            if '_attrs' in change:
+                undo.append((elt, 'attributes',
+                             elt.attributes and dict(elt.attributes)))
+                for name, value in change['_attrs'].items():
+                    if name not in (elt._attribute_names or []):
+                        raise DeltaError('Invalid attribute %s for %s' % (
+                            name, str_id))
+                    elt.add_attribute(name, value)
+            modified.append(elt)
+    except Exception:
+        revert(undo)
+        raise
+    return modified, undo
+
+
+def validate_elements(elts, dtd_entry):
+    """Validate the subtrees of the given elements.
+
+    :param dtd_entry: the DTDEntry of the document
+    :raise etree.DocumentInvalid: if an element is not valid
+    """
+    for elt in elts:
+        dtd_entry.validate(elt.to_xml())
@@ -0,0 +1,244 @@
+"""On-disk cache of the dtds shared by the processes.
+
+For each dtd url we keep:
+
+* <key>.json: the index of the url, the fingerprint of its last content and
+  the validators (ETag, Last-Modified) used by the fetcher,
+* <key>-<fingerprint>.dtd: the content,
+* <key>-<fingerprint>.<python version>.marshal: the result of
+  dtd_parser.dtd_to_dict_v2 for this content.
+
+The classes generated by xmltool can't be serialized, the processes still
+create them from the cached dict but they don't download, validate nor
+parse the dtd anymore.
+
+The files are written in a temporary file renamed to its final name, the
+readers never see a partial file. The processes computing the same
+artifact are serialized with a file lock, the first one writes it and the
+others read it.
+
+When the content of a url changes, the files of its previous content are
+removed. The files not written for max_age seconds are removed by prune,
+it's called by the writes at most every PRUNE_INTERVAL seconds. A removed
+file is fetched or computed again when it's needed.
+"""
+import os
+import sys
+import time
+import json
+import errno
+import marshal
+import hashlib
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+# Change it when the format of the files changes
+ARTIFACT_VERSION = 1
+# marshal is the fastest way to load the dicts but its format depends on the
+# python version
+MARSHAL_EXT = 'py%s%s.marshal' % sys.version_info[:2]
+# In seconds, 0 disables the pruning
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+PRUNE_INTERVAL = 3600
+
+
+def get_key(url):
+    return hashlib.sha1(url).hexdigest()
+
+
+class DTDDiskCache(object):
+
+    def __init__(self, directory, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        # flock doesn't serialize the threads of a process
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._pruned = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.removed = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _read(self, name):
+        try:
+            f = open(self._path(name), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _write(self, name, data):
+        """Write data in name atomically
+        """
+        self._makedirs()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            os.rename(tmp, self._path(name))
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self.writes += 1
+        if self.max_age and time.time() - self._pruned > PRUNE_INTERVAL:
+            self.prune()
+
+    def _remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError, e:
+            # Removed by another process
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self.removed += 1
+
+    def prune(self):
+        """Remove the files which have not been written for max_age seconds.
+        The lock files are kept, they can be used by the other processes.
+        """
+        self._pruned = time.time()
+        if not self.max_age or not os.path.isdir(self.directory):
+            return
+        limit = time.time() - self.max_age
+        for name in os.listdir(self.directory):
+            if name.endswith('.lock'):
+                continue
+            try:
+                if os.path.getmtime(self._path(name)) < limit:
+                    self._remove(name)
+            except OSError, e:
+                log.warning("Can't prune %s: %s", name, e)
+
+    @contextmanager
+    def lock(self, url):
+        """Lock the entries of url between the processes
+        """
+        key = get_key(url)
+        with self._lock:
+            thread_lock = self._locks.setdefault(key, threading.Lock())
+        with thread_lock:
+            if fcntl is None:
+                yield
+                return
+            self._makedirs()
+            f = open(self._path('%s.lock' % key), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            finally:
+                f.close()
+
+    def get_index(self, url):
+        """Returns the index of url: a dict with the fingerprint, etag,
+        last_modified and fetched keys or None
+        """
+        data = self._read('%s.json' % get_key(url))
+        if data is None:
+            return None
+        try:
+            dic = json.loads(data)
+        except ValueError:
+            log.warning('Invalid index for %s', url)
+            return None
+        if dic.get('version') != ARTIFACT_VERSION or dic.get('url') != url:
+            return None
+        return dic
+
+    def get_content(self, url, fingerprint):
+        content = self._read('%s-%s.dtd' % (get_key(url), fingerprint))
+        if content is None:
+            return None
+        if hashlib.md5(content).hexdigest() != fingerprint:
+            log.warning('Invalid content for %s', url)
+            return None
+        return content
+
+    def set_content(self, url, fingerprint, content, etag=None,
+                    last_modified=None, fetched=None):
+        """Save the content of url and update its index
+        """
+        key = get_key(url)
+        index = self.get_index(url)
+        name = '%s-%s.dtd' % (key, fingerprint)
+        if not os.path.exists(self._path(name)):
+            self._write(name, content)
+        else:
+            # Still used, don't prune it
+            os.utime(self._path(name), None)
+        self._write('%s.json' % key, json.dumps({
+            'version': ARTIFACT_VERSION,
+            'url': url,
+            'fingerprint': fingerprint,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': fetched,
+        }))
+        if index is not None and index['fingerprint'] != fingerprint:
+            # The previous content and its artifacts
+            prefix = '%s-%s.' % (key, index['fingerprint'])
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix):
+                    self._remove(name)
+
+    def get_dtd_dict(self, url, fingerprint):
+        """Returns the dict given by dtd_parser.dtd_to_dict_v2 for the
+        content of url identified by fingerprint or None.
+        """
+        data = self._read('%s-%s.%s' % (get_key(url), fingerprint,
+                                        MARSHAL_EXT))
+        if data is not None:
+            try:
+                version, dtd_dict = marshal.loads(data)
+                if version == ARTIFACT_VERSION:
+                    self.hits += 1
+                    return dtd_dict
+            except (ValueError, EOFError, TypeError):
+                log.warning('Invalid artifact for %s', url)
+        self.misses += 1
+        return None
+
+    def set_dtd_dict(self, url, fingerprint, dtd_dict):
+        self._write('%s-%s.%s' % (get_key(url), fingerprint, MARSHAL_EXT),
+                    marshal.dumps((ARTIFACT_VERSION, dtd_dict)))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'removed': self.removed,
+        }
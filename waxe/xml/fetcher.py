@@ -0,0 +1,284 @@
+"""Fetching of the remote dtds.
+
+The dtds are fetched with a pool of persistent connections and kept in
+memory:
+
+* during ttl seconds the copy is used without any request,
+* during the next stale_while_revalidate seconds the copy is still used but
+  it's revalidated in a background thread,
+* after that the copy is revalidated before being used.
+
+The revalidations are conditional requests (If-None-Match and
+If-Modified-Since). If the dtd server can't be reached or returns an error,
+the last copy is used during stale_if_error seconds after its expiration.
+
+When a disk_cache (see waxe.xml.diskcache) is defined, the copies are
+shared by the processes: a process starting uses the copies fetched by the
+others.
+
+install() makes xmltool use the fetcher, so the dtds loaded by xmltool
+itself (update, new elements, ...) also benefit from it.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from urllib2 import URLError
+
+import requests
+from requests.adapters import HTTPAdapter
+from xmltool import dtd
+
+from waxe.xml.metrics import phase
+
+
+log = logging.getLogger(__name__)
+
+# In seconds
+DEFAULT_TTL = 300
+DEFAULT_STALE_WHILE_REVALIDATE = 3600
+DEFAULT_STALE_IF_ERROR = 24 * 3600
+DEFAULT_TIMEOUT = 5
+DEFAULT_POOL_SIZE = 10
+
+
+class DTDFetchError(URLError):
+    """The dtd can't be fetched and there is no usable copy.
+
+    It's an URLError to be handled like the errors of urllib2.
+    """
+
+
+def is_remote(url):
+    return url.startswith('http://') or url.startswith('https://')
+
+
+class FetchedDTD(object):
+
+    def __init__(self, content, etag=None, last_modified=None, fetched=None):
+        self.content = content
+        self.fingerprint = hashlib.md5(content).hexdigest()
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched if fetched is not None else time.time()
+
+
+class DTDFetcher(object):
+
+    def __init__(self, ttl=DEFAULT_TTL,
+                 stale_while_revalidate=DEFAULT_STALE_WHILE_REVALIDATE,
+                 stale_if_error=DEFAULT_STALE_IF_ERROR,
+                 timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE):
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.entries = {}
+        # DTDDiskCache shared by the processes
+        self.disk_cache = None
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self.hits = 0
+        self.fetches = 0
+        self.not_modified = 0
+        self.refreshes = 0
+        self.stale_errors = 0
+
+    def configure(self, ttl=None, stale_while_revalidate=None,
+                  stale_if_error=None, timeout=None, pool_size=None):
+        if ttl is not None:
+            self.ttl = float(ttl)
+        if stale_while_revalidate is not None:
+            self.stale_while_revalidate = float(stale_while_revalidate)
+        if stale_if_error is not None:
+            self.stale_if_error = float(stale_if_error)
+        if timeout is not None:
+            self.timeout = float(timeout)
+        if pool_size is not None:
+            self.pool_size = int(pool_size)
+            self._session = None
+
+    @property
+    def session(self):
+        # Don't share the connections with the parent process
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                  pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+            self._pid = os.getpid()
+        return self._session
+
+    def _request(self, url, entry=None):
+        """Fetch url, entry is the current copy used to make a conditional
+        request.
+
+        :raise DTDFetchError: if the dtd can't be fetched
+        """
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        try:
+            res = self.session.get(url, headers=headers,
+                                   timeout=self.timeout)
+        except requests.RequestException, e:
+            raise DTDFetchError('%s: %s' % (url, e))
+
+        if res.status_code == 304 and entry is not None:
+            self.not_modified += 1
+            return FetchedDTD(entry.content,
+                              res.headers.get('ETag') or entry.etag,
+                              (res.headers.get('Last-Modified') or
+                               entry.last_modified))
+        if res.status_code != 200:
+            raise DTDFetchError('%s: HTTP %s' % (url, res.status_code))
+        self.fetches += 1
+        # We want a string, not unicode, like xmltool
+        return FetchedDTD(res.content, res.headers.get('ETag'),
+                          res.headers.get('Last-Modified'))
+
+    def _revalidate(self, url, entry=None):
+        try:
+            new_entry = self._request(url, entry)
+        except DTDFetchError, e:
+            if (entry is None or
+                    time.time() - entry.fetched >
+                    self.ttl + self.stale_if_error):
+                raise
+            log.warning('Using the stale copy of %s: %s', url, e)
+            self.stale_errors += 1
+            return entry
+        with self._lock:
+            self.entries[url] = new_entry
+        if self.disk_cache is not None:
+            try:
+                self.disk_cache.set_content(
+                    url, new_entry.fingerprint, new_entry.content,
+                    new_entry.etag, new_entry.last_modified,
+                    new_entry.fetched)
+            except (IOError, OSError), e:
+                log.warning("Can't write %s in the disk cache: %s", url, e)
+        return new_entry
+
+    def _load_from_disk(self, url):
+        index = self.disk_cache.get_index(url)
+        if index is None:
+            return None
+        content = self.disk_cache.get_content(url, index['fingerprint'])
+        if content is None:
+            return None
+        entry = FetchedDTD(content, index['etag'], index['last_modified'],
+                           index['fetched'])
+        with self._lock:
+            self.entries[url] = entry
+        return entry
+
+    def _get_first(self, url):
+        """Fetch a dtd we don't have, when the disk cache is used only one
+        process fetches it.
+        """
+        if self.disk_cache is None:
+            return self._revalidate(url)
+        with self.disk_cache.lock(url):
+            # Fetched by another process while we were waiting
+            entry = self._load_from_disk(url)
+            if entry is None:
+                entry = self._revalidate(url)
+        return entry
+
+    def _refresh(self, url, entry):
+        try:
+            self._revalidate(url, entry)
+        except Exception, e:
+            log.exception(e)
+        finally:
+            with self._lock:
+                self._refreshing.pop(url, None)
+
+    def _schedule_refresh(self, url, entry):
+        with self._lock:
+            if url in self._refreshing:
+                return
+            thread = threading.Thread(target=self._refresh,
+                                      args=(url, entry))
+            thread.daemon = True
+            self._refreshing[url] = thread
+            self.refreshes += 1
+        thread.start()
+
+    def get(self, url):
+        """Returns the FetchedDTD of url
+
+        :raise DTDFetchError: if the dtd can't be fetched and there is no
+            usable copy
+        """
+        entry = self.entries.get(url)
+        if entry is None and self.disk_cache is not None:
+            entry = self._load_from_disk(url)
+        if entry is None:
+            return self._get_first(url)
+
+        age = time.time() - entry.fetched
+        if age < self.ttl:
+            self.hits += 1
+            return entry
+        if age < self.ttl + self.stale_while_revalidate:
+            self.hits += 1
+            self._schedule_refresh(url, entry)
+            return entry
+        return self._revalidate(url, entry)
+
+    def fetch(self, url):
+        """Returns the content of the dtd url
+        """
+        return self.get(url).content
+
+    def invalidate(self, url=None):
+        with self._lock:
+            if url is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(url, None)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'fetches': self.fetches,
+            'not_modified': self.not_modified,
+            'refreshes': self.refreshes,
+            'stale_errors': self.stale_errors,
+        }
+
+
+dtd_fetcher = DTDFetcher()
+
+_xmltool_fetch = dtd.DTD._fetch
+
+
+def _fetch(self):
+    url = self._get_dtd_url()
+    with phase('dtd'):
+        if not is_remote(url):
+            return _xmltool_fetch(self)
+        self._content = dtd_fetcher.fetch(url)
+    return self._content
+
+
+def install():
+    """Make xmltool fetch the remote dtds with dtd_fetcher
+    """
+    dtd.DTD._fetch = _fetch
+
+
+def uninstall():
+    dtd.DTD._fetch = _xmltool_fetch
@@ -0,0 +1,351 @@
+"""Helpers to generate the HTML form of an xmltool object by pieces.
+
+The HTML is the same as the one generated by xmltool.generate_form_from_obj
+but we don't need to build the whole string in memory.
+"""
+from xmltool import elements
+from xmltool.utils import prefixes_to_str, truncate
+
+
+def form_parts(obj, form_filename=None, form_attrs=None):
+    """Returns the opening and the closing HTML of the form
+    """
+    hidden_inputs = (
+        '<input type="hidden" name="_xml_filename" '
+        'id="_xml_filename" value="%s" />'
+        '<input type="hidden" name="_xml_dtd_url" '
+        'id="_xml_dtd_url" value="%s" />'
+        '<input type="hidden" name="_xml_encoding" '
+        'id="_xml_encoding" value="%s" />'
+    ) % (
+        form_filename or '',
+        obj.dtd_url,
+        obj.encoding or elements.DEFAULT_ENCODING,
+    )
+    attrs = {}
+    if form_attrs:
+        attrs = form_attrs.copy()
+    if 'id' not in attrs:
+        attrs['id'] = 'xmltool-form'
+
+    attrs_str = ' '.join(['%s="%s"' % tple for tple in attrs.items()])
+    return '<form method="POST" %s>%s' % (attrs_str, hidden_inputs), '</form>'
+
+
+def container_parts(obj):
+    """Returns the opening and the closing HTML of a ContainerElement, the
+    HTML of the children should be put between them.
+    """
+    renderer = obj.get_html_renderer()
+    legend = obj.tagname
+
+    ident = prefixes_to_str(obj.prefixes_no_cache)
+    if obj._parent_obj:
+        # The root element is not deletable
+        if obj._add_html_add_button():
+            legend += obj._get_html_add_button(css_class='hidden')
+
+        if obj._add_html_delete_button():
+            legend += obj._get_html_delete_button()
+
+    if renderer.add_comment():
+        legend += obj._comment_to_html()
+
+    head = (
+        u'<div class="panel panel-default {css_class}" id="{ident}">'
+        u'<div class="panel-heading">'
+        u'<span data-toggle="collapse" '
+        u'href="#collapse-{escaped_id}">{legend}</span>'
+        u'</div>'
+        u'<div class="panel-body panel-collapse collapse in" '
+        u'id="collapse-{ident}">').format(
+            css_class=obj.tagname,
+            ident=ident,
+            legend=legend,
+            escaped_id=elements.escape_attr(ident),
+        )
+    return head + obj._attributes_to_html(), u'</div></div>'
+
+
+def iter_list_html(lst, render=None):
+    """Same as BaseListElement.to_html but yields the HTML element by element
+
+    :param render: function used to get the HTML of an element of the list,
+        by default we call its to_html method.
+    """
+    lst._before_render()
+    renderer = lst.get_html_renderer()
+    yield u'<div class="list-container">'
+    i = 0
+    for e in lst:
+        i += 1
+        if isinstance(e, elements.EmptyElement):
+            continue
+        if render:
+            yield render(e)
+        else:
+            yield e.to_html()
+
+    if renderer.add_add_button():
+        yield lst._get_html_add_button(i)
+    lst._after_render()
+    yield u'</div>'
+
+
+def iter_children_html(obj):
+    """Yields the HTML of the children of obj one by one. The lists are
+    splitted by element.
+    """
+    for child in obj._full_children:
+        if isinstance(child, elements.BaseListElement):
+            for html in iter_list_html(child):
+                yield html
+        else:
+            html = child._to_html()
+            if html:
+                yield html
+        child._delete_auto_added()
+
+
+def iter_form_from_obj(obj, form_filename=None, form_attrs=None):
+    """Same as xmltool.generate_form_from_obj but yields the HTML by top-level
+    subtree.
+    """
+    form_head, form_tail = form_parts(obj, form_filename, form_attrs)
+    if not isinstance(obj, elements.ContainerElement):
+        yield form_head + obj._to_html() + form_tail
+        return
+
+    head, tail = container_parts(obj)
+    yield form_head + head
+    for html in iter_children_html(obj):
+        yield html
+    yield tail + form_tail
+
+
+def lazy_placeholder(obj):
+    """The HTML to put instead of a container which is not rendered
+    """
+    ident = prefixes_to_str(obj.prefixes_no_cache)
+    return u'<div class="xmltool-lazy" data-elt-id="%s"></div>' % ident
+
+
+def _is_rendered_as_container(obj):
+    """Returns True if obj._to_html() calls obj.to_html()
+    """
+    if not isinstance(obj, elements.ContainerElement):
+        return False
+    return obj._has_value() or obj._required or not obj._parent_obj
+
+
+def _lazy_child_html(child, depth):
+    """Same as child._to_html() but the containers deeper than depth are
+    replaced by a placeholder.
+    """
+    if isinstance(child, elements.BaseListElement):
+        return u''.join(iter_list_html(
+            child, render=lambda e: lazy_html(e, depth)))
+    if _is_rendered_as_container(child):
+        return lazy_html(child, depth)
+    return child._to_html()
+
+
+def lazy_container_html(obj, depth):
+    """Same as ContainerElement.to_html (without the add button of the list
+    elements) but only depth levels of sub containers are rendered, the
+    deeper ones are replaced by a placeholder.
+    """
+    head, tail = container_parts(obj)
+    html = [head]
+    for child in obj._full_children:
+        html.append(_lazy_child_html(child, depth - 1))
+        child._delete_auto_added()
+    html.append(tail)
+    return u''.join(html)
+
+
+def lazy_html(obj, depth):
+    """Same as obj.to_html() but the containers deeper than depth are replaced
+    by a placeholder.
+    """
+    if not isinstance(obj, elements.ContainerElement):
+        return obj.to_html()
+
+    html = []
+    if isinstance(obj, elements.InListMixin):
+        if obj.get_html_renderer().add_add_button():
+            lst = obj._parent_obj
+            html.append(lst._get_html_add_button(lst.index(obj)))
+
+    if depth <= 0:
+        html.append(lazy_placeholder(obj))
+    else:
+        html.append(lazy_container_html(obj, depth))
+    return u''.join(html)
+
+
+def lazy_form_from_obj(obj, depth, form_filename=None, form_attrs=None):
+    """Same as xmltool.generate_form_from_obj but only the depth first levels
+    of containers are rendered.
+
+    .. note:: the form can't be submitted before all the placeholders are
+        replaced, otherwise the data of the missing elements will be lost.
+    """
+    form_head, form_tail = form_parts(obj, form_filename, form_attrs)
+    if not isinstance(obj, elements.ContainerElement):
+        return form_head + obj._to_html() + form_tail
+    return form_head + lazy_container_html(obj, depth) + form_tail
+
+
+def get_obj_from_str_id(root, str_id):
+    """Get the element of root corresponding to str_id.
+
+    :raise KeyError: if there is no such element
+    """
+    splitted = str_id.split(':')
+    if splitted.pop(0) != root.tagname:
+        raise KeyError(str_id)
+    obj = root
+    while splitted:
+        s = splitted.pop(0)
+        if isinstance(obj, elements.BaseListElement):
+            try:
+                obj = obj[int(s)]
+            except (ValueError, IndexError):
+                raise KeyError(str_id)
+            if isinstance(obj, elements.EmptyElement):
+                raise KeyError(str_id)
+            # Skip the tagname of the element in the list
+            if splitted and splitted[0] == obj.tagname:
+                splitted.pop(0)
+            continue
+
+        if s in obj:
+            obj = obj[s]
+            continue
+
+        # The ChoiceElement are not in the prefixes
+        for v in obj.xml_elements.values():
+            if isinstance(v, elements.ChoiceElement) and s in v:
+                obj = v[s]
+                break
+        else:
+            raise KeyError(str_id)
+
+    if isinstance(obj, elements.BaseListElement):
+        raise KeyError(str_id)
+    return obj
+
+
+def compact_obj(obj):
+    """Returns the data of obj as nested dicts to render the form on the
+    client side. The keys are short to keep the payload small:
+
+        t: the tagname
+        a: the attributes
+        m: the comment
+        v: the text of a text element
+        d: 1 if the text is a CDATA
+        c: the children
+        l: the tagname of the list containing the element
+        i: the index of the element in its list
+
+    The required elements which are not defined are added like in the form.
+    """
+    node = {'t': obj.tagname}
+    if obj.attributes:
+        node['a'] = dict(obj.attributes)
+    if obj.comment:
+        node['m'] = obj.comment
+    if isinstance(obj, elements.TextElement):
+        if obj.text is not None:
+            node['v'] = obj.text
+        if obj.cdata:
+            node['d'] = 1
+        return node
+
+    children = []
+    for child in obj._children_with_required:
+        if isinstance(child, elements.BaseListElement):
+            for index, elt in enumerate(child):
+                if isinstance(elt, elements.EmptyElement):
+                    continue
+                dic = compact_obj(elt)
+                dic['l'] = child.tagname
+                dic['i'] = index
+                children.append(dic)
+        else:
+            children.append(compact_obj(child))
+        child._delete_auto_added()
+    if children:
+        node['c'] = children
+    return node
+
+
+def outline_obj(obj):
+    """Returns the jstree outline of obj as flat arrays. It has the nodes of
+    obj.to_jstree_dict() in the same order without building the dicts:
+
+        tags: the tagnames used by the nodes
+        parents: the index of the parent node, -1 for the root
+        names: the index in tags of the tagname
+        lists: the index in tags of the list containing the node or -1
+        indexes: the index of the node in its list or -1
+        labels: the labels of the text elements concatenated
+        offsets: the label of the node i is labels[offsets[i]:offsets[i+1]]
+
+    The ids of the jstree nodes are built from the tagnames of the parents
+    and the lists like the prefixes of xmltool.
+    """
+    tags = []
+    tag_indexes = {}
+    parents = []
+    names = []
+    lists = []
+    indexes = []
+    labels = []
+    offsets = [0]
+
+    def get_tag_index(tagname):
+        index = tag_indexes.get(tagname)
+        if index is None:
+            index = tag_indexes[tagname] = len(tags)
+            tags.append(tagname)
+        return index
+
+    def add(elt, parent, lst=None, index=-1):
+        node = len(parents)
+        parents.append(parent)
+        names.append(get_tag_index(elt.tagname))
+        lists.append(get_tag_index(lst.tagname) if lst is not None else -1)
+        indexes.append(index)
+        if isinstance(elt, elements.TextElement):
+            label = truncate(elt.text) if elt.text else ''
+            labels.append(label)
+            offsets.append(offsets[-1] + len(label))
+            return
+        offsets.append(offsets[-1])
+        for child in elt._children_with_required:
+            if isinstance(child, elements.BaseListElement):
+                child._before_render()
+                for i, e in enumerate(child):
+                    if not isinstance(e, elements.EmptyElement):
+                        add(e, node, child, i)
+                child._after_render()
+            elif isinstance(child, elements.ChoiceElement):
+                if child._value:
+                    add(child._value, node)
+            else:
+                add(child, node)
+            child._delete_auto_added()
+
+    add(obj, -1)
+    return {
+        'tags': tags,
+        'parents': parents,
+        'names': names,
+        'lists': lists,
+        'indexes': indexes,
+        'labels': u''.join(labels),
+        'offsets': offsets,
+    }
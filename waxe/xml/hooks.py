@@ -0,0 +1,40 @@
+"""Resolution of the functions defined by dotted path in the settings.
+
+The functions are imported once, the result is kept by dotted path.
+"""
+import importlib
+
+from pyramid.exceptions import ConfigurationError
+
+
+_resolved = {}
+
+
+def resolve(dotted_path):
+    """Returns the object defined by dotted_path like 'package.module.func'
+
+    :raise ConfigurationError: if the object can't be imported
+    """
+    try:
+        return _resolved[dotted_path]
+    except KeyError:
+        pass
+
+    try:
+        mod, name = dotted_path.rsplit('.', 1)
+        obj = getattr(importlib.import_module(mod), name)
+    except (ValueError, ImportError, AttributeError), e:
+        raise ConfigurationError(
+            "Invalid dotted path %s: %s" % (dotted_path, e))
+    _resolved[dotted_path] = obj
+    return obj
+
+
+def get_hook(settings, key):
+    """Returns the function defined in the setting key or None if the setting
+    is not defined.
+    """
+    dotted_path = settings.get(key)
+    if not dotted_path:
+        return None
+    return resolve(dotted_path.strip())
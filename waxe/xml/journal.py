@@ -0,0 +1,434 @@
+"""Journal of the saves of the documents, used to revert a document to one of
+its previous versions (undo and redo).
+
+Each save is an entry of the journal of the document: the list of the
+element-level changes (str_id, attr, old value, new value) made by the save.
+attr is one of:
+
+* text, comment or attributes: the value of an existing element,
+* element: the XML of an element added (the old value is None) or removed
+  (the new value is None). The indexes of the str_ids are the ones of the
+  document when the change is applied, so the changes should be applied in
+  order.
+
+update_delta and the reverts give their changes directly, the full updates
+are diffed against the cached object of the document (see diff_objs).
+
+A version is reconstructed from the current document by putting back the old
+values of the newer changes in the reverse order, it costs O(changes). A
+revert is recorded like a save so the reverted versions are still available.
+
+The storage is bounded: when a journal has more than max_entries entries, the
+oldest half is merged in one snapshot entry, the intermediate versions are
+not available anymore. The oldest entries are dropped when the journal is
+bigger than max_size.
+"""
+import time
+import difflib
+import threading
+
+from lxml import etree
+from xmltool import elements
+from xmltool.utils import prefixes_to_str
+
+from waxe.xml.cache import LRUCache
+from waxe.xml.clipboard import get_data_size
+from waxe.xml.form import get_obj_from_str_id
+
+
+DEFAULT_MAX_DOCUMENTS = 100
+DEFAULT_MAX_ENTRIES = 100
+# Max size in bytes of the journal of a document
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+
+ELEMENT = 'element'
+VALUE_ATTRS = ('text', 'comment', 'attributes')
+# The tag containing an element and its comment in the element changes
+WRAPPER_TAG = 'waxe-journal'
+
+
+class JournalError(Exception):
+    pass
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def _normalize(attr, value):
+    if attr == 'attributes':
+        # An element without attribute can have None or {}
+        return value and dict(value) or None
+    return value
+
+
+def get_changes(undo):
+    """Returns the element-level changes of the undo list given by
+    delta.apply_changes, the elements have their new values.
+    """
+    changes = []
+    for elt, attr, old in undo:
+        new = _normalize(attr, getattr(elt, attr))
+        old = _normalize(attr, old)
+        if old != new:
+            changes.append((prefixes_to_str(elt.prefixes_no_cache), attr,
+                            old, new))
+    return changes
+
+
+def element_to_string(elt):
+    """The XML of elt with its comment
+    """
+    xml = elt.to_xml()
+    wrapper = etree.Element(WRAPPER_TAG)
+    wrapper.append(xml)
+    # The comment is added before the element
+    elt._comment_to_xml(xml)
+    return etree.tostring(wrapper)
+
+
+def _diff_values(old, new, str_id, changes):
+    for attr in VALUE_ATTRS:
+        if attr == 'text' and not isinstance(old, elements.TextElement):
+            continue
+        old_value = _normalize(attr, getattr(old, attr))
+        new_value = _normalize(attr, getattr(new, attr))
+        if old_value != new_value:
+            changes.append((str_id, attr, old_value, new_value))
+
+
+def _diff_list(old_items, new_items, str_id, changes):
+    """The items are matched by their XML, the changed items are diffed
+    when they have the same tag, otherwise they are removed and added.
+
+    The changes are made from the end of the list: the indexes of the
+    items before the change are the ones of old_items.
+    """
+    old_xml = [element_to_string(e) for e in old_items]
+    new_xml = [element_to_string(e) for e in new_items]
+    matcher = difflib.SequenceMatcher(None, old_xml, new_xml, autojunk=False)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        if i2 - i1 == j2 - j1:
+            for k in reversed(range(i2 - i1)):
+                old, new = old_items[i1 + k], new_items[j1 + k]
+                item_id = '%s:%s:%s' % (str_id, i1 + k, old.tagname)
+                if old.tagname == new.tagname:
+                    _diff_element(old, new, item_id, changes)
+                    continue
+                changes.append((item_id, ELEMENT, old_xml[i1 + k], None))
+                changes.append(('%s:%s:%s' % (str_id, i1 + k, new.tagname),
+                                ELEMENT, None, new_xml[j1 + k]))
+            continue
+        for k in reversed(range(i1, i2)):
+            changes.append(('%s:%s:%s' % (str_id, k, old_items[k].tagname),
+                            ELEMENT, old_xml[k], None))
+        for k in range(j2 - j1):
+            new = new_items[j1 + k]
+            changes.append(('%s:%s:%s' % (str_id, i1 + k, new.tagname),
+                            ELEMENT, None, new_xml[j1 + k]))
+
+
+def _diff_element(old, new, str_id, changes):
+    _diff_values(old, new, str_id, changes)
+    for cls in old.children_classes:
+        old_value = cls._get_value_from_parent(old)
+        new_value = cls._get_value_from_parent(new)
+        if issubclass(cls, elements.BaseListElement):
+            _diff_list(old_value or [], new_value or [],
+                       '%s:%s' % (str_id, cls.tagname), changes)
+            continue
+        if (old_value is not None and new_value is not None and
+                old_value.tagname == new_value.tagname):
+            _diff_element(old_value, new_value,
+                          '%s:%s' % (str_id, old_value.tagname), changes)
+            continue
+        # The ChoiceElement are not in the str_ids
+        if old_value is not None:
+            changes.append(('%s:%s' % (str_id, old_value.tagname), ELEMENT,
+                            element_to_string(old_value), None))
+        if new_value is not None:
+            changes.append(('%s:%s' % (str_id, new_value.tagname), ELEMENT,
+                            None, element_to_string(new_value)))
+
+
+def diff_objs(old, new):
+    """Returns the changes to apply to the xmltool object old to get new.
+
+    :raise JournalError: if the root elements are not the same
+    """
+    if old.tagname != new.tagname:
+        raise JournalError("The root %s can't be replaced by %s" % (
+            old.tagname, new.tagname))
+    changes = []
+    _diff_element(old, new, old.tagname, changes)
+    return changes
+
+
+def _get_element(root, str_id):
+    try:
+        return get_obj_from_str_id(root, str_id)
+    except KeyError:
+        raise JournalError('Element %s not found' % str_id)
+
+
+def _add_element(root, str_id, value):
+    splitted = str_id.split(':')
+    tagname = splitted.pop()
+    index = None
+    if len(splitted) > 1 and splitted[-1].isdigit():
+        index = int(splitted.pop())
+        # The tagname of the list
+        splitted.pop()
+    parent = _get_element(root, ':'.join(splitted))
+    xml = etree.fromstring(value)[-1]
+    try:
+        obj = parent.add(tagname, index=index)
+    except Exception, e:
+        raise JournalError("Element %s can't be added: %s" % (str_id, e))
+    obj.load_from_xml(xml)
+    return obj
+
+
+def apply_values(root, values):
+    """Set the (str_id, attr, value) to the elements of root in the given
+    order. If a value can't be set, the object is reverted and the exception
+    is raised.
+
+    :return: the list of the modified elements and the list of the applied
+        changes, it can be given to cancel_changes.
+    """
+    modified = []
+    changes = []
+    try:
+        for str_id, attr, value in values:
+            if attr == ELEMENT:
+                elt = None
+                old = None
+                if value is None:
+                    obj = _get_element(root, str_id)
+                    old = element_to_string(obj)
+                    obj.delete()
+                else:
+                    elt = _add_element(root, str_id, value)
+            else:
+                elt = _get_element(root, str_id)
+                old = _copy(getattr(elt, attr))
+                setattr(elt, attr, _copy(value))
+            changes.append((str_id, attr, old, value))
+            if elt is not None and elt not in modified:
+                modified.append(elt)
+    except Exception:
+        cancel_changes(root, changes)
+        raise
+    return modified, changes
+
+
+def cancel_changes(root, changes):
+    """Cancel the changes applied by apply_values
+    """
+    apply_values(root, [(str_id, attr, old)
+                        for str_id, attr, old, new in reversed(changes)])
+
+
+class JournalEntry(object):
+    """A save of the document, it goes from the version previous to the
+    version version.
+    """
+
+    def __init__(self, changes, user=None):
+        self.changes = changes
+        self.user = user
+        self.time = time.time()
+        self.previous = None
+        self.version = None
+        self.size = get_data_size([list(c) for c in changes])
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'previous': self.previous,
+            'time': self.time,
+            'user': self.user,
+            'changes': len(self.changes),
+        }
+
+
+def merge_entries(entries):
+    """Merge the consecutive entries in one entry. When there are only value
+    changes, we keep the oldest and the newest value of each element.
+    """
+    if len(entries) == 1:
+        return entries[0]
+    changes = []
+    for entry in entries:
+        changes.extend(entry.changes)
+    if not [c for c in changes if c[1] == ELEMENT]:
+        values = {}
+        keys = []
+        for str_id, attr, old, new in changes:
+            key = (str_id, attr)
+            if key in values:
+                values[key][1] = new
+            else:
+                values[key] = [old, new]
+                keys.append(key)
+        changes = [key + tuple(values[key]) for key in keys
+                   if values[key][0] != values[key][1]]
+    merged = JournalEntry(changes, user=entries[-1].user)
+    merged.time = entries[-1].time
+    merged.previous = entries[0].previous
+    merged.version = entries[-1].version
+    return merged
+
+
+class DocumentJournal(object):
+    """The entries of a document, the current version of the document is
+    version and the oldest available one is base.
+
+    stamp is the stamp of the file after the last recorded save. If the
+    file has been modified outside of the journal, the entries are
+    dropped.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_size=DEFAULT_MAX_SIZE):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.entries = []
+        self.version = 0
+        self.base = 0
+        self.size = 0
+        self.stamp = None
+        # Reverting and saving shouldn't be mixed
+        self.lock = threading.RLock()
+
+    def clear(self):
+        self.entries = []
+        self.base = self.version
+        self.size = 0
+
+    def is_modified(self, stamp):
+        return self.stamp is not None and self.stamp != stamp
+
+    def sync(self, stamp):
+        """stamp is the current stamp of the file, the entries are dropped
+        if the file has been modified outside of the journal.
+        """
+        with self.lock:
+            if self.is_modified(stamp):
+                self.clear()
+            self.stamp = stamp
+
+    def record(self, before_stamp, after_stamp, entry=None):
+        """Record a save, before_stamp and after_stamp are the stamps of the
+        file before and after the save. entry is None if the document has
+        not changed.
+
+        :return: the current version
+        """
+        with self.lock:
+            self.sync(before_stamp)
+            self.stamp = after_stamp
+            if entry is None:
+                return self.version
+            entry.previous = self.version
+            self.version += 1
+            entry.version = self.version
+            self.entries.append(entry)
+            self.size += entry.size
+            self._trim()
+            return self.version
+
+    def _drop_oldest(self):
+        entry = self.entries.pop(0)
+        self.size -= entry.size
+        self.base = entry.version
+
+    def _trim(self):
+        if len(self.entries) > self.max_entries:
+            nb = len(self.entries) - self.max_entries // 2
+            self.entries = ([merge_entries(self.entries[:nb])] +
+                            self.entries[nb:])
+            self.size = sum([e.size for e in self.entries])
+        while self.entries and self.size > self.max_size:
+            self._drop_oldest()
+
+    def get_versions(self):
+        return [self.base] + [e.version for e in self.entries]
+
+    def get_revert(self, version):
+        """Returns the (str_id, attr, value) to give to apply_values to
+        build version from the current version.
+
+        :raise JournalError: if the version is not available
+        """
+        with self.lock:
+            if version not in self.get_versions():
+                raise JournalError('The version %s is not available' %
+                                   version)
+            values = []
+            for entry in reversed(self.entries):
+                if entry.version <= version:
+                    break
+                values += [(str_id, attr, old) for str_id, attr, old, new
+                           in reversed(entry.changes)]
+            return values
+
+    def history(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'base': self.base,
+                'entries': [e.to_dict() for e in self.entries],
+            }
+
+
+class MemoryJournalStore(object):
+    """Keep the journals of the documents in memory.
+
+    .. warning:: The journals are not shared between the processes: it
+        should only be used when the application runs in one process,
+        otherwise a file saved by a process has no history in the other
+        ones. Use waxe.xml.journal.factory to share the journals.
+
+    The journals of the least recently saved documents are dropped when
+    there are more than max_documents journals.
+    """
+
+    def __init__(self, max_documents=DEFAULT_MAX_DOCUMENTS,
+                 max_entries=DEFAULT_MAX_ENTRIES, max_size=DEFAULT_MAX_SIZE):
+        self.journals = LRUCache(max_documents)
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get(self, path, create=False):
+        """Returns the journal of path, None if there is no journal and
+        create is False.
+        """
+        with self._lock:
+            journal = self.journals.get(path)
+            if journal is None and create:
+                journal = DocumentJournal(self.max_entries, self.max_size)
+                self.journals.set(path, journal)
+            return journal
+
+    def delete(self, path):
+        self.journals.invalidate(path)
+
+    def stats(self):
+        return self.journals.stats()
+
+
+def memory_store_factory(settings):
+    return MemoryJournalStore(
+        max_documents=int(settings.get('waxe.xml.journal.max_documents',
+                                       DEFAULT_MAX_DOCUMENTS)),
+        max_entries=int(settings.get('waxe.xml.journal.max_entries',
+                                     DEFAULT_MAX_ENTRIES)),
+        max_size=int(settings.get('waxe.xml.journal.max_size',
+                                  DEFAULT_MAX_SIZE)))
@@ -0,0 +1,302 @@
+"""Timing of the phases of the editor requests.
+
+The code wraps the expensive phases with:
+
+    with phase('render'):
+        ...
+
+The durations are recorded in the timer of the current request, there is
+nothing to do when there is no request (scripts, worker processes). The
+phases can be nested ('load' contains 'dtd' when the dtd is fetched), the
+durations of the phases with the same name are summed.
+
+At the end of the request the timings of the editor routes (TIMED_ROUTES)
+are sent in the Server-Timing header and to the metrics sink. The sink is
+created by the function defined in waxe.xml.metrics.sink, it receives the
+settings. By default the durations are kept in memory in histograms,
+statsd_sink_factory sends them to a statsd server.
+"""
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from pyramid.settings import asbool
+
+import waxe.xml
+from waxe.xml.hooks import get_hook
+
+
+log = logging.getLogger(__name__)
+
+# The upper bounds in ms of the histogram buckets
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                   10000)
+DEFAULT_STATSD_HOST = 'localhost'
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_STATSD_PREFIX = 'waxe.xml'
+# The max size of a statsd datagram
+STATSD_MAX_PACKET = 1432
+
+# The routes of the editor, the other routes of the application are not
+# timed
+TIMED_ROUTES = waxe.xml.EDITOR_ROUTE_NAMES
+
+_local = threading.local()
+
+
+class PhaseTimer(object):
+    """The durations in ms of the phases of a request
+    """
+
+    def __init__(self):
+        self.durations = OrderedDict()
+        self._started = {}
+
+    def add(self, name, duration):
+        self.durations[name] = self.durations.get(name, 0) + duration
+
+    def start(self, name):
+        self._started[name] = time.time()
+
+    def stop(self, name):
+        """Stop the phase started with start, does nothing if the phase is
+        not started.
+        """
+        start = self._started.pop(name, None)
+        if start is not None:
+            self.add(name, (time.time() - start) * 1000)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, (time.time() - start) * 1000)
+
+    def items(self):
+        return self.durations.items()
+
+
+def get_current_timer():
+    return getattr(_local, 'timer', None)
+
+
+def set_current_timer(timer):
+    _local.timer = timer
+
+
+@contextmanager
+def phase(name):
+    """Record the duration of the block in the timer of the current request
+    """
+    timer = get_current_timer()
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+def get_server_timing(timings):
+    """The value of the Server-Timing header for the given (name, ms)
+    """
+    return ', '.join(['%s;dur=%.1f' % (name, duration)
+                      for name, duration in timings])
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last one is for the values bigger than the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Estimation of the p percentile: the upper bound of the bucket
+        containing it.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': zip([str(b) for b in self.buckets] + ['+Inf'],
+                           self.counts),
+        }
+
+
+class HistogramSink(object):
+    """Keep the durations in memory, one histogram by route and phase
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, route_name, timings):
+        with self._lock:
+            for name, duration in timings:
+                key = '%s.%s' % (route_name, name)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram(
+                        self.buckets)
+                histogram.record(duration)
+
+    def snapshot(self):
+        with self._lock:
+            return dict([(key, histogram.snapshot())
+                         for key, histogram in self.histograms.items()])
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+
+class StatsdSink(object):
+    """Send the durations as statsd timers over UDP, the errors are ignored:
+    the metrics should never break a request.
+    """
+
+    def __init__(self, host=DEFAULT_STATSD_HOST, port=DEFAULT_STATSD_PORT,
+                 prefix=DEFAULT_STATSD_PREFIX):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def get_lines(self, route_name, timings):
+        prefix = route_name
+        if self.prefix:
+            prefix = '%s.%s' % (self.prefix, route_name)
+        return ['%s.%s:%.3f|ms' % (prefix, name, duration)
+                for name, duration in timings]
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error, e:
+            log.debug("Can't send the metrics: %s", e)
+
+    def record(self, route_name, timings):
+        # Send many metrics by packet
+        packet = []
+        size = 0
+        for line in self.get_lines(route_name, timings):
+            if packet and size + len(line) + 1 > STATSD_MAX_PACKET:
+                self.send('\n'.join(packet))
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.send('\n'.join(packet))
+
+    def snapshot(self):
+        return {}
+
+
+def histogram_sink_factory(settings):
+    return HistogramSink()
+
+
+def statsd_sink_factory(settings):
+    return StatsdSink(
+        host=settings.get('waxe.xml.metrics.statsd.host',
+                          DEFAULT_STATSD_HOST),
+        port=settings.get('waxe.xml.metrics.statsd.port',
+                          DEFAULT_STATSD_PORT),
+        prefix=settings.get('waxe.xml.metrics.statsd.prefix',
+                            DEFAULT_STATSD_PREFIX))
+
+
+def get_metrics_sink(settings):
+    """Create the metrics sink, the function creating it can be defined in
+    waxe.xml.metrics.sink, it receives the settings.
+    """
+    func = get_hook(settings, 'waxe.xml.metrics.sink')
+    if func is None:
+        return histogram_sink_factory(settings)
+    return func(settings)
+
+
+def start_serialize(event):
+    """BeforeRender subscriber: the renderer will serialize the result of
+    the view.
+    """
+    request = event.get('request')
+    timer = getattr(request, 'xml_timer', None)
+    if timer is not None:
+        timer.start('serialize')
+
+
+def timing_tween_factory(handler, registry):
+    settings = registry.settings or {}
+    if not asbool(settings.get('waxe.xml.metrics', True)):
+        return handler
+    server_timing = asbool(settings.get('waxe.xml.metrics.server_timing',
+                                        True))
+
+    def timing_tween(request):
+        timer = PhaseTimer()
+        request.xml_timer = timer
+        set_current_timer(timer)
+        start = time.time()
+        try:
+            response = handler(request)
+        finally:
+            set_current_timer(None)
+        timer.stop('serialize')
+        timer.add('total', (time.time() - start) * 1000)
+
+        route = getattr(request, 'matched_route', None)
+        if route is None or route.name not in TIMED_ROUTES:
+            return response
+        timings = timer.items()
+        if server_timing:
+            response.headers['Server-Timing'] = get_server_timing(timings)
+        sink = getattr(registry, 'xml_metrics', None)
+        if sink is not None:
+            try:
+                sink.record(route.name, timings)
+            except Exception, e:
+                log.exception(e)
+        return response
+
+    return timing_tween
@@ -0,0 +1,103 @@
+"""Dispatch of the add_element calls to the plugins.
+
+A plugin is a module (or any object) with the functions
+match(request, str_id, dtd_url) and add_element(request, str_id, dtd_url).
+It can also declare the elements it handles:
+
+    # Patterns (fnmatch syntax) of the dtd urls
+    dtd_urls = ['http://dtd.example.com/*.dtd']
+    # Patterns (fnmatch syntax) of the tags of the elements to add
+    tags = ['section', 'chapter', 'list-*']
+
+The declared plugins are only probed for the matching elements: match is
+not required for them, if it's defined it's called to confirm the
+dispatch. The plugins without declaration are probed for each element like
+before.
+"""
+import fnmatch
+import importlib
+
+from pyramid.exceptions import ConfigurationError
+
+from waxe.xml.cache import LRUCache
+
+
+# Number of (dtd_url, tag) for which we keep the candidate plugins
+DEFAULT_INDEX_SIZE = 1000
+
+
+def get_tag(str_id):
+    """The tag of the element identified by str_id
+    """
+    return str_id.rsplit(':', 1)[-1]
+
+
+def load_plugins(names):
+    """Import the given plugin modules
+
+    :raise ConfigurationError: if a module can't be imported
+    """
+    plugins = []
+    for name in names:
+        try:
+            plugins.append(importlib.import_module(name))
+        except ImportError, e:
+            raise ConfigurationError(
+                "The plugin %s can't be loaded: %s" % (name, e))
+    return plugins
+
+
+class PluginIndex(list):
+    """The list of the plugins with an index of the candidates for each
+    (dtd_url, tag).
+    """
+
+    def __init__(self, plugins=None, max_size=DEFAULT_INDEX_SIZE):
+        super(PluginIndex, self).__init__(plugins or [])
+        self.candidates = LRUCache(max_size)
+
+    def _is_declared(self, plugin):
+        return (getattr(plugin, 'dtd_urls', None) is not None or
+                getattr(plugin, 'tags', None) is not None)
+
+    def _is_candidate(self, plugin, dtd_url, tag):
+        if not self._is_declared(plugin):
+            return True
+        tags = getattr(plugin, 'tags', None)
+        if tags is not None:
+            for pattern in tags:
+                if fnmatch.fnmatchcase(tag, pattern):
+                    break
+            else:
+                return False
+        dtd_urls = getattr(plugin, 'dtd_urls', None)
+        if dtd_urls is not None:
+            for pattern in dtd_urls:
+                if fnmatch.fnmatchcase(dtd_url, pattern):
+                    return True
+            return False
+        return True
+
+    def get_candidates(self, dtd_url, tag):
+        """Returns the plugins which can handle the tag for dtd_url, ordered
+        like the plugins.
+        """
+        key = (dtd_url, tag)
+        candidates = self.candidates.get(key)
+        if candidates is None:
+            candidates = [p for p in self
+                          if self._is_candidate(p, dtd_url, tag)]
+            self.candidates.set(key, candidates)
+        return candidates
+
+    def match(self, request, str_id, dtd_url):
+        """Returns the first plugin handling str_id
+        """
+        for plugin in self.get_candidates(dtd_url, get_tag(str_id)):
+            if not self._is_declared(plugin):
+                if plugin.match(request, str_id, dtd_url):
+                    return plugin
+            elif (not hasattr(plugin, 'match') or
+                    plugin.match(request, str_id, dtd_url)):
+                return plugin
+        return None
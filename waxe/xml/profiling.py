@@ -0,0 +1,327 @@
+"""Opt-in profiling of the editor requests in production.
+
+Two modes can be combined:
+
+* waxe.xml.profiling.percent: this percentage of the requests is profiled
+  with cProfile, the profiles are saved as pstats files.
+* waxe.xml.profiling.threshold: the other requests are watched by a stack
+  sampler (a thread looking at the stack of the request every
+  waxe.xml.profiling.interval seconds). When a request takes more than
+  threshold ms its stacks are saved in the folded format used by
+  flamegraph.pl and speedscope.
+
+The profiles are kept in waxe.xml.profiling.directory, only the
+waxe.xml.profiling.max_files last ones are kept. Each profile has a JSON
+file with the route, the path of the edited file, the dtd and the duration
+of the request. They can be listed and downloaded with the profiles.json
+and profile routes.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import cProfile
+import tempfile
+import itertools
+import threading
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.settings import asbool
+
+import waxe.xml
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PERCENT = 0
+# In ms, 0 disables the sampler
+DEFAULT_THRESHOLD = 0
+# In seconds
+DEFAULT_INTERVAL = 0.005
+DEFAULT_MAX_FILES = 100
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), 'waxe-xml-profiles')
+
+PSTATS = 'pstats'
+FOLDED = 'folded'
+
+# The routes of the editor, the other routes of the application and the
+# download of the profiles are not profiled
+PROFILED_ROUTES = waxe.xml.EDITOR_ROUTE_NAMES
+
+
+def get_stack_key(frame):
+    """The stack of frame in the folded format: the callers first, separated
+    by ;
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%s)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class StackSampler(object):
+    """Sample the stacks of the registered threads.
+
+    The sampling thread is only running when there are registered threads.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, ident=None):
+        """Start to sample the given thread, by default the current one
+        """
+        if ident is None:
+            ident = threading.current_thread().ident
+        with self._lock:
+            self.stacks[ident] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, ident=None):
+        """Stop to sample the thread, returns {stack: count}
+        """
+        if ident is None:
+            ident = threading.current_thread().ident
+        with self._lock:
+            return self.stacks.pop(ident, {})
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, stacks in self.stacks.items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            key = get_stack_key(frame)
+            stacks[key] = stacks.get(key, 0) + 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self.stacks:
+                    self._thread = None
+                    return
+                self.sample()
+
+
+def get_folded(stacks):
+    return ''.join(['%s %s\n' % (key, count)
+                    for key, count in sorted(stacks.items())])
+
+
+class ProfileStore(object):
+    """The last max_files profiles saved in directory.
+
+    The directory can be shared by the processes, the names contain the pid.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY,
+                 max_files=DEFAULT_MAX_FILES):
+        self.directory = directory
+        self.max_files = max_files
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _get_name(self, route_name, kind):
+        return '%s-%s-%s-%s.%s' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            next(self._counter), route_name, kind)
+
+    def save(self, route_name, kind, write, tags):
+        """Save a profile
+
+        :param write: function receiving the filename where to write the
+            profile
+        :param tags: dict saved with the profile
+        :return: the name of the profile
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.directory):
+                    raise
+        name = self._get_name(route_name, kind)
+        filename = os.path.join(self.directory, name)
+        write(filename)
+        dic = dict(tags, name=name, kind=kind, route=route_name,
+                   created=time.time())
+        f = open(filename + '.json', 'w')
+        try:
+            json.dump(dic, f)
+        finally:
+            f.close()
+        self.trim()
+        return name
+
+    def _names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [name for name in os.listdir(self.directory)
+                if os.path.splitext(name)[1] in ('.' + PSTATS, '.' + FOLDED)]
+
+    def _get_created(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self.directory, name))
+        except OSError:
+            return 0
+
+    def trim(self):
+        """Remove the oldest profiles when there are more than max_files
+        """
+        with self._lock:
+            names = sorted(self._names(), key=self._get_created)
+            for name in names[:max(0, len(names) - self.max_files)]:
+                for filename in [name, name + '.json']:
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        # Removed by another process
+                        pass
+
+    def list(self):
+        """The metadata of the profiles, the newest first
+        """
+        profiles = []
+        for name in self._names():
+            try:
+                f = open(os.path.join(self.directory, name + '.json'))
+                try:
+                    dic = json.load(f)
+                finally:
+                    f.close()
+                dic['size'] = os.path.getsize(
+                    os.path.join(self.directory, name))
+            except (IOError, OSError, ValueError):
+                continue
+            profiles.append(dic)
+        profiles.sort(key=lambda dic: dic['created'], reverse=True)
+        return profiles
+
+    def get_path(self, name):
+        """The path of the profile name or None if it doesn't exist
+        """
+        if not name or name not in self._names():
+            return None
+        return os.path.join(self.directory, name)
+
+
+def get_route_name(request, registry):
+    """The name of the route of request. The tweens are called before the
+    router, so the route is matched here.
+    """
+    route = getattr(request, 'matched_route', None)
+    if route is None:
+        mapper = registry.queryUtility(IRoutesMapper)
+        if mapper is None:
+            return None
+        route = mapper(request)['route']
+    if route is None:
+        return None
+    return route.name
+
+
+def get_tags(request):
+    """The tags of the profile of request: the path of the edited file and
+    its dtd. The views can complete request.xml_profile_tags.
+    """
+    params = request.params
+    tags = {
+        'path': params.get('path') or params.get('_xml_filename'),
+        'dtd_url': params.get('dtd_url') or params.get('_xml_dtd_url'),
+    }
+    tags.update(getattr(request, 'xml_profile_tags', None) or {})
+    return tags
+
+
+def add_tags(request, **kw):
+    """Add tags to the profile of request, if it's profiled
+    """
+    tags = getattr(request, 'xml_profile_tags', None)
+    if tags is not None:
+        tags.update(kw)
+
+
+def get_profile_store(settings):
+    return ProfileStore(
+        directory=settings.get('waxe.xml.profiling.directory',
+                               DEFAULT_DIRECTORY),
+        max_files=int(settings.get('waxe.xml.profiling.max_files',
+                                   DEFAULT_MAX_FILES)))
+
+
+def profiling_tween_factory(handler, registry):
+    settings = registry.settings or {}
+    if not asbool(settings.get('waxe.xml.profiling')):
+        return handler
+
+    percent = float(settings.get('waxe.xml.profiling.percent',
+                                 DEFAULT_PERCENT))
+    threshold = float(settings.get('waxe.xml.profiling.threshold',
+                                   DEFAULT_THRESHOLD))
+    sampler = StackSampler(float(settings.get('waxe.xml.profiling.interval',
+                                              DEFAULT_INTERVAL)))
+    store = getattr(registry, 'xml_profiles', None)
+    if store is None:
+        store = registry.xml_profiles = get_profile_store(settings)
+
+    def save(request, route_name, kind, write, duration):
+        tags = get_tags(request)
+        tags['duration'] = duration
+        try:
+            store.save(route_name, kind, write, tags)
+        except Exception, e:
+            # The profiling should never break a request
+            log.exception(e)
+
+    def profiling_tween(request):
+        route_name = get_route_name(request, registry)
+        if route_name not in PROFILED_ROUTES:
+            return handler(request)
+        request.xml_profile_tags = {}
+        start = time.time()
+        if percent and random.random() * 100 < percent:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                response = handler(request)
+            finally:
+                profiler.disable()
+            save(request, route_name, PSTATS, profiler.dump_stats,
+                 (time.time() - start) * 1000)
+            return response
+
+        if not threshold:
+            return handler(request)
+
+        sampler.start()
+        try:
+            response = handler(request)
+        finally:
+            stacks = sampler.stop()
+        duration = (time.time() - start) * 1000
+        if duration >= threshold and stacks:
+            def write(filename):
+                f = open(filename, 'w')
+                try:
+                    f.write(get_folded(stacks))
+                finally:
+                    f.close()
+            save(request, route_name, FOLDED, write, duration)
+        return response
+
+    return profiling_tween
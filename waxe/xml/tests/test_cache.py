@@ -0,0 +1,494 @@
+import os
+import tempfile
+import unittest
+from mock import patch
+from lxml import etree
+import xmltool
+from xmltool import render, dtd
+
+from waxe.xml.cache import (
+    dtd_cache,
+    install,
+    uninstall,
+    LRUCache,
+    DTDCache,
+    FormCache,
+    DocumentCache,
+    ElementTemplateCache,
+    RendererCache,
+    get_file_stamp,
+    get_str_id_shape,
+    get_str_id_prefixes,
+    resolve_dtd_url,
+)
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ELEMENT test (question)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+'''
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # 'a' is now the most recently used
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertTrue('b' not in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_get_size(self):
+        cache = LRUCache(10, get_size=len)
+        cache.set('a', 'x' * 6)
+        cache.set('b', 'x' * 4)
+        self.assertEqual(cache.size, 10)
+        cache.set('c', 'x' * 2)
+        self.assertEqual(cache.keys(), ['b', 'c'])
+        self.assertEqual(cache.size, 6)
+        # Too big values are not cached
+        cache.set('d', 'x' * 11)
+        self.assertTrue('d' not in cache)
+        self.assertEqual(cache.size, 6)
+
+    def test_invalidate(self):
+        cache = LRUCache(10, get_size=len)
+        cache.set('a', 'xx')
+        cache.set('b', 'xxx')
+        self.assertEqual(cache.invalidate('a'), 'xx')
+        self.assertEqual(cache.invalidate('a'), None)
+        self.assertEqual(cache.size, 3)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_stats(self):
+        cache = LRUCache(1)
+        cache.set('a', 1)
+        cache.set('b', 1)
+        cache.get('a')
+        cache.get('b')
+        expected = {
+            'entries': 1,
+            'size': 1,
+            'max_size': 1,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 1,
+        }
+        self.assertEqual(cache.stats(), expected)
+
+
+class TestDTDCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dtd_url = tempfile.mkstemp(suffix='.dtd')
+        os.write(fd, DTD_CONTENT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+
+    def test_get(self):
+        cache = DTDCache()
+        entry = cache.get(self.dtd_url)
+        self.assertEqual(entry.url, self.dtd_url)
+        self.assertEqual(entry.tags, ['Exercise', 'test'])
+        self.assertEqual(entry.text_tags, ['number', 'question'])
+        self.assertTrue(entry.fingerprint)
+        self.assertEqual(sorted(entry.elements.keys()),
+                         ['Exercise', 'number', 'question', 'test'])
+
+        with patch('xmltool.dtd.DTD') as m:
+            self.assertEqual(cache.get(self.dtd_url), entry)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_get_tags(self):
+        cache = DTDCache()
+        self.assertEqual(cache.get_tags(self.dtd_url), ['Exercise', 'test'])
+        self.assertEqual(cache.get_tags(self.dtd_url, text=True),
+                         ['number', 'question'])
+
+    def test_get_file_changed(self):
+        cache = DTDCache()
+        entry = cache.get(self.dtd_url)
+        open(self.dtd_url, 'w').write(
+            DTD_CONTENT + '<!ELEMENT comment (#PCDATA)>\n')
+        new_entry = cache.get(self.dtd_url)
+        self.assertTrue(new_entry is not entry)
+        self.assertNotEqual(new_entry.fingerprint, entry.fingerprint)
+        self.assertEqual(new_entry.text_tags,
+                         ['comment', 'number', 'question'])
+
+    def test_invalidate(self):
+        cache = DTDCache()
+        entry = cache.get(self.dtd_url)
+        cache.invalidate(self.dtd_url)
+        self.assertEqual(len(cache.entries), 0)
+        self.assertTrue(cache.get(self.dtd_url) is not entry)
+        cache.invalidate()
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_prefetch(self):
+        cache = DTDCache()
+        self.assertEqual(cache.prefetch([]), [])
+        errors = cache.prefetch([self.dtd_url, '/unexisting.dtd'], workers=2)
+        self.assertEqual(len(errors), 1)
+        url, e = errors[0]
+        self.assertEqual(url, '/unexisting.dtd')
+        self.assertTrue(isinstance(e, OSError))
+        self.assertEqual(len(cache.entries), 1)
+        with patch('xmltool.dtd.DTD') as m:
+            cache.get(self.dtd_url)
+            self.assertEqual(m.call_count, 0)
+
+    def test_install(self):
+        # xmltool uses the dtds prefetched in dtd_cache
+        dtd_cache.invalidate()
+        self.assertEqual(dtd_cache.prefetch([self.dtd_url]), [])
+        install()
+        try:
+            with patch('xmltool.dtd_parser.dtd_to_dict_v2') as m:
+                html = xmltool.new(self.dtd_url, 'Exercise')
+                dic = dtd.DTD(self.dtd_url).parse()
+            self.assertEqual(m.call_count, 0)
+            self.assertTrue('name="Exercise:number:_value"' in html)
+            self.assertTrue(dic is dtd_cache.parse(self.dtd_url))
+        finally:
+            uninstall()
+            dtd_cache.invalidate()
+        self.assertTrue(dtd.DTD(self.dtd_url).parse() is not dic)
+
+    def test_load(self):
+        cache = DTDCache()
+        path = os.path.dirname(self.dtd_url)
+        filename = os.path.join(path, 'waxe-test-load.xml')
+        open(filename, 'w').write(
+            '<!DOCTYPE Exercise SYSTEM "%s">'
+            '<Exercise><number>1</number></Exercise>' %
+            os.path.basename(self.dtd_url))
+        try:
+            obj = cache.load(filename)
+            self.assertEqual(obj.tagname, 'Exercise')
+            self.assertEqual(obj['number'].text, '1')
+            self.assertEqual(obj.dtd_url, os.path.basename(self.dtd_url))
+            with patch.object(cache, '_load') as m:
+                cache.load(filename)
+                self.assertEqual(m.call_count, 0)
+
+            open(filename, 'w').write(
+                '<!DOCTYPE Exercise SYSTEM "%s">'
+                '<Exercise><test/></Exercise>' %
+                os.path.basename(self.dtd_url))
+            try:
+                cache.load(filename)
+                assert(False)
+            except etree.DocumentInvalid:
+                pass
+        finally:
+            os.remove(filename)
+
+    def test_validate_string(self):
+        cache = DTDCache()
+        path = os.path.dirname(self.dtd_url)
+        xml_str = ('<!DOCTYPE Exercise SYSTEM "%s">'
+                   '<Exercise><number>1</number></Exercise>' %
+                   os.path.basename(self.dtd_url))
+        with patch('xmltool.elements.Element.load_from_xml') as m:
+            tree = cache.validate_string(xml_str, path)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(tree.getroot().tag, 'Exercise')
+        tree = cache.validate_string(unicode(xml_str), path)
+        self.assertEqual(tree.getroot().tag, 'Exercise')
+
+        try:
+            cache.validate_string(xml_str.replace('<number>1</number>', ''),
+                                  path)
+            assert(False)
+        except etree.DocumentInvalid:
+            pass
+        try:
+            cache.validate_string(xml_str.replace('</Exercise>', ''), path)
+            assert(False)
+        except etree.XMLSyntaxError:
+            pass
+        try:
+            cache.validate_string('<Exercise/>', path)
+            assert(False)
+        except ValueError, e:
+            self.assertEqual(str(e), 'No dtd defined')
+
+    def test_configure(self):
+        cache = DTDCache()
+        cache.configure(max_size='3')
+        self.assertEqual(cache.entries.max_size, 3)
+        cache.configure()
+        self.assertEqual(cache.entries.max_size, 3)
+
+
+class TestFormCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dtd_url = tempfile.mkstemp(suffix='.dtd')
+        os.write(fd, DTD_CONTENT)
+        os.close(fd)
+        fd, self.filename = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, '<Exercise/>')
+        os.close(fd)
+        self.payload = {'content': '<form></form>', 'jstree_data': {}}
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+        os.remove(self.filename)
+
+    def test_resolve_dtd_url(self):
+        self.assertEqual(resolve_dtd_url('my.dtd', '/path'), '/path/my.dtd')
+        self.assertEqual(resolve_dtd_url('/root/my.dtd', '/path'),
+                         '/root/my.dtd')
+        self.assertEqual(resolve_dtd_url('http://dtd/my.dtd', '/path'),
+                         'http://dtd/my.dtd')
+
+    def test_enabled(self):
+        cache = FormCache(dtd_cache=DTDCache())
+        self.assertEqual(cache.enabled, False)
+        cache.configure(max_size='1000')
+        self.assertEqual(cache.enabled, True)
+
+    def test_get_set(self):
+        cache = FormCache(1000, dtd_cache=DTDCache())
+        stamp = get_file_stamp(self.filename)
+        self.assertEqual(cache.get(self.filename, stamp, 'key'), None)
+        cache.set(self.filename, stamp, 'key', self.dtd_url, self.payload)
+        self.assertEqual(cache.get(self.filename, stamp, 'key'),
+                         self.payload)
+        self.assertEqual(cache.get(self.filename, stamp, 'other'), None)
+        self.assertEqual(cache.entries.size, len('<form></form>{}'))
+
+        open(self.filename, 'w').write('<Exercise></Exercise>')
+        stamp = get_file_stamp(self.filename)
+        self.assertEqual(cache.get(self.filename, stamp, 'key'), None)
+
+    def test_set_outline(self):
+        cache = FormCache(1000, dtd_cache=DTDCache())
+        stamp = get_file_stamp(self.filename)
+        payload = {'content': '<form></form>', 'outline': {'tags': []}}
+        cache.set(self.filename, stamp, 'key', self.dtd_url, payload)
+        self.assertEqual(cache.get(self.filename, stamp, 'key'), payload)
+        self.assertEqual(cache.entries.size,
+                         len('<form></form>{"tags": []}'))
+
+    def test_get_dtd_changed(self):
+        cache = FormCache(1000, dtd_cache=DTDCache())
+        stamp = get_file_stamp(self.filename)
+        cache.set(self.filename, stamp, 'key', self.dtd_url, self.payload)
+        open(self.dtd_url, 'w').write(
+            DTD_CONTENT + '<!ELEMENT comment (#PCDATA)>\n')
+        self.assertEqual(cache.get(self.filename, stamp, 'key'), None)
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_invalidate(self):
+        cache = FormCache(1000, dtd_cache=DTDCache())
+        stamp = get_file_stamp(self.filename)
+        cache.set(self.filename, stamp, 'key1', self.dtd_url, self.payload)
+        cache.set(self.filename, stamp, 'key2', self.dtd_url, self.payload)
+        cache.set('/other.xml', stamp, 'key1', self.dtd_url, self.payload)
+        cache.invalidate(self.filename)
+        self.assertEqual(cache.entries.keys(), [('/other.xml', stamp, 'key1')])
+        cache.invalidate()
+        self.assertEqual(len(cache.entries), 0)
+
+
+class TestDocumentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        open(os.path.join(self.path, 'exercise.dtd'), 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(
+            '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+            '<Exercise><number>1</number></Exercise>')
+
+    def tearDown(self):
+        os.remove(os.path.join(self.path, 'exercise.dtd'))
+        os.remove(self.filename)
+        os.rmdir(self.path)
+
+    def test_load(self):
+        cache = DocumentCache()
+        doc = cache.load(self.filename)
+        self.assertEqual(doc.obj.tagname, 'Exercise')
+        self.assertEqual(doc.obj['number'].text, '1')
+        self.assertTrue(cache.load(self.filename) is doc)
+
+        open(self.filename, 'w').write(
+            '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+            '<Exercise><number>12</number></Exercise>')
+        new_doc = cache.load(self.filename)
+        self.assertTrue(new_doc is not doc)
+        self.assertEqual(new_doc.obj['number'].text, '12')
+
+        cache.invalidate(self.filename)
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_disabled(self):
+        cache = DocumentCache(0)
+        doc = cache.load(self.filename)
+        self.assertTrue(cache.load(self.filename) is not doc)
+
+
+ELEMENT_DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*, comments?, (a|b)*)>
+<!ELEMENT a (choice*)>
+<!ELEMENT b (#PCDATA)>
+<!ELEMENT test (question, answer?, choice+)>
+<!ATTLIST test idx CDATA #IMPLIED>
+<!ELEMENT comments (comment*)>
+<!ELEMENT comment (#PCDATA)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT answer (#PCDATA)>
+<!ELEMENT choice (#PCDATA)>
+'''
+
+
+class TestElementTemplateCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dtd_url = tempfile.mkstemp(suffix='.dtd')
+        os.write(fd, ELEMENT_DTD_CONTENT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+
+    def test_get_str_id_shape(self):
+        self.assertEqual(get_str_id_shape('Exercise:list__test:1:test'),
+                         ('Exercise', 'list__test', None, 'test'))
+
+    def test_get_data(self):
+        cache = ElementTemplateCache(dtd_cache=DTDCache())
+        str_ids = [
+            'Exercise:list__test:0:test',
+            'Exercise:list__test:7:test',
+            'Exercise:list__test:3:test:list__choice:2:choice',
+            'Exercise:list__test:1:test:list__choice:0:choice',
+            'Exercise:list__test:2:test:question',
+            'Exercise:list__test:3:test:question',
+            'Exercise:comments',
+            'Exercise:comments',
+            'Exercise:comments:list__comment:4:comment',
+            'Exercise:comments:list__comment:0:comment',
+        ]
+        for str_id in str_ids:
+            expected = xmltool.factory.get_data_from_str_id_for_html_display(
+                str_id,
+                dtd_url=self.dtd_url,
+                html_renderer=render.ContenteditableRender())
+            res = cache.get_data(str_id, self.dtd_url,
+                                 render.ContenteditableRender())
+            self.assertEqual(res, expected)
+        self.assertEqual(len(cache.entries), 5)
+        self.assertEqual(cache.stats()['hits'], 5)
+
+    def test_get_str_id_prefixes(self):
+        self.assertEqual(
+            get_str_id_prefixes('Exercise:list__test:1:test:list__c:12:c'),
+            ['Exercise:list__test:1:test:list__c:12:',
+             'Exercise:list__test:1:'])
+        self.assertEqual(get_str_id_prefixes('Exercise:comments'), [])
+
+    def test_get_data_choice(self):
+        # The ids of the options of the choice have the index of the element
+        cache = ElementTemplateCache(dtd_cache=DTDCache())
+        str_ids = [
+            'Exercise:list__a_b:1:a',
+            'Exercise:list__a_b:11:a',
+            'Exercise:list__a_b:11:b',
+            'Exercise:list__a_b:2:b',
+            'Exercise:list__a_b:3:a:list__choice:1:choice',
+            'Exercise:list__a_b:13:a:list__choice:11:choice',
+        ]
+        for str_id in str_ids:
+            expected = xmltool.factory.get_data_from_str_id_for_html_display(
+                str_id,
+                dtd_url=self.dtd_url,
+                html_renderer=render.ContenteditableRender())
+            res = cache.get_data(str_id, self.dtd_url,
+                                 render.ContenteditableRender())
+            self.assertEqual(res, expected)
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertTrue('value="Exercise:list__a_b:11:b"' in
+                        cache.get_data('Exercise:list__a_b:11:a',
+                                       self.dtd_url,
+                                       render.ContenteditableRender())['html'])
+
+    def test_get_data_renderer(self):
+        cache = ElementTemplateCache(dtd_cache=DTDCache())
+        str_id = 'Exercise:list__test:0:test'
+        res = cache.get_data(str_id, self.dtd_url,
+                             render.ContenteditableRender())
+        self.assertTrue('contenteditable' in res['html'])
+        res = cache.get_data(str_id, self.dtd_url, render.Render(),
+                             renderer_key='default')
+        self.assertTrue('contenteditable' not in res['html'])
+        self.assertEqual(len(cache.entries), 2)
+
+    def test_get_data_dtd_changed(self):
+        cache = ElementTemplateCache(dtd_cache=DTDCache())
+        res = cache.get_data('Exercise:comments', self.dtd_url,
+                             render.ContenteditableRender())
+        self.assertTrue('list__comment' in res['html'])
+        open(self.dtd_url, 'w').write(
+            ELEMENT_DTD_CONTENT.replace('(comment*)', '(number)'))
+        res = cache.get_data('Exercise:comments', self.dtd_url,
+                             render.ContenteditableRender())
+        self.assertTrue('list__comment' not in res['html'])
+
+
+class TestRendererCache(unittest.TestCase):
+
+    def test_get(self):
+        calls = []
+
+        def renderer_func(login):
+            calls.append(login)
+            if login == 'Alice':
+                return None
+            return render.CKeditorRender()
+
+        cache = RendererCache(2)
+        renderer = cache.get(renderer_func, 'Bob')
+        self.assertTrue(isinstance(renderer, render.CKeditorRender))
+        self.assertTrue(cache.get(renderer_func, 'Bob') is renderer)
+        self.assertEqual(cache.get(renderer_func, 'Alice'), None)
+        self.assertEqual(cache.get(renderer_func, 'Alice'), None)
+        self.assertEqual(calls, ['Bob', 'Alice'])
+
+        cache.get(renderer_func, 'Fred')
+        self.assertEqual(len(cache.entries), 2)
+        cache.invalidate()
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_disabled(self):
+        cache = RendererCache(0)
+        self.assertTrue(cache.get(lambda login: render.Render(), 'Bob') is
+                        not cache.get(lambda login: render.Render(), 'Bob'))
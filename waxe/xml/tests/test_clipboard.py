@@ -0,0 +1,100 @@
+import unittest
+from mock import patch
+
+from waxe.xml.clipboard import (
+    MemoryClipboardStore,
+    SharedClipboardStore,
+    ClipboardTooBigError,
+    get_data_size,
+    memory_store_factory,
+)
+
+
+class FakeClient(object):
+    """Stand-in for a memcache client
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key, (None, None))[0]
+
+    def set(self, key, value, time=0):
+        self.data[key] = (value, time)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class TestClipboard(unittest.TestCase):
+
+    def test_get_data_size(self):
+        self.assertEqual(get_data_size({}), 0)
+        self.assertEqual(get_data_size({'a': {'_value': u'abc'}}), 10)
+        self.assertEqual(get_data_size({'a': [None, {'b': {}}]}), 6)
+
+    def test_memory_store(self):
+        store = MemoryClipboardStore(max_users=2, max_size=20, ttl=10)
+        self.assertEqual(store.get('Bob'), None)
+        data = {'number': {'_value': 'Hello'}}
+        store.set('Bob', 'Exercise:number', data)
+        entry = store.get('Bob')
+        self.assertEqual(entry.elt_id, 'Exercise:number')
+        # We keep the parsed data
+        self.assertTrue(entry.data is data)
+        self.assertEqual(entry.size, 17)
+
+        try:
+            store.set('Bob', 'Exercise:number',
+                      {'number': {'_value': 'Hello world'}})
+            assert(False)
+        except ClipboardTooBigError, e:
+            self.assertEqual(str(e), 'The element is too big to be copied')
+        # The previous clipboard is kept
+        self.assertTrue(store.get('Bob').data is data)
+
+        store.set('Alice', 'Exercise', {})
+        store.set('Fred', 'Exercise', {})
+        self.assertEqual(store.get('Bob'), None)
+        self.assertEqual(store.stats()['entries'], 2)
+
+        store.delete('Fred')
+        self.assertEqual(store.get('Fred'), None)
+
+    def test_memory_store_ttl(self):
+        store = MemoryClipboardStore(ttl=10)
+        with patch('time.time', return_value=100):
+            store.set('Bob', 'Exercise', {})
+        with patch('time.time', return_value=110):
+            self.assertTrue(store.get('Bob'))
+        with patch('time.time', return_value=111):
+            self.assertEqual(store.get('Bob'), None)
+        self.assertEqual(len(store.entries), 0)
+
+    def test_memory_store_factory(self):
+        store = memory_store_factory({'waxe.xml.clipboard.max_users': '3'})
+        self.assertEqual(store.entries.max_size, 3)
+
+    def test_shared_store(self):
+        client = FakeClient()
+        store = SharedClipboardStore(client, max_size=100, ttl=10)
+        self.assertEqual(store.get(u'Bob'), None)
+        data = {'number': {'_value': 'Hello'}}
+        store.set(u'Bob', 'Exercise:number', data)
+        self.assertEqual(client.data.keys(), ['waxe.xml.clipboard.Bob'])
+        self.assertEqual(client.data['waxe.xml.clipboard.Bob'][1], 10)
+
+        # Another process gets the same clipboard
+        entry = SharedClipboardStore(client).get(u'Bob')
+        self.assertEqual(entry.elt_id, 'Exercise:number')
+        self.assertEqual(entry.data, data)
+
+        try:
+            store.set(u'Bob', 'Exercise', {'text': {'_value': 'a' * 100}})
+            assert(False)
+        except ClipboardTooBigError:
+            pass
+
+        store.delete(u'Bob')
+        self.assertEqual(store.get(u'Bob'), None)
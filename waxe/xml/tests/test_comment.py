@@ -0,0 +1,67 @@
+import json
+import unittest
+from mock import patch
+from pyramid import testing
+from pyramid.renderers import render
+
+from waxe.xml import comment
+
+
+class C(object):
+    pass
+
+
+class TestCommentModal(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'mako.directories': 'waxe.xml:templates',
+        })
+        self.config.include('pyramid_mako')
+        self.registry = self.config.registry
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_render(self):
+        modal = comment.CommentModal(self.registry)
+        self.assertEqual(len(modal.parts), 2)
+        for value in [u'', u'My comment', u'<b>"&\'</b>', u'\xe9t\xe9']:
+            expected = render('comment_modal.mak', {'comment': value})
+            self.assertEqual(modal.render(value), expected)
+            self.assertEqual(json.loads(modal.get_body(value)),
+                             {'content': expected})
+        self.assertTrue('&lt;b&gt;' in modal.render(u'<b>'))
+
+        # The template is not rendered anymore
+        with patch.object(modal.template, 'render_unicode') as m:
+            modal.render(u'comment')
+            self.assertTrue(modal.get_body(u'') is modal.empty_body)
+        self.assertEqual(m.call_count, 0)
+
+    def test_render_no_marker(self):
+        # The comment is not rendered as is, we can't replace the marker
+        with patch('waxe.xml.comment.MARKER', u'<marker>'):
+            modal = comment.CommentModal(self.registry)
+        self.assertEqual(modal.parts, None)
+        self.assertEqual(modal.render(u'<b>'),
+                         render('comment_modal.mak', {'comment': u'<b>'}))
+
+    def test_get_comment_modal(self):
+        modal = comment.get_comment_modal(self.registry)
+        self.assertTrue(self.registry.xml_comment_modal is modal)
+        self.assertTrue(comment.get_comment_modal(self.registry) is modal)
+
+        # The template has been modified
+        with patch('waxe.xml.comment.get_file_stamp', return_value=(1, 1)):
+            new_modal = comment.get_comment_modal(self.registry)
+        self.assertTrue(new_modal is not modal)
+
+    def test_warm_comment_modal(self):
+        event = C()
+        event.app = C()
+        event.app.registry = self.registry
+        comment.warm_comment_modal(event)
+        self.assertTrue(
+            isinstance(self.registry.xml_comment_modal,
+                       comment.CommentModal))
@@ -0,0 +1,122 @@
+import gzip
+import unittest
+from StringIO import StringIO
+from mock import patch
+
+import waxe.xml
+from waxe.xml import compression
+
+
+class C(object):
+    pass
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, status_int=200, headers=None, app_iter=None):
+        self.status_int = status_int
+        self.headers = headers or {}
+        self.body = body
+        self.app_iter = app_iter if app_iter is not None else [body]
+
+
+def get_request(accept_encoding=None, route_name='edit_json'):
+    request = C()
+    request.headers = {}
+    if accept_encoding:
+        request.headers['Accept-Encoding'] = accept_encoding
+    request.matched_route = C()
+    request.matched_route.name = route_name
+    return request
+
+
+def gunzip(body):
+    return gzip.GzipFile(fileobj=StringIO(body)).read()
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_compressed_routes(self):
+        self.assertTrue(
+            compression.COMPRESSED_ROUTES <= waxe.xml.EDITOR_ROUTE_NAMES)
+
+    def test_choose_encoding(self):
+        encodings = ['br', 'gzip']
+        self.assertEqual(compression.choose_encoding(None, encodings), None)
+        self.assertEqual(compression.choose_encoding('gzip', encodings),
+                         'gzip')
+        self.assertEqual(
+            compression.choose_encoding('gzip, deflate, br', encodings),
+            'br')
+        self.assertEqual(
+            compression.choose_encoding('gzip;q=1.0, br;q=0.5', encodings),
+            'gzip')
+        self.assertEqual(
+            compression.choose_encoding('gzip;q=0, identity', encodings),
+            None)
+        self.assertEqual(compression.choose_encoding('*', encodings), 'br')
+        self.assertEqual(compression.choose_encoding('br', ['gzip']), None)
+
+    def test_compress(self):
+        body = 'Hello world' * 100
+        self.assertEqual(gunzip(compression.compress(body, 'gzip')), body)
+        # The result is stable since we don't put the mtime
+        self.assertEqual(compression.compress(body, 'gzip'),
+                         compression.compress(body, 'gzip'))
+
+    def test_compress_response(self):
+        body = '{"content": "%s"}' % ('<div></div>' * 200)
+        with patch('waxe.xml.compression.brotli', None):
+            response = FakeResponse(body, headers={'ETag': '"abc"'})
+            res = compression.compress_response(get_request('gzip'),
+                                                response)
+            self.assertEqual(res, 'gzip')
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.headers['ETag'], '"abc-gzip"')
+            self.assertTrue(len(response.body) < len(body))
+            self.assertEqual(gunzip(response.body), body)
+
+            # Not accepted by the client
+            response = FakeResponse(body)
+            res = compression.compress_response(get_request(), response)
+            self.assertEqual(res, None)
+            self.assertEqual(response.body, body)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+            # Too small
+            response = FakeResponse(body)
+            res = compression.compress_response(get_request('gzip'),
+                                                response,
+                                                threshold=len(body) + 1)
+            self.assertEqual(res, None)
+
+            # Streamed
+            response = FakeResponse(body, app_iter=iter([body]))
+            res = compression.compress_response(get_request('gzip'),
+                                                response)
+            self.assertEqual(res, None)
+
+            # Error
+            response = FakeResponse(body, status_int=500)
+            res = compression.compress_response(get_request('gzip'),
+                                                response)
+            self.assertEqual(res, None)
+
+    def test_compression_tween_factory(self):
+        body = 'x' * 2000
+        registry = C()
+        registry.settings = {'waxe.xml.compression.threshold': '10'}
+        handler = lambda request: FakeResponse(body)
+        tween = compression.compression_tween_factory(handler, registry)
+        with patch('waxe.xml.compression.brotli', None):
+            response = tween(get_request('gzip'))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+            response = tween(get_request('gzip', route_name='other'))
+            self.assertEqual(response.headers, {})
+
+        registry.settings = {'waxe.xml.compression': 'false'}
+        self.assertTrue(
+            compression.compression_tween_factory(handler, registry) is
+            handler)
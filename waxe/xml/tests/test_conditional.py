@@ -0,0 +1,55 @@
+import unittest
+
+from waxe.xml import conditional
+
+
+class C(object):
+    pass
+
+
+class TestConditional(unittest.TestCase):
+
+    def test_make_etag(self):
+        etag = conditional.make_etag('edit', (1, 2), 'fingerprint')
+        self.assertEqual(len(etag), 32)
+        self.assertEqual(etag,
+                         conditional.make_etag('edit', (1, 2), 'fingerprint'))
+        self.assertNotEqual(etag,
+                            conditional.make_etag('edit', (1, 3),
+                                                  'fingerprint'))
+
+    def test_parse_if_none_match(self):
+        self.assertEqual(conditional.parse_if_none_match(None), [])
+        self.assertEqual(conditional.parse_if_none_match('"abc"'), ['abc'])
+        self.assertEqual(
+            conditional.parse_if_none_match('"abc", W/"def" ,*'),
+            ['abc', 'def', '*'])
+        self.assertEqual(
+            conditional.parse_if_none_match('"abc-gzip", "def-br"'),
+            ['abc', 'def'])
+
+    def test_is_not_modified(self):
+        request = C()
+        request.headers = {}
+        self.assertEqual(conditional.is_not_modified(request, 'abc'), False)
+        request.headers = {'If-None-Match': '"def", "abc"'}
+        self.assertEqual(conditional.is_not_modified(request, 'abc'), True)
+        request.headers = {'If-None-Match': '*'}
+        self.assertEqual(conditional.is_not_modified(request, 'abc'), True)
+
+    def test_get_cache_control(self):
+        self.assertEqual(conditional.get_cache_control(),
+                         'private, no-cache')
+        self.assertEqual(conditional.get_cache_control(60),
+                         'private, max-age=60')
+        self.assertEqual(conditional.get_cache_control(60, public=True),
+                         'public, max-age=60')
+
+    def test_set_cache_headers(self):
+        response = C()
+        response.headers = {}
+        conditional.set_cache_headers(response, 'abc', 'private, no-cache')
+        self.assertEqual(response.headers, {
+            'ETag': '"abc"',
+            'Cache-Control': 'private, no-cache',
+        })
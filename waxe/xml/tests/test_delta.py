@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+from lxml import etree
+import xmltool
+
+from waxe.xml import delta
+from waxe.xml.cache import DTDCache
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ATTLIST Exercise idatt CDATA #IMPLIED>
+<!ELEMENT test (question)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ATTLIST question type (open|closed) #IMPLIED>
+'''
+
+XML_CONTENT = '''<?xml version="1.0"?>
+<!DOCTYPE Exercise SYSTEM "exercise.dtd">
+<Exercise>
+  <number>1</number>
+  <test><question>q1</question></test>
+  <test><question>q2</question></test>
+</Exercise>
+'''
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dtd_url = os.path.join(self.path, 'exercise.dtd')
+        open(self.dtd_url, 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(XML_CONTENT)
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+        os.remove(self.filename)
+        os.rmdir(self.path)
+
+    def test_parse_changes(self):
+        params = {
+            '_xml_dtd_url': 'exercise.dtd',
+            'Exercise:number:_value': 'Hello',
+            'Exercise:number:_comment': 'Comment',
+            'Exercise:_attrs:idatt': 'id',
+            'Exercise:list__test:1:test:question:_value': '\xc3\xa9',
+        }
+        expected = {
+            'Exercise:number': {'_value': 'Hello', '_comment': 'Comment'},
+            'Exercise': {'_attrs': {'idatt': 'id'}},
+            'Exercise:list__test:1:test:question': {'_value': u'\xe9'},
+        }
+        self.assertEqual(delta.parse_changes(params), expected)
+
+        try:
+            delta.parse_changes({'Exercise:number': 'Hello'})
+            assert(False)
+        except delta.DeltaError, e:
+            self.assertEqual(str(e), 'Invalid parameter: Exercise:number')
+
+    def test_apply_changes(self):
+        obj = xmltool.load(self.filename)
+        changes = {
+            'Exercise:number': {'_value': 'Hello', '_comment': 'Comment'},
+            'Exercise': {'_attrs': {'idatt': 'id'}},
+            'Exercise:list__test:1:test:question': {'_value': 'q3'},
+        }
+        modified, undo = delta.apply_changes(obj, changes)
+        self.assertEqual(len(modified), 3)
+        self.assertEqual(obj['number'].text, 'Hello')
+        self.assertEqual(obj['number'].comment, 'Comment')
+        self.assertEqual(obj.attributes, {'idatt': 'id'})
+        self.assertEqual(obj['test'][1]['question'].text, 'q3')
+
+        delta.revert(undo)
+        self.assertEqual(obj['number'].text, '1')
+        self.assertEqual(obj['number'].comment, None)
+        self.assertEqual(obj.attributes, None)
+        self.assertEqual(obj['test'][1]['question'].text, 'q2')
+
+    def test_apply_changes_error(self):
+        obj = xmltool.load(self.filename)
+        for changes, msg in [
+            ({'Exercise:unexisting': {'_value': 'Hello'}},
+             'Element Exercise:unexisting not found'),
+            ({'Exercise': {'_value': 'Hello'}},
+             "Can't set value to Exercise"),
+            ({'Exercise': {'_attrs': {'unexisting': 'id'}}},
+             'Invalid attribute unexisting for Exercise'),
+        ]:
+            changes['Exercise:number'] = {'_value': 'Hello'}
+            try:
+                delta.apply_changes(obj, changes)
+                assert(False)
+            except delta.DeltaError, e:
+                self.assertEqual(str(e), msg)
+            # The object is reverted
+            self.assertEqual(obj['number'].text, '1')
+
+    def test_validate_elements(self):
+        obj = xmltool.load(self.filename)
+        dtd_entry = DTDCache().get(self.dtd_url)
+        question = obj['test'][0]['question']
+        delta.validate_elements([obj['number'], question], dtd_entry)
+
+        question.add_attribute('type', 'invalid')
+        try:
+            delta.validate_elements([question], dtd_entry)
+            assert(False)
+        except etree.DocumentInvalid:
+            pass
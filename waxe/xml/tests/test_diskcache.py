@@ -0,0 +1,280 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+import multiprocessing
+from mock import patch
+import xmltool
+from xmltool import dtd_parser
+
+from waxe.xml import diskcache, cache, workers
+from waxe.xml.cache import DTDCache
+from waxe.xml.fetcher import DTDFetcher, FetchedDTD
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*)>
+<!ELEMENT test (question, answer)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT answer (#PCDATA)>
+'''
+
+XML_CONTENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE Exercise SYSTEM "exercise.dtd">
+<Exercise>
+  <number>1</number>
+</Exercise>
+'''
+
+
+def load_dtd(args):
+    """Load the dtd in another process
+    """
+    directory, url = args
+    cache = DTDCache()
+    cache.disk_cache = diskcache.DTDDiskCache(directory)
+    return cache.get(url).tags
+
+
+class TestDTDDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.disk_cache = diskcache.DTDDiskCache(
+            os.path.join(self.directory, 'cache'))
+        self.url = 'http://dtd.example.com/exercise.dtd'
+        self.fingerprint = hashlib.md5(DTD_CONTENT).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_content(self):
+        self.assertEqual(self.disk_cache.get_index(self.url), None)
+        self.assertEqual(
+            self.disk_cache.get_content(self.url, self.fingerprint), None)
+        self.disk_cache.set_content(self.url, self.fingerprint, DTD_CONTENT,
+                                    '"v1"', None, 10)
+        index = self.disk_cache.get_index(self.url)
+        self.assertEqual(index['fingerprint'], self.fingerprint)
+        self.assertEqual(index['etag'], '"v1"')
+        self.assertEqual(index['fetched'], 10)
+        self.assertEqual(
+            self.disk_cache.get_content(self.url, self.fingerprint),
+            DTD_CONTENT)
+        self.assertEqual(self.disk_cache.get_index('http://other'), None)
+        # No temporary file left
+        self.assertEqual(
+            [n for n in os.listdir(self.disk_cache.directory)
+             if n.startswith('.tmp')], [])
+
+    def test_corrupted_files(self):
+        self.disk_cache.set_content(self.url, self.fingerprint, DTD_CONTENT)
+        key = diskcache.get_key(self.url)
+        name = os.path.join(self.disk_cache.directory, key)
+        open(name + '-%s.dtd' % self.fingerprint, 'w').write('truncated')
+        self.assertEqual(
+            self.disk_cache.get_content(self.url, self.fingerprint), None)
+        open(name + '.json', 'w').write('{')
+        self.assertEqual(self.disk_cache.get_index(self.url), None)
+        open(name + '-%s.%s' % (self.fingerprint, diskcache.MARSHAL_EXT),
+             'w').write('\x00')
+        self.assertEqual(
+            self.disk_cache.get_dtd_dict(self.url, self.fingerprint), None)
+
+    def test_dtd_dict(self):
+        self.assertEqual(
+            self.disk_cache.get_dtd_dict(self.url, self.fingerprint), None)
+        self.disk_cache.set_dtd_dict(self.url, self.fingerprint,
+                                     {'test': {'elts': 'a', 'attrs': []}})
+        self.assertEqual(
+            self.disk_cache.get_dtd_dict(self.url, self.fingerprint),
+            {'test': {'elts': 'a', 'attrs': []}})
+        self.assertEqual(self.disk_cache.stats(),
+                         {'hits': 1, 'misses': 1, 'writes': 1,
+                          'removed': 0})
+
+    def test_write_error(self):
+        with patch('os.rename', side_effect=OSError('Read-only')):
+            self.assertRaises(OSError, self.disk_cache.set_dtd_dict,
+                              self.url, self.fingerprint, {})
+        self.assertEqual(os.listdir(self.disk_cache.directory), [])
+
+    def test_set_content_removes_previous(self):
+        self.disk_cache.set_content(self.url, self.fingerprint, DTD_CONTENT)
+        self.disk_cache.set_dtd_dict(self.url, self.fingerprint, {})
+        content = DTD_CONTENT + '<!ELEMENT other (#PCDATA)>'
+        fingerprint = hashlib.md5(content).hexdigest()
+        self.disk_cache.set_content(self.url, fingerprint, content)
+        key = diskcache.get_key(self.url)
+        self.assertEqual(sorted(os.listdir(self.disk_cache.directory)),
+                         ['%s-%s.dtd' % (key, fingerprint), '%s.json' % key])
+        self.assertEqual(self.disk_cache.stats()['removed'], 2)
+
+    def test_prune(self):
+        disk_cache = diskcache.DTDDiskCache(self.disk_cache.directory,
+                                            max_age=3600)
+        disk_cache.set_content(self.url, self.fingerprint, DTD_CONTENT)
+        with disk_cache.lock(self.url):
+            pass
+        key = diskcache.get_key(self.url)
+        old = time.time() - 7200
+        for name in ['%s.json' % key, '%s.lock' % key]:
+            os.utime(os.path.join(disk_cache.directory, name), (old, old))
+        disk_cache.prune()
+        # The lock is kept
+        self.assertEqual(sorted(os.listdir(disk_cache.directory)),
+                         ['%s-%s.dtd' % (key, self.fingerprint),
+                          '%s.lock' % key])
+        self.assertEqual(disk_cache.get_index(self.url), None)
+
+        # The writes prune at most every PRUNE_INTERVAL seconds
+        name = os.path.join(disk_cache.directory,
+                            '%s-%s.dtd' % (key, self.fingerprint))
+        os.utime(name, (old, old))
+        disk_cache.set_dtd_dict(self.url, self.fingerprint, {})
+        self.assertTrue(os.path.exists(name))
+        disk_cache._pruned = 0
+        disk_cache.set_dtd_dict(self.url, self.fingerprint, {})
+        self.assertFalse(os.path.exists(name))
+
+        # Disabled
+        disk_cache = diskcache.DTDDiskCache(disk_cache.directory, max_age=0)
+        disk_cache.set_content(self.url, self.fingerprint, DTD_CONTENT)
+        os.utime(name, (old, old))
+        disk_cache.prune()
+        self.assertTrue(os.path.exists(name))
+
+    def test_lock(self):
+        with self.disk_cache.lock(self.url):
+            self.assertTrue(os.path.exists(os.path.join(
+                self.disk_cache.directory,
+                '%s.lock' % diskcache.get_key(self.url))))
+
+
+class TestDTDCacheWithDisk(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dtd_url = os.path.join(self.directory, 'exercise.dtd')
+        open(self.dtd_url, 'w').write(DTD_CONTENT)
+        self.disk_directory = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_cache(self):
+        cache = DTDCache()
+        cache.disk_cache = diskcache.DTDDiskCache(self.disk_directory)
+        return cache
+
+    def test_get(self):
+        cache = self.get_cache()
+        with patch('xmltool.dtd_parser.dtd_to_dict_v2',
+                   side_effect=dtd_parser.dtd_to_dict_v2) as m:
+            entry = cache.get(self.dtd_url)
+        # The dtd is parsed once for the classes and the disk cache
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(entry.tags, ['Exercise', 'test'])
+        self.assertEqual(cache.disk_cache.stats()['writes'], 1)
+
+        # Another process: the dtd is not parsed
+        cache = self.get_cache()
+        with patch('xmltool.dtd.DTD.parse') as m:
+            new_entry = cache.get(self.dtd_url)
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(cache.disk_cache.stats()['hits'], 1)
+        self.assertEqual(new_entry.tags, entry.tags)
+        self.assertEqual(new_entry.text_tags, entry.text_tags)
+        exercise = new_entry.elements['Exercise']
+        self.assertEqual([c.tagname for c in exercise.children_classes],
+                         ['number', 'list__test'])
+
+    def test_get_processes(self):
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(load_dtd, [(self.disk_directory,
+                                           self.dtd_url)] * 8)
+        finally:
+            pool.terminate()
+        self.assertEqual(results, [['Exercise', 'test']] * 8)
+        fingerprint = hashlib.md5(DTD_CONTENT).hexdigest()
+        self.assertTrue(diskcache.DTDDiskCache(
+            self.disk_directory).get_dtd_dict(self.dtd_url, fingerprint))
+
+    def test_invalid_dtd(self):
+        open(self.dtd_url, 'w').write('<!ELEMENT Exercise (number)>')
+        cache = self.get_cache()
+        self.assertRaises(Exception, cache.get, self.dtd_url)
+        self.assertEqual(cache.disk_cache.stats()['writes'], 0)
+
+    def test_xmltool(self):
+        # Parsed by another process
+        self.get_cache().get(self.dtd_url)
+        filename = os.path.join(self.directory, 'exercise.xml')
+        open(filename, 'w').write(XML_CONTENT)
+        old_disk_cache = cache.dtd_cache.disk_cache
+        cache.dtd_cache.disk_cache = diskcache.DTDDiskCache(
+            self.disk_directory)
+        cache.dtd_cache.invalidate()
+        cache.install()
+        try:
+            with patch('xmltool.dtd_parser.dtd_to_dict_v2') as m:
+                # The loading of edit
+                payload, dtd_url = workers.render_file(filename, None, None)
+                self.assertEqual(dtd_url, 'exercise.dtd')
+                # xmltool itself
+                xmltool.update(filename, {
+                    '_xml_encoding': 'UTF-8',
+                    '_xml_dtd_url': 'exercise.dtd',
+                    'Exercise:number:_value': '2',
+                })
+                obj = xmltool.load(filename)
+            self.assertEqual(m.call_count, 0)
+            self.assertEqual(obj['number'].text, '2')
+            self.assertEqual(len(cache.dtd_cache.entries), 1)
+        finally:
+            cache.uninstall()
+            cache.dtd_cache.disk_cache = old_disk_cache
+            cache.dtd_cache.invalidate()
+
+
+class TestDTDFetcherWithDisk(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.url = 'http://dtd.example.com/exercise.dtd'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_fetcher(self):
+        fetcher = DTDFetcher(ttl=60)
+        fetcher.disk_cache = diskcache.DTDDiskCache(self.directory)
+        return fetcher
+
+    def test_get(self):
+        fetcher = self.get_fetcher()
+        with patch.object(fetcher, '_request',
+                          return_value=FetchedDTD(DTD_CONTENT, '"v1"')) as m:
+            self.assertEqual(fetcher.fetch(self.url), DTD_CONTENT)
+        self.assertEqual(m.call_count, 1)
+
+        # Another process uses the fetched copy
+        fetcher = self.get_fetcher()
+        with patch.object(fetcher, '_request') as m:
+            entry = fetcher.get(self.url)
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(entry.content, DTD_CONTENT)
+        self.assertEqual(entry.etag, '"v1"')
+
+        # The copy is too old, it's revalidated
+        fetcher = self.get_fetcher()
+        fetcher.ttl = fetcher.stale_while_revalidate = 0
+        with patch.object(fetcher, '_request',
+                          return_value=FetchedDTD(DTD_CONTENT, '"v1"')) as m:
+            fetcher.get(self.url)
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(m.call_args[0][1].etag, '"v1"')
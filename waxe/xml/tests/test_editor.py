@@ -1,6 +1,9 @@
 import os
+import gzip
+import shutil
 import tempfile
 import json
+from StringIO import StringIO
 from pyramid import testing
 import pyramid.httpexceptions as exc
 from mock import patch
@@ -13,8 +16,27 @@ from waxe.xml.views.editor import (
     EditorView,
     _get_tags,
     is_valid_filecontent,
-    get_xmltool_transform
+    get_text_validation,
+    get_xmltool_transform,
+    prefetch_dtds,
+    invalidate_cached_file,
+    get_clipboard_store,
+    get_journal_store,
 )
+from waxe.xml import writer
+from waxe.xml.clipboard import MemoryClipboardStore
+from waxe.xml.journal import MemoryJournalStore
+from waxe.xml.metrics import HistogramSink
+from waxe.xml.profiling import ProfileStore
+from waxe.xml.workers import worker_pool
+from waxe.xml.diskcache import DTDDiskCache
+from waxe.xml.cache import (
+    dtd_cache,
+    form_cache,
+    document_cache,
+    element_cache,
+)
+from pyramid.exceptions import ConfigurationError
 
 
 def fake_renderer_func(login):
@@ -29,6 +51,14 @@ def fake_get_xmltool_transform():
     return 'Hello world'
 
 
+def fake_clipboard_factory(settings):
+    return 'My store'
+
+
+def fake_journal_factory(settings):
+    return 'My journal store'
+
+
 class TestEditorView(LoggedBobTestCase):
     BOB_RELPATH = 'waxe/xml/tests/files'
 
@@ -57,6 +87,48 @@ class TestEditorView(LoggedBobTestCase):
             res = is_valid_filecontent(view, 'file.xml', 'plop')
             self.assertEqual(res, (view, 'file.xml', 'Hello plop'))
 
+    def test_is_valid_filecontent_tiered(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        request = testing.DummyRequest()
+        request.xmltool_transform = None
+        view = EditorView(request)
+        filecontent = ('<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+                       '<Exercise><number>1</number></Exercise>')
+        with patch('xmltool.load_string') as m:
+            res = is_valid_filecontent(view, 'file.xml', filecontent)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(res, (view, 'file.xml', filecontent))
+
+        try:
+            is_valid_filecontent(view, 'file.xml',
+                                 filecontent.replace('<number>1</number>',
+                                                     ''))
+            assert(False)
+        except exc.HTTPInternalServerError, e:
+            self.assertTrue('Element Exercise content' in str(e))
+
+        # The transform needs the xmltool object
+        request.xmltool_transform = lambda s: s.upper()
+        with patch('xmltool.load_string') as m:
+            res = is_valid_filecontent(view, 'file.xml', filecontent)
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(res, (view, 'file.xml', filecontent.upper()))
+
+        request.xmltool_transform = None
+        request.registry.settings['waxe.xml.text_validation'] = 'full'
+        with patch('xmltool.load_string') as m:
+            is_valid_filecontent(view, 'file.xml', filecontent)
+            self.assertEqual(m.call_count, 1)
+
+    def test_get_text_validation(self):
+        self.assertEqual(get_text_validation({}), 'tiered')
+        self.assertEqual(
+            get_text_validation({'waxe.xml.text_validation': 'full'}),
+            'full')
+        self.assertRaises(ConfigurationError, get_text_validation,
+                          {'waxe.xml.text_validation': 'fast'})
+
     def test_get_xmltool_transform(self):
         request = testing.DummyRequest()
         func = get_xmltool_transform(request)
@@ -79,6 +151,30 @@ class TestEditorView(LoggedBobTestCase):
         settings['waxe.xml.xmltool.renderer_func'] = func_str
         res = EditorView(request)._get_html_renderer()
         self.assertTrue(isinstance(res, xmltool.render.CKeditorRender))
+        # The renderer is kept for the user
+        self.assertTrue(EditorView(request)._get_html_renderer() is res)
+
+        settings['waxe.xml.xmltool.renderer_func'] = 'unexisting.func'
+        try:
+            EditorView(request)._get_html_renderer()
+            assert(False)
+        except ConfigurationError, e:
+            self.assertTrue('unexisting.func' in str(e))
+
+    def test__render_file(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        absfilename = os.path.join(path, 'file1.xml')
+        request = testing.DummyRequest()
+        request.custom_route_path = lambda *args, **kw: '/filepath'
+        settings = request.registry.settings
+        func_str = '%s.fake_renderer_func' % fake_renderer_func.__module__
+        settings['waxe.xml.xmltool.renderer_func'] = func_str
+        with patch('waxe.xml.workers.get_html_renderer') as m:
+            res, dtd_url = EditorView(request)._render_file(absfilename)
+            EditorView(request)._render_file(absfilename)
+        # The renderer of the user is used
+        self.assertEqual(m.call_count, 0)
+        self.assertTrue('contenteditable="true"' not in res['content'])
 
     def test__get_tags(self):
         path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
@@ -91,6 +187,33 @@ class TestEditorView(LoggedBobTestCase):
         expected = ['choice', 'comment', 'number', 'question']
         self.assertEqual(res, expected)
 
+    def test_prefetch_dtds(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        dtd_url = os.path.join(path, 'exercise.dtd')
+        dtd_cache.invalidate()
+        settings = {'dtd_urls': '\n%s\n' % dtd_url}
+        res = prefetch_dtds(settings)
+        self.assertEqual(res, [])
+        self.assertEqual(len(dtd_cache.entries), 1)
+        # The editor uses the prefetched dtd
+        request = testing.DummyRequest()
+        request.custom_route_path = lambda *args, **kw: '/filepath'
+        with patch('xmltool.dtd_parser.dtd_to_dict_v2') as m:
+            EditorView(request)._render_file(os.path.join(path, 'file1.xml'))
+        self.assertEqual(m.call_count, 0)
+
+        settings['dtd_urls'] += '/unexisting.dtd'
+        res = prefetch_dtds(settings)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0][0], '/unexisting.dtd')
+
+        settings['waxe.xml.dtd_prefetch.strict'] = 'true'
+        try:
+            prefetch_dtds(settings)
+            assert(False)
+        except ConfigurationError, e:
+            self.assertTrue('/unexisting.dtd' in str(e))
+
     def test_edit(self):
         class C(object): pass
         path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
@@ -133,7 +256,7 @@ class TestEditorView(LoggedBobTestCase):
         def raise_func(*args, **kw):
             raise Exception('My error')
 
-        with patch('xmltool.load') as m:
+        with patch('waxe.xml.cache.DTDCache.load') as m:
             m.side_effect = raise_func
             request = testing.DummyRequest(
                 params={'path': 'file1.xml'})
@@ -149,7 +272,7 @@ class TestEditorView(LoggedBobTestCase):
         def raise_http_func(*args, **kw):
             raise HTTPError('http://url', 404, 'Not found', [], None)
 
-        with patch('xmltool.load') as m:
+        with patch('waxe.xml.cache.DTDCache.load') as m:
             m.side_effect = raise_http_func
             request = testing.DummyRequest(
                 params={'path': 'file1.xml'})
@@ -165,7 +288,7 @@ class TestEditorView(LoggedBobTestCase):
         def raise_xml_error(*args, **kw):
             raise etree.XMLSyntaxError('Invalid XML', None, None, None)
 
-        with patch('xmltool.load') as m:
+        with patch('waxe.xml.cache.DTDCache.load') as m:
             m.side_effect = raise_xml_error
             request = testing.DummyRequest(
                 params={'path': 'file1.xml'})
@@ -178,6 +301,34 @@ class TestEditorView(LoggedBobTestCase):
             except Exception, e:
                 self.assertEqual(str(e), 'Invalid XML')
 
+    def test_edit_form_cache(self):
+        class C(object): pass
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+
+        def get_request():
+            request = testing.DummyRequest(params={'path': 'file1.xml'})
+            request.custom_route_path = lambda *args, **kw: '/filepath'
+            request.matched_route = C()
+            request.matched_route.name = 'route_json'
+            return request
+
+        form_cache.configure(max_size=10 * 1024 * 1024)
+        try:
+            res = EditorView(get_request()).edit()
+            self.assertEqual(len(form_cache.entries), 1)
+            with patch('waxe.xml.cache.DTDCache.load') as m:
+                cached = EditorView(get_request()).edit()
+                self.assertEqual(m.call_count, 0)
+            self.assertEqual(cached, res)
+
+            view = EditorView(get_request())
+            invalidate_cached_file(view, 'file1.xml')
+            self.assertEqual(len(form_cache.entries), 0)
+        finally:
+            form_cache.configure(max_size=0)
+            form_cache.invalidate()
+
     def test_get_tags(self):
         request = testing.DummyRequest()
         try:
@@ -280,7 +431,10 @@ class TestEditorView(LoggedBobTestCase):
             expected = "Bad filename extension '.doc'. It should be '.xml'"
             self.assertEqual(str(e), expected)
 
-        with patch('xmltool.update', return_value=False):
+        with patch('xmltool.update', return_value=False) as m, \
+                patch('waxe.xml.writer.atomic_write',
+                      side_effect=lambda filename, write, fsync: write(
+                          filename + '.tmp')):
             request = testing.DummyRequest(
                 params={'_xml_filename': 'test.xml'})
             request.custom_route_path = lambda *args, **kw: '/filepath'
@@ -288,6 +442,20 @@ class TestEditorView(LoggedBobTestCase):
             res = EditorView(request).update()
             expected = 'File updated'
             self.assertEqual(res, expected)
+            # The file is written in a temporary file
+            self.assertEqual(m.call_args[0][0],
+                             os.path.join(path, 'test.xml.tmp'))
+
+        # The save has been replaced by a newer one
+        with patch('waxe.xml.writer.write_coalescer.write',
+                   return_value=False), \
+                patch('waxe.core.events.trigger') as m:
+            request = testing.DummyRequest(
+                params={'_xml_filename': 'test.xml'})
+            request.xmltool_transform = None
+            res = EditorView(request).update()
+            self.assertEqual(res, 'File updated')
+            self.assertEqual(m.call_count, 0)
 
         def raise_func(*args, **kw):
             raise Exception('My error')
@@ -305,6 +473,98 @@ class TestEditorView(LoggedBobTestCase):
             except exc.HTTPInternalServerError, e:
                 self.assertEqual(str(e), expected)
 
+    def test_update_delta(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        request = testing.DummyRequest(params={})
+        try:
+            EditorView(request).update_delta()
+            assert(False)
+        except exc.HTTPClientError, e:
+            expected = 'No filename given'
+            self.assertEqual(str(e), expected)
+
+        request = testing.DummyRequest(params={'_xml_filename': 'test.doc'})
+        try:
+            EditorView(request).update_delta()
+            assert(False)
+        except exc.HTTPClientError, e:
+            expected = "Bad filename extension '.doc'. It should be '.xml'"
+            self.assertEqual(str(e), expected)
+
+        try:
+            with patch('waxe.xml.writer.write_obj') as m:
+                request = testing.DummyRequest(
+                    params={'_xml_filename': 'file1.xml',
+                            'Exercise:unexisting:_value': 'Hello'})
+                request.xmltool_transform = None
+                try:
+                    EditorView(request).update_delta()
+                    assert(False)
+                except exc.HTTPClientError, e:
+                    expected = 'Element Exercise:unexisting not found'
+                    self.assertEqual(str(e), expected)
+                self.assertEqual(m.call_count, 0)
+
+                request = testing.DummyRequest(
+                    params={'_xml_filename': 'file1.xml',
+                            'Exercise:number:_value': '42'})
+                request.xmltool_transform = None
+                res = EditorView(request).update_delta()
+                self.assertEqual(res, 'File updated')
+                self.assertEqual(m.call_count, 1)
+                obj = m.call_args[0][0]
+                self.assertEqual(obj['number'].text, '42')
+
+            def raise_func(*args, **kw):
+                raise Exception('My error')
+
+            with patch('waxe.xml.writer.write_obj') as m:
+                m.side_effect = raise_func
+                request = testing.DummyRequest(
+                    params={'_xml_filename': 'file1.xml',
+                            'Exercise:number:_value': '43'})
+                request.xmltool_transform = None
+                try:
+                    EditorView(request).update_delta()
+                    assert(False)
+                except exc.HTTPInternalServerError, e:
+                    self.assertEqual(str(e), 'My error')
+                # The cached object is reverted
+                obj = document_cache.load(
+                    os.path.join(path, 'file1.xml')).obj
+                self.assertNotEqual(obj['number'].text, '43')
+        finally:
+            document_cache.invalidate()
+
+    def test_update_delta_concurrent_save(self):
+        path = tempfile.mkdtemp()
+        src = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        shutil.copy(os.path.join(src, 'exercise.dtd'), path)
+        shutil.copy(os.path.join(src, 'file1.xml'), path)
+        self.user_bob.config.root_path = path
+        absfilename = os.path.join(path, 'file1.xml')
+
+        def save(*args, **kw):
+            # Another save written after the lock of the path is released
+            open(absfilename, 'w').write(
+                '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+                '<Exercise><number>Another save</number></Exercise>')
+
+        try:
+            request = testing.DummyRequest(
+                params={'_xml_filename': 'file1.xml',
+                        'Exercise:number:_value': '42'})
+            request.xmltool_transform = None
+            with patch('waxe.core.events.trigger', side_effect=save):
+                EditorView(request).update_delta()
+            # The object of our save is not cached for the other save
+            obj = document_cache.load(absfilename).obj
+            self.assertEqual(obj['number'].text, 'Another save')
+        finally:
+            document_cache.invalidate()
+            shutil.rmtree(path)
+
     def test_add_element_json(self):
         path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
         request = testing.DummyRequest(params={})
@@ -320,6 +580,235 @@ class TestEditorView(LoggedBobTestCase):
         self.assertTrue(res)
         self.assertTrue(isinstance(res, dict))
 
+    def test_add_element_json_cache(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        dtd_url = os.path.join(path, 'exercise.dtd')
+
+        def get_request():
+            return testing.DummyRequest(params={'dtd_url': dtd_url,
+                                                'elt_id': 'Exercise:number'},
+                                        xml_plugins=[])
+
+        element_cache.invalidate()
+        element_cache.configure(max_size=0)
+        try:
+            expected = EditorView(get_request()).add_element_json()
+            self.assertEqual(len(element_cache.entries), 0)
+        finally:
+            element_cache.configure(max_size=200)
+
+        res = EditorView(get_request()).add_element_json()
+        self.assertEqual(res, expected)
+        self.assertEqual(len(element_cache.entries), 1)
+        with patch('xmltool.elements.TextElement.to_html') as m:
+            res = EditorView(get_request()).add_element_json()
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(res, expected)
+
+        # The plugins are used before the cache
+        class Plugin(object):
+            def match(self, request, str_id, dtd_url):
+                return True
+
+            def add_element(self, request, str_id, dtd_url):
+                return {'html': 'From plugin'}
+
+        request = get_request()
+        request.xml_plugins = [Plugin()]
+        res = EditorView(request).add_element_json()
+        self.assertEqual(res, {'html': 'From plugin'})
+
+    def test_get_clipboard_store(self):
+        store = get_clipboard_store({'waxe.xml.clipboard.max_size': '10',
+                                     'waxe.xml.clipboard.ttl': '20'})
+        self.assertTrue(isinstance(store, MemoryClipboardStore))
+        self.assertEqual(store.max_size, 10)
+        self.assertEqual(store.ttl, 20)
+
+        settings = {
+            'waxe.xml.clipboard.factory':
+            'waxe.xml.tests.test_editor.fake_clipboard_factory'
+        }
+        self.assertEqual(get_clipboard_store(settings), 'My store')
+
+    def test_get_journal_store(self):
+        self.assertEqual(get_journal_store({}), None)
+        store = get_journal_store({'waxe.xml.journal': 'true',
+                                   'waxe.xml.journal.max_entries': '10'})
+        self.assertTrue(isinstance(store, MemoryJournalStore))
+        self.assertEqual(store.max_entries, 10)
+
+        settings = {
+            'waxe.xml.journal': 'true',
+            'waxe.xml.journal.factory':
+            'waxe.xml.tests.test_editor.fake_journal_factory'
+        }
+        self.assertEqual(get_journal_store(settings), 'My journal store')
+
+    def test_history_revert(self):
+        path = tempfile.mkdtemp()
+        src = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        shutil.copy(os.path.join(src, 'exercise.dtd'), path)
+        shutil.copy(os.path.join(src, 'file1.xml'), path)
+        self.user_bob.config.root_path = path
+        absfilename = os.path.join(path, 'file1.xml')
+
+        def get_request(params):
+            request = testing.DummyRequest(params=params)
+            request.xmltool_transform = None
+            return request
+
+        def get_number():
+            return xmltool.load(absfilename)['number'].text
+
+        def update(value):
+            request = get_request({'_xml_filename': 'file1.xml',
+                                   'Exercise:number:_value': value})
+            EditorView(request).update_delta()
+
+        def revert(version):
+            request = get_request({'_xml_filename': 'file1.xml',
+                                   'version': version})
+            return EditorView(request).revert()
+
+        request = get_request({'path': 'file1.xml'})
+        request.registry.xml_journal = None
+        try:
+            EditorView(request).history()
+            assert(False)
+        except exc.HTTPNotFound, e:
+            self.assertEqual(str(e), 'The journal is not enabled')
+
+        request.registry.xml_journal = MemoryJournalStore()
+        try:
+            original = get_number()
+            update('42')
+            update('43')
+            res = EditorView(get_request({'path': 'file1.xml'})).history()
+            self.assertEqual(res['version'], 2)
+            self.assertEqual(res['base'], 0)
+            self.assertEqual([e['user'] for e in res['entries']],
+                             ['Bob', 'Bob'])
+
+            self.assertEqual(revert('0'), {'version': 3})
+            self.assertEqual(get_number(), original)
+            # Redo
+            self.assertEqual(revert('2'), {'version': 4})
+            self.assertEqual(get_number(), '43')
+
+            for version, expected in [('a', 'Bad version'),
+                                      ('10', 'The version 10 is not '
+                                       'available')]:
+                try:
+                    revert(version)
+                    assert(False)
+                except exc.HTTPClientError, e:
+                    self.assertEqual(str(e), expected)
+
+            # The full saves are diffed against the cached document
+            request = get_request({'_xml_filename': 'file1.xml',
+                                   'Exercise:number:_value': '44'})
+            EditorView(request).update()
+            self.assertEqual(get_number(), '44')
+            res = EditorView(get_request({'path': 'file1.xml'})).history()
+            self.assertEqual(res['version'], 5)
+            self.assertEqual(revert('4'), {'version': 6})
+            self.assertEqual(get_number(), '43')
+            self.assertEqual(revert('3'), {'version': 7})
+            self.assertEqual(get_number(), original)
+
+            # A save written after the lock of the path is released
+            def save(*args, **kw):
+                open(absfilename, 'w').write(
+                    '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+                    '<Exercise><number>Another save</number></Exercise>')
+
+            with patch('waxe.core.events.trigger', side_effect=save):
+                revert('5')
+            obj = document_cache.load(absfilename).obj
+            self.assertEqual(obj['number'].text, 'Another save')
+
+            # The file has been modified outside of waxe
+            open(absfilename, 'w').write(
+                '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+                '<Exercise><number>45</number></Exercise>')
+            try:
+                revert('3')
+                assert(False)
+            except exc.HTTPConflict, e:
+                self.assertEqual(
+                    str(e), 'The file has been modified, the history is '
+                    'lost')
+            res = EditorView(get_request({'path': 'file1.xml'})).history()
+            self.assertEqual(res['entries'], [])
+        finally:
+            document_cache.invalidate()
+            shutil.rmtree(path)
+
+    def test_metrics(self):
+        request = testing.DummyRequest()
+        request.registry.xml_metrics = HistogramSink()
+        request.registry.xml_metrics.record('edit_json', [('total', 10)])
+        try:
+            EditorView(request).metrics()
+            assert(False)
+        except exc.HTTPForbidden:
+            pass
+
+        request.registry.settings['waxe.xml.admins'] = 'Admin Bob'
+        request.registry.xml_clipboard = None
+        request.registry.xml_journal = MemoryJournalStore()
+        res = EditorView(request).metrics()
+        self.assertEqual(res['timings'].keys(), ['edit_json.total'])
+        self.assertEqual(res['timings']['edit_json.total']['count'], 1)
+        self.assertEqual(sorted(res['caches'].keys()),
+                         ['document', 'dtd', 'element', 'form', 'journal',
+                          'renderer'])
+        self.assertEqual(res['caches']['dtd'], dtd_cache.stats())
+        self.assertTrue('hits' in res['caches']['form'])
+        self.assertEqual(res['workers'], worker_pool.stats())
+        self.assertEqual(res['writes'], writer.write_coalescer.stats())
+
+    def test_profiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            request = testing.DummyRequest()
+            store = ProfileStore(directory)
+            request.registry.xml_profiles = store
+            try:
+                EditorView(request).profiles()
+                assert(False)
+            except exc.HTTPForbidden:
+                pass
+
+            request.registry.settings['waxe.xml.admins'] = 'Bob'
+            res = EditorView(request).profiles()
+            self.assertEqual(res, {'profiles': []})
+
+            name = store.save('edit_json', 'pstats',
+                              lambda f: open(f, 'w').write('profile'),
+                              {'path': 'file1.xml'})
+            res = EditorView(request).profiles()
+            self.assertEqual([dic['name'] for dic in res['profiles']],
+                             [name])
+
+            request = testing.DummyRequest(params={'name': name})
+            request.registry.xml_profiles = store
+            request.registry.settings['waxe.xml.admins'] = 'Bob'
+            res = EditorView(request).get_profile()
+            self.assertEqual(res.content_disposition,
+                             'attachment; filename="%s"' % name)
+            self.assertEqual(''.join(res.app_iter), 'profile')
+
+            request.GET['name'] = '../%s' % name
+            try:
+                EditorView(request).get_profile()
+                assert(False)
+            except exc.HTTPNotFound:
+                pass
+        finally:
+            shutil.rmtree(directory)
+
     def test_copy_json(self):
         class C(object): pass
         request = testing.DummyRequest(params={})
@@ -335,10 +824,19 @@ class TestEditorView(LoggedBobTestCase):
         res = EditorView(request).copy_json()
         expected = {'info_msg': 'Copied'}
         self.assertEqual(res, expected)
-        self.assertEqual(len(request.session), 1)
-        clipboard = request.session['clipboard']
-        self.assertEqual(clipboard['elt_id'], 'my:element')
-        self.assertTrue(clipboard['filename'])
+        self.assertEqual(len(request.session), 0)
+        entry = request.registry.xml_clipboard.get('Bob')
+        self.assertEqual(entry.elt_id, 'my:element')
+
+        request.registry.xml_clipboard.max_size = 0
+        request = testing.DummyRequest(
+            params={'elt_id': 'my:element',
+                    'my:element:_value': 'Hello world'})
+        request.matched_route = C()
+        request.matched_route.name = 'route_json'
+        res = EditorView(request).copy_json()
+        expected = {'error_msg': 'The element is too big to be copied'}
+        self.assertEqual(res, expected)
 
     def test_paste_json(self):
         class C(object): pass
@@ -367,12 +865,7 @@ class TestEditorView(LoggedBobTestCase):
         data = {
             'number': {'_value': 'Hello world'}
         }
-        filename = tempfile.mktemp()
-        open(filename, 'w').write(json.dumps(data))
-        request.session['clipboard'] = {
-            'filename': filename,
-            'elt_id': 'Exercise:number'
-        }
+        request.registry.xml_clipboard.set('Bob', 'Exercise:number', data)
         res = EditorView(request).paste_json()
         self.assertEqual(len(res), 4)
         self.assertEqual(res['elt_id'], 'Exercise:number')
@@ -384,11 +877,7 @@ class TestEditorView(LoggedBobTestCase):
         data = {
             'Exercise': {}
         }
-        open(filename, 'w').write(json.dumps(data))
-        request.session['clipboard'] = {
-            'filename': filename,
-            'elt_id': 'Exercise'
-        }
+        request.registry.xml_clipboard.set('Bob', 'Exercise', data)
         res = EditorView(request).paste_json()
         expected = {'error_msg': 'The element can\'t be pasted here'}
         self.assertEqual(res, expected)
@@ -406,9 +895,18 @@ class FunctionalTestEditorView(WaxeTestCase):
 
         for url in [
             '/api/1/account/Bob/xml/edit.json',
+            '/api/1/account/Bob/xml/edit-stream.json',
+            '/api/1/account/Bob/xml/edit-batch.json',
+            '/api/1/account/Bob/xml/edit-lazy.json',
+            '/api/1/account/Bob/xml/get-element.json',
             '/api/1/account/Bob/xml/get-tags.json',
+            '/api/1/account/Bob/xml/validate.json',
+            '/api/1/account/Bob/xml/metrics.json',
+            '/api/1/account/Bob/xml/profiles.json',
+            '/api/1/account/Bob/xml/profile',
             '/api/1/account/Bob/xml/new.json',
             '/api/1/account/Bob/xml/update.json',
+            '/api/1/account/Bob/xml/update-delta.json',
             '/api/1/account/Bob/xml/add-element.json',
             '/api/1/account/Bob/xml/get-comment-modal.json',
             '/api/1/account/Bob/xml/copy.json',
@@ -453,6 +951,168 @@ class FunctionalTestEditorView(WaxeTestCase):
         self.assertEqual(dic['content'].count('<textarea'), 17)
         self.assertEqual(dic['content'].count('contenteditable="true"'), 0)
 
+    @login_user('Bob')
+    def test_edit_dtd_disk_cache(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        directory = tempfile.mkdtemp()
+        old_disk_cache = dtd_cache.disk_cache
+        dtd_cache.disk_cache = DTDDiskCache(directory)
+        dtd_cache.invalidate()
+        form_cache.invalidate()
+        try:
+            self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                             status=200,
+                             params={'path': 'file1.xml'})
+            self.assertEqual(dtd_cache.disk_cache.stats()['writes'], 1)
+
+            # Another process: the parsed dtd comes from the disk cache
+            dtd_cache.invalidate()
+            with patch('xmltool.dtd_parser.dtd_to_dict_v2') as m:
+                self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                 status=200,
+                                 params={'path': 'file1.xml'})
+            self.assertEqual(m.call_count, 0)
+            self.assertEqual(dtd_cache.disk_cache.stats()['hits'], 1)
+        finally:
+            dtd_cache.disk_cache = old_disk_cache
+            dtd_cache.invalidate()
+            shutil.rmtree(directory)
+
+    @login_user('Bob')
+    def test_edit_stream(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-stream.json',
+                               status=400)
+        self.assertEqual(res.body,  '"No filename given"')
+
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-stream.json',
+                               status=200,
+                               params={'path': 'file1.xml'})
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        lines = [json.loads(l) for l in res.body.splitlines()]
+        self.assertEqual(lines[0].keys(), ['jstree_data'])
+        self.assertTrue(isinstance(lines[0]['jstree_data'], dict))
+        content = ''.join([l['content'] for l in lines[1:]])
+
+        expected = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                    status=200,
+                                    params={'path': 'file1.xml'})
+        dic = json.loads(expected.body)
+        self.assertEqual(content, dic['content'])
+        self.assertEqual(lines[0]['jstree_data'], dic['jstree_data'])
+
+    @login_user('Bob')
+    def test_edit_batch(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-batch.json',
+                               status=400)
+        self.assertEqual(res.body,  '"No filename given"')
+
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-batch.json',
+                               status=200,
+                               params=[('paths', 'file1.xml'),
+                                       ('paths', 'unexisting.xml'),
+                                       ('paths', 'file1.xml')])
+        files = json.loads(res.body)['files']
+        self.assertEqual(len(files), 3)
+        self.assertEqual([f['path'] for f in files],
+                         ['file1.xml', 'unexisting.xml', 'file1.xml'])
+        self.assertTrue('error_msg' in files[1])
+
+        expected = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                    status=200,
+                                    params={'path': 'file1.xml'})
+        dic = json.loads(expected.body)
+        dic['path'] = 'file1.xml'
+        self.assertEqual(files[0], dic)
+        self.assertEqual(files[2], dic)
+
+        params = [('paths', 'file1.xml')] * 21
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-batch.json',
+                               status=400,
+                               params=params)
+        self.assertEqual(res.body,  '"Too many files, the maximum is 20"')
+
+    @login_user('Bob')
+    def test_validate(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/validate.json',
+                               status=400,
+                               params={'path': 'unexisting'})
+        self.assertEqual(res.body,  '"Directory unexisting not found"')
+
+        res = self.testapp.get('/api/1/account/Bob/xml/validate.json',
+                               status=200)
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        lines = [json.loads(l) for l in res.body.splitlines()]
+        summary = lines.pop()['summary']
+        self.assertEqual(summary['total'], len(lines))
+        dic = dict([(l['path'], l) for l in lines])
+        self.assertEqual(dic['file1.xml']['valid'], True)
+        self.assertEqual(dic['file1.xml']['total'], len(lines))
+
+    @login_user('Bob')
+    def test_edit_lazy(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-lazy.json',
+                               status=400)
+        self.assertEqual(res.body,  '"No filename given"')
+
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-lazy.json',
+                               status=200,
+                               params={'path': 'file1.xml'})
+        dic = json.loads(res.body)
+        self.assertEqual(len(dic), 2)
+        expected = (
+            '<form method="POST" '
+            'data-action="/api/1/account/Bob/xml/update.json" '
+            'data-paste-href="/api/1/account/Bob/xml/paste.json" '
+            'data-add-href="/api/1/account/Bob/xml/add-element.json" '
+            'data-comment-href="/api/1/account/Bob/xml/get-comment-modal.json" '
+            'data-copy-href="/api/1/account/Bob/xml/copy.json" '
+            'id="xmltool-form">')
+        self.assertTrue(expected in dic['content'])
+        self.assertTrue(isinstance(dic['jstree_data'], dict))
+
+        settings = self.testapp.app.app.registry.settings
+        settings['waxe.xml.lazy_depth'] = '100'
+        res = self.testapp.get('/api/1/account/Bob/xml/edit-lazy.json',
+                               status=200,
+                               params={'path': 'file1.xml'})
+        full = json.loads(res.body)
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml'})
+        self.assertEqual(full, json.loads(res.body))
+
+    @login_user('Bob')
+    def test_get_element_json(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/get-element.json',
+                               status=200)
+        self.assertEqual(json.loads(res.body), {'error_msg': 'Bad parameter'})
+
+        res = self.testapp.get('/api/1/account/Bob/xml/get-element.json',
+                               status=200,
+                               params={'path': 'file1.xml',
+                                       'elt_id': 'Exercise:unexisting'})
+        expected = {'error_msg': 'Element Exercise:unexisting not found'}
+        self.assertEqual(json.loads(res.body), expected)
+
+        res = self.testapp.get('/api/1/account/Bob/xml/get-element.json',
+                               status=200,
+                               params={'path': 'file1.xml',
+                                       'elt_id': 'Exercise:number'})
+        dic = json.loads(res.body)
+        self.assertEqual(dic['elt_id'], 'Exercise:number')
+        self.assertTrue('name="Exercise:number:_value"' in dic['html'])
+
     @login_user('Bob')
     def test_get_tags(self):
         path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
@@ -511,7 +1171,8 @@ class FunctionalTestEditorView(WaxeTestCase):
         expected = '"No filename given"'
         self.assertEqual(res.body, expected)
 
-        with patch('xmltool.update', return_value=False):
+        with patch('xmltool.update', return_value=False), \
+                patch('waxe.xml.writer.atomic_write'):
             res = self.testapp.post('/api/1/account/Bob/xml/update.json',
                                     status=200,
                                     params={'_xml_filename': 'test.xml'})
@@ -535,6 +1196,173 @@ class FunctionalTestEditorView(WaxeTestCase):
         dic = json.loads(res.body)
         self.assertTrue(dic)
 
+    @login_user('Bob')
+    def test_compression(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        expected = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                    status=200,
+                                    params={'path': 'file1.xml'})
+        self.assertTrue('Content-Encoding' not in expected.headers)
+        self.assertEqual(expected.headers['Vary'], 'Accept-Encoding')
+
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml'},
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].endswith('-gzip"'))
+        body = gzip.GzipFile(fileobj=StringIO(res.body)).read()
+        self.assertTrue(len(res.body) < len(body))
+        self.assertEqual(body, expected.body)
+
+        # The compressed ETag is accepted
+        self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                         status=304,
+                         params={'path': 'file1.xml'},
+                         headers={'If-None-Match': res.headers['ETag']})
+
+    @login_user('Bob')
+    def test_server_timing(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        # Don't get the payload and the dtd from the cache
+        form_cache.invalidate()
+        dtd_cache.invalidate()
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml'})
+        phases = [s.split(';')[0]
+                  for s in res.headers['Server-Timing'].split(', ')]
+        for name in ['load', 'dtd', 'render', 'jstree', 'serialize',
+                     'total']:
+            self.assertTrue(name in phases)
+
+        settings = self.testapp.app.app.registry.settings
+        settings['waxe.xml.admins'] = 'Bob'
+        res = self.testapp.get('/api/1/account/Bob/xml/metrics.json',
+                               status=200)
+        res = json.loads(res.body)
+        self.assertTrue('edit_json.render' in res['timings'])
+        self.assertTrue(res['caches']['form']['misses'] >= 1)
+        self.assertTrue('submitted' in res['workers'])
+
+    @login_user('Bob')
+    def test_edit_compact(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml', 'compact': 1})
+        self.assertTrue(', ' not in res.body[:100])
+        dic = json.loads(res.body)
+        self.assertEqual(sorted(dic.keys()),
+                         ['compact', 'dtd_url', 'encoding'])
+        self.assertEqual(dic['compact']['t'], 'Exercise')
+        self.assertEqual(dic['dtd_url'], 'exercise.dtd')
+
+        dtd_url = os.path.join(path, 'exercise.dtd')
+        res = self.testapp.get('/api/1/account/Bob/xml/new.json',
+                               status=200,
+                               params={'dtd_url': dtd_url,
+                                       'dtd_tag': 'Exercise',
+                                       'compact': 1})
+        dic = json.loads(res.body)
+        self.assertEqual(dic['compact']['t'], 'Exercise')
+        self.assertEqual(dic['dtd_url'], dtd_url)
+
+    @login_user('Bob')
+    def test_edit_outline(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml', 'outline': 1})
+        dic = json.loads(res.body)
+        self.assertEqual(sorted(dic.keys()), ['content', 'outline'])
+        self.assertEqual(dic['outline']['tags'][0], 'Exercise')
+        self.assertEqual(dic['outline']['parents'][0], -1)
+        etag = res.headers['ETag']
+
+        # Not the same version as the default payload
+        res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                               status=200,
+                               params={'path': 'file1.xml'},
+                               headers={'If-None-Match': etag})
+        self.assertTrue('jstree_data' in json.loads(res.body))
+
+        dtd_url = os.path.join(path, 'exercise.dtd')
+        res = self.testapp.get('/api/1/account/Bob/xml/new.json',
+                               status=200,
+                               params={'dtd_url': dtd_url,
+                                       'dtd_tag': 'Exercise',
+                                       'outline': 1})
+        dic = json.loads(res.body)
+        self.assertEqual(sorted(dic.keys()), ['content', 'outline'])
+        self.assertEqual(dic['outline']['tags'][0], 'Exercise')
+
+    @login_user('Bob')
+    def test_edit_outline_form_cache(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        self.user_bob.config.root_path = path
+        form_cache.configure(max_size=10 * 1024 * 1024)
+        try:
+            for i in range(2):
+                res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                       status=200,
+                                       params={'path': 'file1.xml',
+                                               'outline': 1})
+                dic = json.loads(res.body)
+                self.assertEqual(sorted(dic.keys()), ['content', 'outline'])
+                self.assertEqual(dic['outline']['tags'][0], 'Exercise')
+                self.assertEqual(len(form_cache.entries), 1)
+
+            res = self.testapp.get('/api/1/account/Bob/xml/edit.json',
+                                   status=200,
+                                   params={'path': 'file1.xml'})
+            self.assertTrue('jstree_data' in json.loads(res.body))
+            self.assertEqual(len(form_cache.entries), 2)
+        finally:
+            form_cache.configure(max_size=0)
+            form_cache.invalidate()
+
+    @login_user('Bob')
+    def test_conditional_get(self):
+        path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
+        dtd_url = os.path.join(path, 'exercise.dtd')
+        self.user_bob.config.root_path = path
+        for url, params, cache_control in [
+            ('/api/1/account/Bob/xml/edit.json', {'path': 'file1.xml'},
+             'private, no-cache'),
+            ('/api/1/account/Bob/xml/get-tags.json', {'dtd_url': dtd_url},
+             'private, max-age=3600'),
+            ('/api/1/account/Bob/xml/get-comment-modal.json',
+             {'comment': 'Hello'},
+             'private, max-age=3600'),
+        ]:
+            res = self.testapp.get(url, status=200, params=params)
+            etag = res.headers['ETag']
+            self.assertTrue(etag)
+            self.assertEqual(res.headers['Cache-Control'], cache_control)
+
+            res = self.testapp.get(url, status=304, params=params,
+                                   headers={'If-None-Match': etag})
+            self.assertEqual(res.body, '')
+            self.assertEqual(res.headers['ETag'], etag)
+
+            res = self.testapp.get(url, status=200, params=params,
+                                   headers={'If-None-Match': '"other"'})
+            self.assertEqual(res.headers['ETag'], etag)
+
+        res = self.testapp.get('/api/1/account/Bob/xml/get-tags.json',
+                               status=200,
+                               params={'dtd_url': dtd_url})
+        etag = res.headers['ETag']
+        res = self.testapp.get('/api/1/account/Bob/xml/get-tags.json',
+                               status=200,
+                               params={'dtd_url': dtd_url, 'text': True})
+        self.assertNotEqual(res.headers['ETag'], etag)
+
     @login_user('Bob')
     def test_get_comment_modal_json(self):
         path = os.path.join(os.getcwd(), 'waxe/xml/tests/files')
@@ -545,3 +1373,14 @@ class FunctionalTestEditorView(WaxeTestCase):
         body = json.loads(res.body)
         self.assertEqual(len(body), 1)
         self.assertTrue('<div class="modal ' in body['content'])
+        registry = self.testapp.app.app.registry
+        self.assertEqual(res.body, registry.xml_comment_modal.empty_body)
+
+        res = self.testapp.get(
+            '/api/1/account/Bob/xml/get-comment-modal.json',
+            status=200, params={'comment': '<b>My comment</b>'})
+        self.assertTrue(('Content-Type', 'application/json; charset=UTF-8') in
+                        res._headerlist)
+        body = json.loads(res.body)
+        self.assertTrue('>&lt;b&gt;My comment&lt;/b&gt;</textarea>' in
+                        body['content'])
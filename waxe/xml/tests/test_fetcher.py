@@ -0,0 +1,206 @@
+import time
+import unittest
+import threading
+import SocketServer
+import BaseHTTPServer
+from urllib2 import URLError
+from mock import patch
+
+from xmltool import dtd
+
+from waxe.xml import fetcher, metrics
+from waxe.xml.cache import DTDCache
+
+
+DTD_CONTENT = '<!ELEMENT Exercise (#PCDATA)>'
+DTD_CONTENT_2 = '<!ELEMENT Exercise (number)><!ELEMENT number (#PCDATA)>'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.client_address,
+                                self.headers.get('If-None-Match')))
+        if server.status != 200:
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', 'Sat, 01 Jan 2000 00:00:00 GMT')
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DTDServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local stand-in of a dtd server
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.content = DTD_CONTENT
+        self.etag = '"v1"'
+        self.status = 200
+        self.requests = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/exercise.dtd' % self.server_address[1]
+
+
+class TestDTDFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = DTDServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.fetcher = fetcher.DTDFetcher(ttl=60, stale_while_revalidate=60,
+                                          stale_if_error=300)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def age(self, seconds):
+        """Make the copy of the dtd older
+        """
+        self.fetcher.entries[self.server.url].fetched -= seconds
+
+    def wait_refresh(self):
+        for i in range(500):
+            if not self.fetcher._refreshing:
+                return
+            time.sleep(0.01)
+        raise Exception('The refresh is not finished')
+
+    def test_get(self):
+        url = self.server.url
+        entry = self.fetcher.get(url)
+        self.assertEqual(entry.content, DTD_CONTENT)
+        self.assertEqual(entry.etag, '"v1"')
+        self.assertEqual(entry.last_modified,
+                         'Sat, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(self.fetcher.fetch(url), DTD_CONTENT)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.fetcher.stats()['hits'], 1)
+
+    def test_keep_alive(self):
+        url = self.server.url
+        self.fetcher.get(url)
+        self.fetcher.invalidate()
+        self.fetcher.get(url)
+        self.assertEqual(len(self.server.requests), 2)
+        # Same client port: the connection is reused
+        self.assertEqual(self.server.requests[0][0],
+                         self.server.requests[1][0])
+
+    def test_revalidate(self):
+        url = self.server.url
+        entry = self.fetcher.get(url)
+        self.age(200)
+        # Expired: the dtd is revalidated before being returned
+        new_entry = self.fetcher.get(url)
+        self.assertEqual(self.server.requests[-1][1], '"v1"')
+        self.assertEqual(new_entry.content, DTD_CONTENT)
+        self.assertEqual(new_entry.fingerprint, entry.fingerprint)
+        self.assertTrue(new_entry.fetched > entry.fetched)
+        self.assertEqual(self.fetcher.stats()['not_modified'], 1)
+
+        self.age(200)
+        self.server.content = DTD_CONTENT_2
+        self.server.etag = '"v2"'
+        new_entry = self.fetcher.get(url)
+        self.assertEqual(new_entry.content, DTD_CONTENT_2)
+        self.assertTrue(new_entry.fingerprint != entry.fingerprint)
+
+    def test_stale_while_revalidate(self):
+        url = self.server.url
+        self.fetcher.get(url)
+        self.server.content = DTD_CONTENT_2
+        self.server.etag = '"v2"'
+        self.age(90)
+        # The stale copy is returned and refreshed in background
+        self.assertEqual(self.fetcher.fetch(url), DTD_CONTENT)
+        self.wait_refresh()
+        self.assertEqual(self.fetcher.stats()['refreshes'], 1)
+        self.assertEqual(self.fetcher.fetch(url), DTD_CONTENT_2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_stale_if_error(self):
+        url = self.server.url
+        self.fetcher.get(url)
+        self.server.status = 500
+        self.age(150)
+        self.assertEqual(self.fetcher.fetch(url), DTD_CONTENT)
+        self.assertEqual(self.fetcher.stats()['stale_errors'], 1)
+
+        # Too old
+        self.age(250)
+        self.assertRaises(fetcher.DTDFetchError, self.fetcher.fetch, url)
+
+        # Server down
+        self.server.status = 200
+        self.fetcher.invalidate()
+        self.fetcher.get(url)
+        self.age(150)
+        with patch.object(self.fetcher.session, 'get',
+                          side_effect=fetcher.requests.ConnectionError(
+                              'Connection refused')):
+            self.assertEqual(self.fetcher.fetch(url), DTD_CONTENT)
+
+    def test_error(self):
+        self.server.status = 404
+        try:
+            self.fetcher.fetch(self.server.url)
+            assert(False)
+        except URLError, e:
+            self.assertTrue(isinstance(e, fetcher.DTDFetchError))
+            self.assertTrue('HTTP 404' in str(e))
+
+    def test_install(self):
+        url = self.server.url
+        self.fetcher.get(url)
+        self.server.status = 500
+        timer = metrics.PhaseTimer()
+        metrics.set_current_timer(timer)
+        with patch.object(fetcher, 'dtd_fetcher', self.fetcher):
+            fetcher.install()
+            try:
+                self.assertEqual(dtd.DTD(url).content, DTD_CONTENT)
+            finally:
+                fetcher.uninstall()
+                metrics.set_current_timer(None)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual([name for name, d in timer.items()], ['dtd'])
+
+    def test_dtd_cache(self):
+        url = self.server.url
+        cache = DTDCache()
+        with patch('waxe.xml.cache.dtd_fetcher', self.fetcher):
+            entry = cache.get(url)
+            self.assertEqual(entry.tags, [])
+            self.assertEqual(entry.text_tags, ['Exercise'])
+            self.assertTrue(cache.get(url) is entry)
+
+            self.server.content = DTD_CONTENT_2
+            self.server.etag = '"v2"'
+            self.age(200)
+            new_entry = cache.get(url)
+            self.assertTrue(new_entry is not entry)
+            self.assertEqual(new_entry.tags, ['Exercise'])
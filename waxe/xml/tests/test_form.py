@@ -0,0 +1,237 @@
+import os
+import tempfile
+import unittest
+import xmltool
+
+from waxe.xml import form
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, comments?, test*, (a|b)*)>
+<!ATTLIST Exercise idatt CDATA #IMPLIED>
+<!ELEMENT comments (comment*)>
+<!ELEMENT comment (#PCDATA)>
+<!ELEMENT test (question, qcm?)>
+<!ELEMENT qcm (choice+)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT choice (#PCDATA)>
+<!ELEMENT a (#PCDATA)>
+<!ELEMENT b (#PCDATA)>
+'''
+
+XML_CONTENT = '''<?xml version="1.0"?>
+<!DOCTYPE Exercise SYSTEM "%s">
+<Exercise idatt="x">
+  <!-- comment -->
+  <number>1</number>
+  <test>
+    <question>q1</question>
+    <qcm><choice>a</choice><choice>b</choice></qcm>
+  </test>
+  <test><question>q2</question></test>
+  <b>b</b>
+</Exercise>
+'''
+
+
+def outline_to_jstree(outline):
+    """Build the jstree data from the outline like the client does
+    """
+    tags = outline['tags']
+    nodes = []
+    for i, parent in enumerate(outline['parents']):
+        tagname = tags[outline['names'][i]]
+        prefix = 'tree_'
+        if parent != -1:
+            prefix = nodes[parent]['a_attr']['id'] + ':'
+        if outline['lists'][i] != -1:
+            prefix += tags[outline['lists'][i]]
+            css_class = '%s %s' % (prefix, tagname)
+            prefix += ':%s:' % outline['indexes'][i]
+        else:
+            css_class = '%s%s %s' % (prefix, tagname, tagname)
+        text = tagname
+        label = outline['labels'][
+            outline['offsets'][i]:outline['offsets'][i + 1]]
+        if label:
+            text += u' <span class="_tree_text">(%s)</span>' % label
+        node = {
+            'text': text,
+            'a_attr': {'id': prefix + tagname},
+            'li_attr': {'class': css_class},
+            'children': [],
+            'state': {'opened': True},
+        }
+        if parent != -1:
+            nodes[parent]['children'].append(node)
+        nodes.append(node)
+    return nodes[0]
+
+
+class TestForm(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dtd_url = os.path.join(self.path, 'exercise.dtd')
+        open(self.dtd_url, 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(XML_CONTENT % 'exercise.dtd')
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+        os.remove(self.filename)
+        os.rmdir(self.path)
+
+    def test_iter_form_from_obj(self):
+        form_attrs = {'data-action': '/update'}
+        obj = xmltool.load(self.filename)
+        expected = xmltool.generate_form_from_obj(
+            obj, form_filename='file.xml', form_attrs=form_attrs)
+
+        obj = xmltool.load(self.filename)
+        chunks = list(form.iter_form_from_obj(
+            obj, form_filename='file.xml', form_attrs=form_attrs))
+        self.assertEqual(''.join(chunks), expected)
+        # The form head, number, comments, the test list (opening, 2 tests,
+        # add button, closing), the choice list (opening, b, add button,
+        # closing) and the form tail
+        self.assertEqual(len(chunks), 13)
+        self.assertTrue(chunks[0].startswith(
+            '<form method="POST" data-action="/update" id="xmltool-form">'))
+        self.assertTrue(chunks[-1].endswith('</div></div></form>'))
+
+    def test_compact_obj(self):
+        obj = xmltool.load(self.filename)
+        expected = {
+            't': 'Exercise',
+            'a': {'idatt': 'x'},
+            'c': [
+                {'t': 'number', 'v': '1', 'm': ' comment '},
+                {'t': 'test', 'l': 'list__test', 'i': 0, 'c': [
+                    {'t': 'question', 'v': 'q1'},
+                    {'t': 'qcm', 'c': [
+                        {'t': 'choice', 'v': 'a', 'l': 'list__choice',
+                         'i': 0},
+                        {'t': 'choice', 'v': 'b', 'l': 'list__choice',
+                         'i': 1},
+                    ]},
+                ]},
+                {'t': 'test', 'l': 'list__test', 'i': 1, 'c': [
+                    {'t': 'question', 'v': 'q2'},
+                ]},
+                {'t': 'b', 'v': 'b', 'l': 'list__a_b', 'i': 0},
+            ]
+        }
+        self.assertEqual(form.compact_obj(obj), expected)
+
+        # The required elements are added
+        dic = xmltool.dtd.DTD(self.dtd_url).parse()
+        obj = dic['Exercise']()
+        self.assertEqual(form.compact_obj(obj),
+                         {'t': 'Exercise', 'c': [{'t': 'number'}]})
+
+    def test_iter_form_from_obj_new(self):
+        dic = xmltool.dtd.DTD(self.dtd_url).parse()
+        obj = dic['Exercise']()
+        obj.dtd_url = self.dtd_url
+        expected = xmltool.generate_form_from_obj(obj)
+        chunks = list(form.iter_form_from_obj(obj))
+        self.assertEqual(''.join(chunks), expected)
+
+    def test_lazy_form_from_obj(self):
+        obj = xmltool.load(self.filename)
+        expected = xmltool.generate_form_from_obj(obj)
+        obj = xmltool.load(self.filename)
+        self.assertEqual(form.lazy_form_from_obj(obj, 100), expected)
+
+        obj = xmltool.load(self.filename)
+        html = form.lazy_form_from_obj(obj, 1)
+        self.assertTrue(
+            '<div class="xmltool-lazy" '
+            'data-elt-id="Exercise:list__test:0:test"></div>' in html)
+        self.assertTrue(
+            '<div class="xmltool-lazy" '
+            'data-elt-id="Exercise:list__test:1:test"></div>' in html)
+        self.assertTrue('name="Exercise:number:_value"' in html)
+        self.assertTrue('question' not in html)
+
+        html = form.lazy_form_from_obj(obj, 2)
+        self.assertTrue('xmltool-lazy' in html)
+        self.assertTrue('name="Exercise:list__test:0:test:question:_value"'
+                        in html)
+        self.assertTrue('name="Exercise:list__test:0:test:qcm:list__choice:'
+                        '0:choice:_value"' not in html)
+
+    def test_lazy_html(self):
+        obj = xmltool.load(self.filename)
+        test = obj['test'][0]
+        self.assertEqual(form.lazy_html(test, 100), test.to_html())
+        html = form.lazy_html(test, 0)
+        self.assertEqual(
+            html,
+            '<a class="btn-add btn-add-test btn-list" '
+            'data-elt-id="Exercise:list__test:0:test">New test</a>'
+            '<div class="xmltool-lazy" '
+            'data-elt-id="Exercise:list__test:0:test"></div>')
+        # The placeholder is replaced by the container without the list
+        # button
+        html = form.lazy_container_html(test, 100)
+        self.assertTrue(test.to_html().endswith(html))
+        self.assertTrue(html.startswith('<div class="panel'))
+
+    def test_get_obj_from_str_id(self):
+        obj = xmltool.load(self.filename)
+        self.assertEqual(form.get_obj_from_str_id(obj, 'Exercise'), obj)
+        self.assertEqual(form.get_obj_from_str_id(obj, 'Exercise:number'),
+                         obj['number'])
+        test = form.get_obj_from_str_id(obj, 'Exercise:list__test:1:test')
+        self.assertEqual(test, obj['test'][1])
+        choice = form.get_obj_from_str_id(
+            obj, 'Exercise:list__test:0:test:qcm:list__choice:1:choice')
+        self.assertEqual(choice.text, 'b')
+
+        for str_id in ['test',
+                       'Exercise:unexisting',
+                       'Exercise:list__test',
+                       'Exercise:list__test:10:test',
+                       'Exercise:list__test:a:test']:
+            try:
+                form.get_obj_from_str_id(obj, str_id)
+                assert(False)
+            except KeyError:
+                pass
+
+    def test_outline_obj(self):
+        obj = xmltool.load(self.filename)
+        outline = form.outline_obj(obj)
+        self.assertEqual(outline['tags'],
+                         ['Exercise', 'number', 'test', 'list__test',
+                          'question', 'qcm', 'choice', 'list__choice', 'b',
+                          'list__a_b'])
+        self.assertEqual(outline['parents'],
+                         [-1, 0, 0, 2, 2, 4, 4, 0, 7, 0])
+        self.assertEqual(outline['names'], [0, 1, 2, 4, 5, 6, 6, 2, 4, 8])
+        self.assertEqual(outline['lists'], [-1, -1, 3, -1, -1, 7, 7, 3, -1, 9])
+        self.assertEqual(outline['indexes'],
+                         [-1, -1, 0, -1, -1, 0, 1, 1, -1, 0])
+        self.assertEqual(outline['labels'], '1q1abq2b')
+        self.assertEqual(outline['offsets'],
+                         [0, 0, 1, 1, 3, 3, 4, 5, 5, 7, 8])
+
+        # Same nodes as to_jstree_dict
+        expected = xmltool.load(self.filename).to_jstree_dict()
+        self.assertEqual(outline_to_jstree(outline), expected)
+
+        # The required elements are added but not kept in the object
+        xml_str = ('<!DOCTYPE Exercise SYSTEM "%s"><Exercise><test><qcm/>'
+                   '</test></Exercise>' % self.dtd_url)
+        obj = xmltool.load_string(xml_str, validate=False)
+        elts = list(obj.walk())
+        outline = form.outline_obj(obj)
+        self.assertEqual(list(obj.walk()), elts)
+        self.assertEqual([outline['tags'][i] for i in outline['names']],
+                         ['Exercise', 'number', 'test', 'question', 'qcm',
+                          'choice'])
+        self.assertEqual(outline_to_jstree(outline),
+                         obj.to_jstree_dict())
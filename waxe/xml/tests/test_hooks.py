@@ -0,0 +1,33 @@
+import unittest
+from pyramid.exceptions import ConfigurationError
+
+from waxe.xml import hooks
+
+
+def fake_hook():
+    return 'Hello world'
+
+
+class TestHooks(unittest.TestCase):
+
+    def test_resolve(self):
+        func = hooks.resolve('waxe.xml.tests.test_hooks.fake_hook')
+        self.assertEqual(func(), 'Hello world')
+        self.assertTrue(
+            'waxe.xml.tests.test_hooks.fake_hook' in hooks._resolved)
+
+        for dotted_path in ['waxe.xml.tests.test_hooks.unexisting',
+                            'waxe.xml.unexisting.func',
+                            'func']:
+            try:
+                hooks.resolve(dotted_path)
+                assert(False)
+            except ConfigurationError, e:
+                self.assertTrue(str(e).startswith(
+                    'Invalid dotted path %s' % dotted_path))
+
+    def test_get_hook(self):
+        self.assertEqual(hooks.get_hook({}, 'hook'), None)
+        self.assertEqual(hooks.get_hook({'hook': ''}, 'hook'), None)
+        settings = {'hook': ' waxe.xml.tests.test_hooks.fake_hook\n'}
+        self.assertEqual(hooks.get_hook(settings, 'hook'), fake_hook)
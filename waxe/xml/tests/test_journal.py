@@ -0,0 +1,334 @@
+import os
+import tempfile
+import unittest
+import xmltool
+from lxml import etree
+
+from waxe.xml import delta, journal
+from waxe.xml.journal import (
+    DocumentJournal,
+    JournalEntry,
+    JournalError,
+    MemoryJournalStore,
+    memory_store_factory,
+)
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number, test*, (a|b)?)>
+<!ATTLIST Exercise idatt CDATA #IMPLIED>
+<!ELEMENT test (question)>
+<!ELEMENT number (#PCDATA)>
+<!ELEMENT question (#PCDATA)>
+<!ELEMENT a (#PCDATA)>
+<!ELEMENT b (#PCDATA)>
+'''
+
+XML_CONTENT = '''<?xml version="1.0"?>
+<!DOCTYPE Exercise SYSTEM "exercise.dtd">
+<Exercise>
+  <number>1</number>
+  <test><question>q1</question></test>
+  <test><question>q2</question></test>
+  <a>a</a>
+</Exercise>
+'''
+
+NEW_XML_CONTENT = '''<?xml version="1.0"?>
+<!DOCTYPE Exercise SYSTEM "exercise.dtd">
+<Exercise idatt="id">
+  <number>2</number>
+  <test><question>q0</question></test>
+  <test><question>q1</question></test>
+  <!-- Comment -->
+  <test><question>q2 modified</question></test>
+  <b>b</b>
+</Exercise>
+'''
+
+
+def entry(*changes):
+    return JournalEntry(list(changes))
+
+
+def to_string(obj):
+    return etree.tostring(obj.to_xml())
+
+
+class TestJournalFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dtd_url = os.path.join(self.path, 'exercise.dtd')
+        open(self.dtd_url, 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(XML_CONTENT)
+
+    def tearDown(self):
+        os.remove(self.dtd_url)
+        os.remove(self.filename)
+        os.rmdir(self.path)
+
+    def test_get_changes(self):
+        obj = xmltool.load(self.filename)
+        changes = {
+            'Exercise:number': {'_value': 'Hello', '_comment': 'Comment'},
+            'Exercise': {'_attrs': {'idatt': 'id'}},
+            'Exercise:list__test:1:test:question': {'_value': 'q2'},
+        }
+        modified, undo = delta.apply_changes(obj, changes)
+        self.assertEqual(sorted(journal.get_changes(undo)), [
+            ('Exercise', 'attributes', None, {'idatt': 'id'}),
+            ('Exercise:number', 'comment', None, 'Comment'),
+            ('Exercise:number', 'text', '1', 'Hello'),
+        ])
+
+    def test_apply_values(self):
+        obj = xmltool.load(self.filename)
+        values = [
+            ('Exercise:number', 'text', 'Hello'),
+            ('Exercise', 'attributes', {'idatt': 'id'}),
+            ('Exercise:list__test:1:test:question', 'text', 'q3'),
+            ('Exercise:list__test:0:test', 'element', None),
+            ('Exercise:a', 'element', None),
+            ('Exercise:b', 'element',
+             '<waxe-journal><!-- Comment --><b>b</b></waxe-journal>'),
+        ]
+        modified, changes = journal.apply_values(obj, values)
+        self.assertEqual(len(modified), 4)
+        self.assertEqual(obj['number'].text, 'Hello')
+        self.assertEqual(obj.attributes, {'idatt': 'id'})
+        # The values are copied
+        self.assertTrue(obj.attributes is not values[1][2])
+        self.assertEqual(len(obj['test']), 1)
+        self.assertEqual(obj['test'][0]['question'].text, 'q3')
+        self.assertEqual(obj['b'].text, 'b')
+        self.assertEqual(obj['b'].comment, ' Comment ')
+        self.assertEqual(changes[3], (
+            'Exercise:list__test:0:test', 'element',
+            '<waxe-journal><test><question>q1</question></test>'
+            '</waxe-journal>', None))
+
+        journal.cancel_changes(obj, changes)
+        self.assertEqual(to_string(obj),
+                         to_string(xmltool.load(self.filename)))
+
+        values = [
+            ('Exercise:number', 'text', 'Hello'),
+            ('Exercise:list__test:5:test:question', 'text', 'q3'),
+        ]
+        try:
+            journal.apply_values(obj, values)
+            assert(False)
+        except JournalError, e:
+            self.assertEqual(
+                str(e), 'Element Exercise:list__test:5:test:question '
+                'not found')
+        # The object is reverted
+        self.assertEqual(obj['number'].text, '1')
+
+    def test_diff_objs(self):
+        old = xmltool.load(self.filename)
+        open(self.filename, 'w').write(NEW_XML_CONTENT)
+        new = xmltool.load(self.filename)
+        changes = journal.diff_objs(old, new)
+        self.assertEqual(changes, [
+            ('Exercise', 'attributes', None, {'idatt': 'id'}),
+            ('Exercise:number', 'text', '1', '2'),
+            # The items are matched by their content
+            ('Exercise:list__test:1:test', 'comment', None, ' Comment '),
+            ('Exercise:list__test:1:test:question', 'text', 'q2',
+             'q2 modified'),
+            ('Exercise:list__test:0:test', 'element', None,
+             '<waxe-journal><test><question>q0</question></test>'
+             '</waxe-journal>'),
+            ('Exercise:a', 'element',
+             '<waxe-journal><a>a</a></waxe-journal>', None),
+            ('Exercise:b', 'element', None,
+             '<waxe-journal><b>b</b></waxe-journal>'),
+        ])
+        self.assertEqual(journal.diff_objs(new, new), [])
+
+        # The changes go from old to new and the revert from new to old
+        obj = xmltool.load(self.filename)
+        doc_journal = DocumentJournal()
+        doc_journal.record(1, 2, JournalEntry(changes))
+        journal.apply_values(obj, doc_journal.get_revert(0))
+        self.assertEqual(to_string(obj), to_string(old))
+        journal.apply_values(obj, [(str_id, attr, value)
+                                   for str_id, attr, old, value in changes])
+        self.assertEqual(to_string(obj), to_string(new))
+
+    def test_diff_objs_list_item(self):
+        old = xmltool.load(self.filename)
+        new = xmltool.load(self.filename)
+        new['test'][1]['question'].text = 'q3'
+        self.assertEqual(journal.diff_objs(old, new), [
+            ('Exercise:list__test:1:test:question', 'text', 'q2', 'q3'),
+        ])
+
+        new = xmltool.load(self.filename)
+        new['test'][0].delete()
+        self.assertEqual(journal.diff_objs(old, new), [
+            ('Exercise:list__test:0:test', 'element',
+             '<waxe-journal><test><question>q1</question></test>'
+             '</waxe-journal>', None),
+        ])
+
+        new = xmltool.load(self.filename)
+        new.tagname = 'Other'
+        try:
+            journal.diff_objs(old, new)
+            assert(False)
+        except JournalError, e:
+            self.assertEqual(str(e),
+                             "The root Exercise can't be replaced by Other")
+
+    def test_merge_entries(self):
+        entries = [
+            entry(('a', 'text', '1', '2'), ('b', 'text', 'b1', 'b2')),
+            entry(('a', 'text', '2', '3')),
+            entry(('b', 'text', 'b2', 'b1')),
+        ]
+        for i, e in enumerate(entries):
+            e.previous, e.version = i, i + 1
+        merged = journal.merge_entries(entries)
+        # b has the same value
+        self.assertEqual(merged.changes, [('a', 'text', '1', '3')])
+        self.assertEqual(merged.previous, 0)
+        self.assertEqual(merged.version, 3)
+        self.assertTrue(journal.merge_entries(entries[:1]) is entries[0])
+
+        # The order of the element changes matters, they are all kept
+        entries = [
+            entry(('a:list__b:0:b', 'element', None, '<b/>')),
+            entry(('a:list__b:0:b', 'element', '<b/>', None)),
+        ]
+        merged = journal.merge_entries(entries)
+        self.assertEqual(merged.changes, [
+            ('a:list__b:0:b', 'element', None, '<b/>'),
+            ('a:list__b:0:b', 'element', '<b/>', None),
+        ])
+
+
+class TestDocumentJournal(unittest.TestCase):
+
+    def test_record(self):
+        doc_journal = DocumentJournal()
+        self.assertEqual(doc_journal.record(1, 2, entry(
+            ('a', 'text', '1', '2'))), 1)
+        self.assertEqual(doc_journal.record(2, 3, entry(
+            ('a', 'text', '2', '3'))), 2)
+        self.assertEqual(doc_journal.stamp, 3)
+        # Nothing has changed
+        self.assertEqual(doc_journal.record(3, 4), 2)
+        self.assertEqual(doc_journal.stamp, 4)
+        self.assertEqual(doc_journal.get_versions(), [0, 1, 2])
+
+        history = doc_journal.history()
+        self.assertEqual(history['version'], 2)
+        self.assertEqual(history['base'], 0)
+        self.assertEqual([e['version'] for e in history['entries']], [1, 2])
+        self.assertEqual(history['entries'][0]['previous'], 0)
+        self.assertEqual(history['entries'][0]['changes'], 1)
+
+        # The file has been modified outside of the journal
+        self.assertEqual(doc_journal.record(10, 11, entry(
+            ('a', 'text', '10', '11'))), 3)
+        self.assertEqual(doc_journal.get_versions(), [2, 3])
+
+        doc_journal.sync(11)
+        self.assertEqual(doc_journal.get_versions(), [2, 3])
+        doc_journal.sync(12)
+        self.assertEqual(doc_journal.get_versions(), [3])
+
+    def test_get_revert(self):
+        doc_journal = DocumentJournal()
+        doc_journal.record(1, 2, entry(('a', 'text', '1', '2'),
+                                       ('b', 'text', 'b1', 'b2')))
+        doc_journal.record(2, 3, entry(('a', 'text', '2', '3')))
+        doc_journal.record(3, 4, entry(('l:0:c', 'element', None, '<c/>'),
+                                       ('l:0:c:d', 'text', None, 'd')))
+
+        self.assertEqual(doc_journal.get_revert(3), [])
+        self.assertEqual(doc_journal.get_revert(2), [
+            ('l:0:c:d', 'text', None),
+            ('l:0:c', 'element', None),
+        ])
+        # The newest changes are cancelled first
+        self.assertEqual(doc_journal.get_revert(0), [
+            ('l:0:c:d', 'text', None),
+            ('l:0:c', 'element', None),
+            ('a', 'text', '2'),
+            ('b', 'text', 'b1'),
+            ('a', 'text', '1'),
+        ])
+
+        try:
+            doc_journal.get_revert(4)
+            assert(False)
+        except JournalError, e:
+            self.assertEqual(str(e), 'The version 4 is not available')
+
+    def test_compaction(self):
+        doc_journal = DocumentJournal(max_entries=4)
+        for i in range(4):
+            doc_journal.record(i, i + 1, entry(
+                ('a', 'text', str(i), str(i + 1))))
+        self.assertEqual(doc_journal.get_versions(), [0, 1, 2, 3, 4])
+        doc_journal.record(4, 5, entry(('a', 'text', '4', '5')))
+        # The 3 oldest entries are merged
+        self.assertEqual(doc_journal.get_versions(), [0, 3, 4, 5])
+        self.assertEqual(doc_journal.entries[0].changes,
+                         [('a', 'text', '0', '3')])
+        self.assertEqual(doc_journal.get_revert(3),
+                         [('a', 'text', '4'), ('a', 'text', '3')])
+        self.assertEqual(doc_journal.get_revert(0),
+                         [('a', 'text', '4'), ('a', 'text', '3'),
+                          ('a', 'text', '0')])
+        try:
+            doc_journal.get_revert(1)
+            assert(False)
+        except JournalError:
+            pass
+
+    def test_max_size(self):
+        # The size of an entry is the size of its strings
+        doc_journal = DocumentJournal(max_size=20)
+        doc_journal.record(0, 1, entry(('a', 'text', '0', '1')))
+        doc_journal.record(1, 2, entry(('a', 'text', '1', '2')))
+        self.assertEqual(doc_journal.get_versions(), [0, 1, 2])
+        self.assertEqual(doc_journal.size, 14)
+        doc_journal.record(2, 3, entry(('a', 'text', '2', '3')))
+        self.assertEqual(doc_journal.get_versions(), [1, 2, 3])
+        self.assertEqual(doc_journal.size, 14)
+        # Too big to be kept
+        doc_journal.record(3, 4, entry(('a', 'text', '3', 'b' * 20)))
+        self.assertEqual(doc_journal.get_versions(), [4])
+        self.assertEqual(doc_journal.size, 0)
+
+
+class TestMemoryJournalStore(unittest.TestCase):
+
+    def test_store(self):
+        store = MemoryJournalStore(max_documents=2, max_entries=5)
+        self.assertEqual(store.get('file1.xml'), None)
+        doc_journal = store.get('file1.xml', create=True)
+        self.assertEqual(doc_journal.max_entries, 5)
+        self.assertTrue(store.get('file1.xml') is doc_journal)
+        store.get('file2.xml', create=True)
+        store.get('file3.xml', create=True)
+        self.assertEqual(store.get('file1.xml'), None)
+        self.assertEqual(store.stats()['entries'], 2)
+        store.delete('file3.xml')
+        self.assertEqual(store.get('file3.xml'), None)
+
+    def test_memory_store_factory(self):
+        store = memory_store_factory({
+            'waxe.xml.journal.max_documents': '3',
+            'waxe.xml.journal.max_entries': '10',
+            'waxe.xml.journal.max_size': '100',
+        })
+        self.assertEqual(store.journals.max_size, 3)
+        self.assertEqual(store.max_entries, 10)
+        self.assertEqual(store.max_size, 100)
@@ -0,0 +1,205 @@
+import socket
+import unittest
+from mock import patch
+
+from waxe.xml import metrics
+
+
+class C(object):
+    pass
+
+
+class FakeResponse(object):
+
+    def __init__(self):
+        self.headers = {}
+
+
+def fake_sink_factory(settings):
+    return 'My sink'
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def test_phase(self):
+        timer = metrics.PhaseTimer()
+        with patch('time.time', side_effect=[1, 1.5, 2, 2.25]):
+            with timer.phase('load'):
+                pass
+            with timer.phase('load'):
+                pass
+        self.assertEqual(timer.items(), [('load', 750)])
+
+        with patch('time.time', side_effect=[1, 1.25]):
+            timer.start('serialize')
+            timer.stop('serialize')
+        # Not started
+        timer.stop('other')
+        self.assertEqual(timer.items(), [('load', 750), ('serialize', 250)])
+
+    def test_phase_without_timer(self):
+        metrics.set_current_timer(None)
+        with metrics.phase('load'):
+            pass
+
+        timer = metrics.PhaseTimer()
+        metrics.set_current_timer(timer)
+        try:
+            with metrics.phase('load'):
+                with metrics.phase('dtd'):
+                    pass
+        finally:
+            metrics.set_current_timer(None)
+        self.assertEqual([name for name, d in timer.items()],
+                         ['dtd', 'load'])
+
+    def test_get_server_timing(self):
+        self.assertEqual(
+            metrics.get_server_timing([('load', 10.123), ('total', 20)]),
+            'load;dur=10.1, total;dur=20.0')
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_record(self):
+        histogram = metrics.Histogram(buckets=(10, 100))
+        self.assertEqual(histogram.percentile(50), None)
+        for value in [1, 5, 50, 500]:
+            histogram.record(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 556)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 500)
+        self.assertEqual(histogram.percentile(50), 10)
+        self.assertEqual(histogram.percentile(75), 100)
+        self.assertEqual(histogram.percentile(99), 500)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'],
+                         [('10', 2), ('100', 1), ('+Inf', 1)])
+        self.assertEqual(snapshot['p50'], 10)
+
+
+class TestSinks(unittest.TestCase):
+
+    def test_histogram_sink(self):
+        sink = metrics.HistogramSink()
+        sink.record('edit_json', [('load', 10), ('total', 20)])
+        sink.record('edit_json', [('total', 30)])
+        snapshot = sink.snapshot()
+        self.assertEqual(sorted(snapshot.keys()),
+                         ['edit_json.load', 'edit_json.total'])
+        self.assertEqual(snapshot['edit_json.total']['count'], 2)
+        sink.reset()
+        self.assertEqual(sink.snapshot(), {})
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = metrics.StatsdSink('127.0.0.1', server.getsockname()[1],
+                                      prefix='waxe')
+            sink.record('edit_json', [('load', 10), ('total', 20.5)])
+            data = server.recv(4096)
+        finally:
+            server.close()
+        self.assertEqual(data, 'waxe.edit_json.load:10.000|ms\n'
+                               'waxe.edit_json.total:20.500|ms')
+
+        with patch.object(metrics, 'STATSD_MAX_PACKET', 40):
+            with patch.object(sink, 'send') as m:
+                sink.record('edit_json', [('load', 10), ('total', 20.5)])
+        self.assertEqual(m.call_count, 2)
+
+    def test_statsd_sink_error(self):
+        sink = metrics.StatsdSink('127.0.0.1', 1)
+        with patch.object(sink.socket, 'sendto',
+                          side_effect=socket.error('refused')):
+            sink.record('edit_json', [('load', 10)])
+
+    def test_get_metrics_sink(self):
+        sink = metrics.get_metrics_sink({})
+        self.assertTrue(isinstance(sink, metrics.HistogramSink))
+
+        sink = metrics.get_metrics_sink({
+            'waxe.xml.metrics.sink': 'waxe.xml.metrics.statsd_sink_factory',
+            'waxe.xml.metrics.statsd.port': '9000',
+        })
+        self.assertTrue(isinstance(sink, metrics.StatsdSink))
+        self.assertEqual(sink.address, ('localhost', 9000))
+
+        sink = metrics.get_metrics_sink({
+            'waxe.xml.metrics.sink':
+            'waxe.xml.tests.test_metrics.fake_sink_factory',
+        })
+        self.assertEqual(sink, 'My sink')
+
+
+class TestTimingTween(unittest.TestCase):
+
+    def get_registry(self, settings=None):
+        registry = C()
+        registry.settings = settings or {}
+        registry.xml_metrics = metrics.HistogramSink()
+        return registry
+
+    def get_request(self, route_name='edit_json'):
+        request = C()
+        request.matched_route = C()
+        request.matched_route.name = route_name
+        return request
+
+    def test_tween(self):
+        def handler(request):
+            self.assertTrue(metrics.get_current_timer() is request.xml_timer)
+            with metrics.phase('load'):
+                pass
+            metrics.start_serialize({'request': request})
+            return FakeResponse()
+
+        registry = self.get_registry()
+        tween = metrics.timing_tween_factory(handler, registry)
+        request = self.get_request()
+        response = tween(request)
+        self.assertEqual(metrics.get_current_timer(), None)
+        header = response.headers['Server-Timing']
+        self.assertEqual([s.split(';')[0] for s in header.split(', ')],
+                         ['load', 'serialize', 'total'])
+        self.assertEqual(
+            sorted(registry.xml_metrics.snapshot().keys()),
+            ['edit_json.load', 'edit_json.serialize', 'edit_json.total'])
+
+        # No route: nothing is recorded
+        request.matched_route = None
+        response = tween(request)
+        self.assertEqual(response.headers, {})
+
+        # Not a route of the editor
+        response = tween(self.get_request('login'))
+        self.assertEqual(response.headers, {})
+        self.assertEqual(len(registry.xml_metrics.snapshot()), 3)
+
+    def test_tween_settings(self):
+        def handler(request):
+            return FakeResponse()
+
+        registry = self.get_registry({'waxe.xml.metrics': 'false'})
+        self.assertTrue(metrics.timing_tween_factory(handler, registry)
+                        is handler)
+
+        registry = self.get_registry(
+            {'waxe.xml.metrics.server_timing': 'false'})
+        tween = metrics.timing_tween_factory(handler, registry)
+        response = tween(self.get_request())
+        self.assertEqual(response.headers, {})
+        self.assertEqual(registry.xml_metrics.snapshot().keys(),
+                         ['edit_json.total'])
+
+    def test_tween_error(self):
+        def handler(request):
+            raise ValueError('Error')
+
+        tween = metrics.timing_tween_factory(handler, self.get_registry())
+        self.assertRaises(ValueError, tween, self.get_request())
+        self.assertEqual(metrics.get_current_timer(), None)
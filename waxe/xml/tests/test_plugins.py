@@ -0,0 +1,101 @@
+import unittest
+from pyramid.exceptions import ConfigurationError
+
+from waxe.xml.plugins import PluginIndex, load_plugins, get_tag
+
+
+class DynamicPlugin(object):
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.calls = 0
+
+    def match(self, request, str_id, dtd_url):
+        self.calls += 1
+        return get_tag(str_id) == self.tag
+
+
+class DeclaredPlugin(object):
+
+    def __init__(self, tags=None, dtd_urls=None, accept=True):
+        self.tags = tags
+        self.dtd_urls = dtd_urls
+        self.accept = accept
+        self.calls = 0
+
+    def match(self, request, str_id, dtd_url):
+        self.calls += 1
+        return self.accept
+
+
+class NoMatchPlugin(object):
+    tags = ['comment']
+
+
+class TestPlugins(unittest.TestCase):
+
+    def test_get_tag(self):
+        self.assertEqual(get_tag('Exercise'), 'Exercise')
+        self.assertEqual(get_tag('Exercise:list__test:0:test'), 'test')
+
+    def test_load_plugins(self):
+        plugins = load_plugins(['waxe.xml.tests.test_plugins'])
+        self.assertEqual(len(plugins), 1)
+        try:
+            load_plugins(['waxe.xml.unexisting'])
+            assert(False)
+        except ConfigurationError, e:
+            self.assertTrue(str(e).startswith(
+                "The plugin waxe.xml.unexisting can't be loaded"))
+
+    def test_match(self):
+        dynamic = DynamicPlugin('question')
+        section = DeclaredPlugin(tags=['test'])
+        dtd = DeclaredPlugin(dtd_urls=['http://dtd/*.dtd'])
+        nomatch = NoMatchPlugin()
+        index = PluginIndex([dynamic, section, dtd, nomatch])
+        self.assertEqual(len(index), 4)
+
+        self.assertEqual(
+            index.match(None, 'Exercise:list__test:0:test', '/my.dtd'),
+            section)
+        self.assertEqual(dynamic.calls, 1)
+        self.assertEqual(section.calls, 1)
+        self.assertEqual(dtd.calls, 0)
+
+        self.assertEqual(
+            index.match(None, 'Exercise:question', 'http://dtd/ex.dtd'),
+            dynamic)
+        self.assertEqual(
+            index.match(None, 'Exercise:number', 'http://dtd/ex.dtd'),
+            dtd)
+        self.assertEqual(index.match(None, 'Exercise:number', '/my.dtd'),
+                         None)
+        self.assertEqual(index.match(None, 'Exercise:comment', '/my.dtd'),
+                         nomatch)
+        self.assertEqual(section.calls, 1)
+
+        section.accept = False
+        self.assertEqual(
+            index.match(None, 'Exercise:list__test:1:test', '/my.dtd'),
+            None)
+
+    def test_get_candidates(self):
+        dynamic = DynamicPlugin('question')
+        section = DeclaredPlugin(tags=['test'], dtd_urls=['/my.dtd'])
+        index = PluginIndex([section, dynamic])
+        self.assertEqual(index.get_candidates('/my.dtd', 'test'),
+                         [section, dynamic])
+        self.assertEqual(index.get_candidates('/other.dtd', 'test'),
+                         [dynamic])
+        self.assertEqual(len(index.candidates), 2)
+        self.assertTrue(index.get_candidates('/my.dtd', 'test') is
+                        index.get_candidates('/my.dtd', 'test'))
+
+    def test_get_candidates_tag_patterns(self):
+        plugin = DeclaredPlugin(tags=['sect*', 'answer-[ab]'])
+        index = PluginIndex([plugin])
+        for tag in ['section', 'sect', 'answer-a']:
+            self.assertEqual(index.get_candidates('/my.dtd', tag), [plugin])
+        for tag in ['subsection', 'answer-c', 'Section']:
+            self.assertEqual(index.get_candidates('/my.dtd', tag), [])
@@ -0,0 +1,244 @@
+import os
+import sys
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+import threading
+from mock import patch
+
+from waxe.xml import profiling
+
+
+class C(object):
+    pass
+
+
+def get_request(route_name='edit_json', params=None):
+    request = C()
+    request.params = params or {}
+    if route_name:
+        request.matched_route = C()
+        request.matched_route.name = route_name
+    else:
+        request.matched_route = None
+    return request
+
+
+def slow_function(duration):
+    end = time.time() + duration
+    while time.time() < end:
+        pass
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_get_stack_key(self):
+        def func():
+            return profiling.get_stack_key(sys._getframe())
+
+        key = func()
+        names = key.split(';')
+        self.assertTrue(names[-1].startswith('func (test_profiling.py:'))
+        self.assertTrue(names[-2].startswith('test_get_stack_key ('))
+
+    def test_sample(self):
+        sampler = profiling.StackSampler(interval=0.001)
+        sampler.start()
+        self.assertTrue(sampler._thread is not None)
+        slow_function(0.1)
+        stacks = sampler.stop()
+        self.assertTrue(stacks)
+        self.assertTrue([key for key in stacks if 'slow_function' in key])
+        # The sampling thread stops when there is nothing to sample
+        for i in range(100):
+            if sampler._thread is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sampler._thread, None)
+        self.assertEqual(sampler.stop(), {})
+
+    def test_sample_other_thread(self):
+        sampler = profiling.StackSampler(interval=0.001)
+        results = {}
+
+        def run():
+            sampler.start()
+            slow_function(0.1)
+            results['stacks'] = sampler.stop()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertTrue([key for key in results['stacks']
+                         if 'slow_function' in key])
+
+    def test_get_folded(self):
+        self.assertEqual(profiling.get_folded({'a;b': 2, 'a': 1}),
+                         'a 1\na;b 2\n')
+
+
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = profiling.ProfileStore(
+            os.path.join(self.directory, 'profiles'), max_files=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, filename):
+        open(filename, 'w').write('profile')
+
+    def test_save(self):
+        self.assertEqual(self.store.list(), [])
+        name = self.store.save('edit_json', profiling.FOLDED, self.write,
+                               {'path': 'file1.xml'})
+        self.assertTrue(name.endswith('-edit_json.folded'))
+        self.assertEqual(self.store.get_path(name),
+                         os.path.join(self.directory, 'profiles', name))
+        profiles = self.store.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['name'], name)
+        self.assertEqual(profiles[0]['path'], 'file1.xml')
+        self.assertEqual(profiles[0]['route'], 'edit_json')
+        self.assertEqual(profiles[0]['kind'], 'folded')
+        self.assertEqual(profiles[0]['size'], 7)
+
+    def test_trim(self):
+        names = []
+        for i in range(3):
+            names.append(self.store.save('edit_json', profiling.PSTATS,
+                                         self.write, {}))
+            time.sleep(0.01)
+        self.assertEqual([dic['name'] for dic in self.store.list()],
+                         [names[2], names[1]])
+        self.assertEqual(self.store.get_path(names[0]), None)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.directory, 'profiles'))), 4)
+
+    def test_get_path(self):
+        self.store.save('edit_json', profiling.PSTATS, self.write, {})
+        self.assertEqual(self.store.get_path(None), None)
+        self.assertEqual(self.store.get_path('../profiles'), None)
+        self.assertEqual(self.store.get_path('unknown.pstats'), None)
+
+
+class TestProfilingTween(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_registry(self, **settings):
+        registry = C()
+        registry.settings = {
+            'waxe.xml.profiling': 'true',
+            'waxe.xml.profiling.directory': self.directory,
+        }
+        registry.settings.update(settings)
+        registry.queryUtility = lambda iface: None
+        return registry
+
+    def handler(self, request):
+        profiling.add_tags(request, dtd_url='exercise.dtd')
+        slow_function(0.05)
+        return 'response'
+
+    def test_disabled(self):
+        registry = self.get_registry(**{'waxe.xml.profiling': 'false'})
+        self.assertEqual(
+            profiling.profiling_tween_factory(self.handler, registry),
+            self.handler)
+
+    def test_cprofile(self):
+        registry = self.get_registry(**{'waxe.xml.profiling.percent': '100'})
+        tween = profiling.profiling_tween_factory(self.handler, registry)
+        request = get_request(params={'path': 'file1.xml'})
+        self.assertEqual(tween(request), 'response')
+        profiles = registry.xml_profiles.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['kind'], 'pstats')
+        self.assertEqual(profiles[0]['path'], 'file1.xml')
+        self.assertEqual(profiles[0]['dtd_url'], 'exercise.dtd')
+        self.assertTrue(profiles[0]['duration'] >= 50)
+        stats = pstats.Stats(
+            registry.xml_profiles.get_path(profiles[0]['name']))
+        self.assertTrue([func for func in stats.stats
+                         if func[2] == 'slow_function'])
+
+        # Excluded routes
+        tween(get_request('get_profile'))
+        tween(get_request('login'))
+        tween(get_request(None))
+        self.assertEqual(len(registry.xml_profiles.list()), 1)
+
+    def test_cprofile_percent(self):
+        registry = self.get_registry(**{'waxe.xml.profiling.percent': '10'})
+        tween = profiling.profiling_tween_factory(self.handler, registry)
+        with patch('random.random', return_value=0.5):
+            tween(get_request())
+        self.assertEqual(registry.xml_profiles.list(), [])
+        with patch('random.random', return_value=0.05):
+            tween(get_request())
+        self.assertEqual(len(registry.xml_profiles.list()), 1)
+
+    def test_sampler(self):
+        registry = self.get_registry(**{
+            'waxe.xml.profiling.threshold': '40',
+            'waxe.xml.profiling.interval': '0.001',
+        })
+        tween = profiling.profiling_tween_factory(self.handler, registry)
+        request = get_request(params={'_xml_filename': 'file1.xml'})
+        self.assertEqual(tween(request), 'response')
+        profiles = registry.xml_profiles.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['kind'], 'folded')
+        self.assertEqual(profiles[0]['path'], 'file1.xml')
+        content = open(registry.xml_profiles.get_path(
+            profiles[0]['name'])).read()
+        self.assertTrue('slow_function' in content)
+
+        # Too fast
+        tween = profiling.profiling_tween_factory(lambda r: 'fast',
+                                                  registry)
+        self.assertEqual(tween(get_request()), 'fast')
+        self.assertEqual(len(registry.xml_profiles.list()), 1)
+
+    def test_save_error(self):
+        registry = self.get_registry(**{'waxe.xml.profiling.percent': '100'})
+        tween = profiling.profiling_tween_factory(self.handler, registry)
+        with patch.object(registry.xml_profiles, 'save',
+                          side_effect=IOError('No space left')):
+            self.assertEqual(tween(get_request()), 'response')
+
+    def test_get_route_name(self):
+        registry = self.get_registry()
+        self.assertEqual(
+            profiling.get_route_name(get_request(), registry), 'edit_json')
+        self.assertEqual(
+            profiling.get_route_name(get_request(None), registry), None)
+
+        # The route is not matched yet
+        route = C()
+        route.name = 'update_json'
+        registry.queryUtility = lambda iface: (
+            lambda request: {'match': {}, 'route': route})
+        self.assertEqual(
+            profiling.get_route_name(get_request(None), registry),
+            'update_json')
+
+    def test_get_tags(self):
+        request = get_request(params={'dtd_url': 'exercise.dtd'})
+        self.assertEqual(profiling.get_tags(request),
+                         {'path': None, 'dtd_url': 'exercise.dtd'})
+        # Not profiled
+        profiling.add_tags(request, path='file1.xml')
+        request.xml_profile_tags = {}
+        profiling.add_tags(request, path='file1.xml')
+        self.assertEqual(profiling.get_tags(request),
+                         {'path': 'file1.xml', 'dtd_url': 'exercise.dtd'})
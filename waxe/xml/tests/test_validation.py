@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from mock import patch
+
+from waxe.xml import validation
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number)>
+<!ELEMENT number (#PCDATA)>
+'''
+
+VALID_XML = ('<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+             '<Exercise><number>1</number></Exercise>')
+INVALID_XML = ('<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+               '<Exercise><unknown/></Exercise>')
+
+
+class TestValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'sub'))
+        os.mkdir(os.path.join(self.path, '.hidden'))
+        for d in ['', 'sub']:
+            open(os.path.join(self.path, d, 'exercise.dtd'), 'w').write(
+                DTD_CONTENT)
+        open(os.path.join(self.path, 'file1.xml'), 'w').write(VALID_XML)
+        open(os.path.join(self.path, 'file2.xml'), 'w').write(INVALID_XML)
+        open(os.path.join(self.path, 'nodtd.xml'), 'w').write('<Exercise/>')
+        open(os.path.join(self.path, 'file.txt'), 'w').write('text')
+        open(os.path.join(self.path, 'sub', 'file3.xml'), 'w').write(
+            VALID_XML)
+        open(os.path.join(self.path, '.hidden', 'file4.xml'), 'w').write(
+            VALID_XML)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_iter_xml_files(self):
+        res = list(validation.iter_xml_files(self.path))
+        expected = [os.path.join(self.path, f) for f in
+                    ['file1.xml', 'file2.xml', 'nodtd.xml', 'sub/file3.xml']]
+        self.assertEqual(res, expected)
+
+    def test_get_dtd_url(self):
+        filename = os.path.join(self.path, 'file1.xml')
+        self.assertEqual(validation.get_dtd_url(filename),
+                         os.path.join(self.path, 'exercise.dtd'))
+        filename = os.path.join(self.path, 'nodtd.xml')
+        self.assertEqual(validation.get_dtd_url(filename), None)
+
+        open(filename, 'w').write(
+            '<?xml version="1.0"?>\n'
+            '<!DOCTYPE Exercise PUBLIC "-//W3C//Exercise" '
+            '\'http://dtd/exercise.dtd\'><Exercise/>')
+        self.assertEqual(validation.get_dtd_url(filename),
+                         'http://dtd/exercise.dtd')
+
+    def test_group_by_dtd(self):
+        groups = validation.group_by_dtd(
+            validation.iter_xml_files(self.path))
+        self.assertEqual(len(groups), 3)
+        self.assertEqual(groups[None],
+                         [os.path.join(self.path, 'nodtd.xml')])
+        self.assertEqual(len(groups[os.path.join(self.path, 'exercise.dtd')]),
+                         2)
+
+    def test_validate_files(self):
+        dtd_url = os.path.join(self.path, 'exercise.dtd')
+        filenames = [os.path.join(self.path, 'file1.xml'),
+                     os.path.join(self.path, 'file2.xml')]
+        res = validation.validate_files(dtd_url, filenames)
+        self.assertEqual(res[0], (filenames[0], None))
+        self.assertEqual(res[1][0], filenames[1])
+        self.assertTrue('unknown' in res[1][1])
+
+        res = validation.validate_files(None, filenames)
+        self.assertEqual(res, [(f, 'No dtd defined') for f in filenames])
+
+        res = validation.validate_files('/unexisting.dtd', filenames[:1])
+        self.assertEqual(len(res), 1)
+        self.assertTrue(res[0][1].startswith(
+            "The dtd /unexisting.dtd can't be loaded"))
+
+    def test_validate_directory(self):
+        for workers in [1, 2]:
+            res = list(validation.validate_directory(self.path,
+                                                     workers=workers,
+                                                     chunk_size=1))
+            self.assertEqual(len(res), 5)
+            summary = res.pop()['summary']
+            self.assertEqual(summary['total'], 4)
+            self.assertEqual(summary['valid'], 2)
+            self.assertEqual(summary['invalid'], 2)
+            self.assertEqual(sorted([d['done'] for d in res]), [1, 2, 3, 4])
+            self.assertEqual(set([d['total'] for d in res]), set([4]))
+            dic = dict([(d['path'], d) for d in res])
+            self.assertEqual(sorted(dic.keys()),
+                             ['file1.xml', 'file2.xml', 'nodtd.xml',
+                              'sub/file3.xml'])
+            self.assertEqual(dic['file1.xml']['valid'], True)
+            self.assertEqual(dic['file1.xml']['error_msg'], None)
+            self.assertEqual(dic['file2.xml']['valid'], False)
+            self.assertEqual(dic['sub/file3.xml']['dtd_url'],
+                             os.path.join(self.path, 'sub', 'exercise.dtd'))
+
+    def test_directory_validator(self):
+        validator = validation.DirectoryValidator(workers=2, chunk_size=1,
+                                                  max_running=1)
+        try:
+            res = list(validator.validate(self.path))
+            self.assertEqual(res[-1]['summary']['total'], 4)
+            pool = validator._pool
+            self.assertTrue(pool is not None)
+            self.assertEqual(validator.running, 0)
+
+            # The pool is shared by the validations
+            results = validator.validate(
+                self.path, wrap=lambda res: (d.keys() for d in res))
+            self.assertTrue(validator._pool is pool)
+            self.assertEqual(validator.running, 1)
+            try:
+                validator.validate(self.path)
+                assert(False)
+            except validation.ValidationBusyError, e:
+                self.assertEqual(
+                    str(e), 'Too many validations are running, try again '
+                    'later')
+            # Closed without being consumed
+            results.close()
+            self.assertEqual(validator.running, 0)
+            results = validator.validate(self.path)
+            next(iter(results))
+            results.close()
+            self.assertEqual(validator.running, 0)
+
+            validator.configure(workers='1', max_running='3')
+            self.assertEqual(validator._pool, None)
+            self.assertEqual(validator.max_running, 3)
+            res = list(validator.validate(self.path))
+            self.assertEqual(res[-1]['summary']['total'], 4)
+            self.assertEqual(validator._pool, None)
+        finally:
+            validator.close()
+
+    def test_main(self):
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            res = validation.main(['-q', '-w', '1', self.path])
+        self.assertEqual(res, 1)
+        lines = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(sorted([l['path'] for l in lines[:2]]),
+                         ['file2.xml', 'nodtd.xml'])
+        self.assertEqual(lines[2]['summary']['invalid'], 2)
@@ -0,0 +1,174 @@
+import os
+import time
+import tempfile
+import unittest
+from urllib2 import URLError
+from mock import patch
+import xmltool
+
+from waxe.xml import workers
+from waxe.xml.workers import WorkerPool, PoolFullError, PoolTimeoutError
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number)>
+<!ELEMENT number (#PCDATA)>
+'''
+
+
+def add(a, b):
+    return a + b
+
+
+def raise_error():
+    raise ValueError('My error')
+
+
+def raise_url_error():
+    raise URLError('Not found')
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool(size=1, threshold=10, timeout=5, max_queue=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_configure(self):
+        pool = WorkerPool()
+        self.assertEqual(pool.enabled, False)
+        self.assertEqual(pool.should_run(1024 * 1024 * 10), False)
+        pool.configure(size='2', threshold='100', timeout='1.5',
+                       max_queue='4')
+        self.assertEqual(pool.enabled, True)
+        self.assertEqual(pool.should_run(99), False)
+        self.assertEqual(pool.should_run(100), True)
+        self.assertEqual(pool.timeout, 1.5)
+        self.assertEqual(pool.max_queue, 4)
+
+    def test_run(self):
+        self.assertEqual(self.pool.run(add, 1, 2), 3)
+        try:
+            self.pool.run(raise_error)
+            assert(False)
+        except Exception, e:
+            self.assertEqual(str(e), 'My error')
+
+        try:
+            self.pool.run(raise_url_error)
+            assert(False)
+        except URLError, e:
+            self.assertTrue('Not found' in str(e))
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_run_timeout(self):
+        self.pool.timeout = 0.1
+        try:
+            self.pool.run(sleep, 1)
+            assert(False)
+        except PoolTimeoutError:
+            pass
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+        # The task still occupies the worker
+        self.assertEqual(self.pool.stats()['pending'], 1)
+        self.assertRaises(PoolFullError, self.pool.run, add, 1, 2)
+
+        time.sleep(1.5)
+        self.assertEqual(self.pool.stats()['pending'], 0)
+        self.assertEqual(self.pool.run(add, 1, 2), 3)
+
+    def test_close(self):
+        self.pool.timeout = 0.1
+        self.assertRaises(PoolTimeoutError, self.pool.run, sleep, 10)
+        self.pool.close()
+        self.assertEqual(self.pool.stats()['pending'], 0)
+        self.assertEqual(self.pool.run(add, 1, 2), 3)
+
+    def test_run_full(self):
+        self.pool.pending = 1
+        try:
+            self.pool.run(add, 1, 2)
+            assert(False)
+        except PoolFullError:
+            pass
+        self.assertEqual(self.pool.stats()['rejected'], 1)
+
+
+class TestTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        open(os.path.join(self.path, 'exercise.dtd'), 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(
+            '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+            '<Exercise><number>1</number></Exercise>')
+
+    def tearDown(self):
+        os.remove(os.path.join(self.path, 'exercise.dtd'))
+        os.remove(self.filename)
+        os.rmdir(self.path)
+
+    def test_render_file(self):
+        payload, dtd_url = workers.render_file(
+            self.filename, 'file.xml', {'data-action': '/update'})
+        self.assertEqual(dtd_url, 'exercise.dtd')
+        self.assertEqual(sorted(payload.keys()), ['content', 'jstree_data'])
+        self.assertTrue('data-action="/update"' in payload['content'])
+        self.assertTrue('contenteditable="true"' in payload['content'])
+
+        pool = WorkerPool(size=1)
+        try:
+            res = pool.run(workers.render_file, self.filename, 'file.xml',
+                           {'data-action': '/update'})
+        finally:
+            pool.close()
+        self.assertEqual(res, (payload, dtd_url))
+
+        with patch('waxe.xml.workers.get_html_renderer') as m:
+            res = workers.load_and_render(
+                self.filename, 'file.xml', {'data-action': '/update'},
+                xmltool.render.Render())
+        self.assertEqual(m.call_count, 0)
+        self.assertTrue('contenteditable="true"' not in res[0]['content'])
+
+    def test_render_file_outline(self):
+        payload, dtd_url = workers.render_file(
+            self.filename, 'file.xml', {'data-action': '/update'},
+            outline=True)
+        self.assertEqual(sorted(payload.keys()), ['content', 'outline'])
+        self.assertEqual(payload['outline']['tags'], ['Exercise', 'number'])
+        self.assertEqual(payload['outline']['parents'], [-1, 0])
+
+    def test_check_string(self):
+        workers.check_string(
+            '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+            '<Exercise><number>1</number></Exercise>', self.path)
+        try:
+            workers.check_string(
+                '<!DOCTYPE Exercise SYSTEM "exercise.dtd">'
+                '<Exercise></Exercise>', self.path)
+            assert(False)
+        except Exception:
+            pass
+
+    def test_validate_string(self):
+        workers.validate_string(
+            '<!DOCTYPE Exercise SYSTEM "%s/exercise.dtd">'
+            '<Exercise><number>1</number></Exercise>' % self.path)
+        try:
+            workers.validate_string('<Exercise>')
+            assert(False)
+        except Exception:
+            pass
@@ -0,0 +1,224 @@
+import os
+import stat
+import time
+import tempfile
+import unittest
+import threading
+from mock import patch
+import xmltool
+
+from waxe.xml import writer
+
+
+DTD_CONTENT = '''
+<!ELEMENT Exercise (number)>
+<!ELEMENT number (#PCDATA)>
+'''
+
+XML_CONTENT = '''<?xml version='1.0' encoding='UTF-8'?>
+<!DOCTYPE Exercise SYSTEM "exercise.dtd">
+<Exercise>
+  <number>1</number>
+</Exercise>
+'''
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.dtd_url = os.path.join(self.path, 'exercise.dtd')
+        open(self.dtd_url, 'w').write(DTD_CONTENT)
+        self.filename = os.path.join(self.path, 'file.xml')
+        open(self.filename, 'w').write(XML_CONTENT)
+        os.chmod(self.filename, 0640)
+
+    def tearDown(self):
+        for f in os.listdir(self.path):
+            os.remove(os.path.join(self.path, f))
+        os.rmdir(self.path)
+
+    def test_write_obj(self):
+        obj = xmltool.load(self.filename)
+        obj['number'].text = '2'
+        writer.write_obj(obj, self.filename)
+        self.assertEqual(open(self.filename).read(),
+                         XML_CONTENT.replace('>1<', '>2<'))
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0640)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['exercise.dtd', 'file.xml'])
+
+        filename = os.path.join(self.path, 'new.xml')
+        writer.write_obj(obj, filename, transform=lambda s: s.upper())
+        self.assertEqual(open(filename).read(),
+                         XML_CONTENT.replace('>1<', '>2<').upper())
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode),
+                         writer.DEFAULT_FILE_MODE)
+
+    def test_write_obj_error(self):
+        obj = xmltool.load(self.filename)
+        obj['number'].text = '2'
+        with patch('os.rename', side_effect=OSError('My error')):
+            try:
+                writer.write_obj(obj, self.filename)
+                assert(False)
+            except OSError, e:
+                self.assertEqual(str(e), 'My error')
+        # The file is not modified and the temporary file is removed
+        self.assertEqual(open(self.filename).read(), XML_CONTENT)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['exercise.dtd', 'file.xml'])
+
+    def test_write_obj_fsync(self):
+        obj = xmltool.load(self.filename)
+        obj['number'].text = '2'
+        with patch('os.fsync') as m:
+            writer.write_obj(obj, self.filename)
+            self.assertEqual(m.call_count, 0)
+            writer.write_obj(obj, self.filename, fsync=True)
+            # The file and its directory
+            self.assertEqual(m.call_count, 2)
+        self.assertEqual(open(self.filename).read(),
+                         XML_CONTENT.replace('>1<', '>2<'))
+
+    def test_atomic_write_error(self):
+        def write(tmpname):
+            open(tmpname, 'w').write('<Exercise>')
+            raise Exception('Invalid')
+
+        self.assertRaises(Exception, writer.atomic_write, self.filename,
+                          write)
+        self.assertEqual(open(self.filename).read(), XML_CONTENT)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['exercise.dtd', 'file.xml'])
+
+
+class TestWriteCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'file.xml')
+        self.writes = []
+
+    def tearDown(self):
+        for f in os.listdir(self.path):
+            os.remove(os.path.join(self.path, f))
+        os.rmdir(self.path)
+
+    def get_write(self, content, delay=0):
+        def write(tmpname):
+            time.sleep(delay)
+            self.writes.append(content)
+            open(tmpname, 'w').write(content)
+        return write
+
+    def save_all(self, coalescer, contents):
+        """Save the contents concurrently, returns the results in the same
+        order.
+        """
+        results = [None] * len(contents)
+
+        def save(i):
+            try:
+                results[i] = coalescer.write(self.filename,
+                                             self.get_write(contents[i]))
+            except Exception, e:
+                results[i] = e
+
+        threads = []
+        for i in range(len(contents)):
+            thread = threading.Thread(target=save, args=(i,))
+            thread.start()
+            threads.append(thread)
+            # Keep the order of the saves
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_write(self):
+        coalescer = writer.WriteCoalescer()
+        self.assertEqual(coalescer.write(self.filename,
+                                         self.get_write('v1')), True)
+        self.assertEqual(coalescer.write(self.filename,
+                                         self.get_write('v2')), True)
+        self.assertEqual(self.writes, ['v1', 'v2'])
+        self.assertEqual(open(self.filename).read(), 'v2')
+        self.assertEqual(coalescer.stats(), {'saves': 2, 'writes': 2})
+
+    def test_write_after(self):
+        coalescer = writer.WriteCoalescer()
+        lock = coalescer.path_lock(self.filename)
+        self.assertTrue(coalescer.path_lock(self.filename) is lock)
+        calls = []
+
+        def after():
+            # The file is written and the path is still locked
+            calls.append(open(self.filename).read())
+            self.assertFalse(lock.acquire(False))
+
+        self.assertEqual(coalescer.write(self.filename, self.get_write('v1'),
+                                         after), True)
+        self.assertEqual(calls, ['v1'])
+        self.assertTrue(lock.acquire(False))
+        lock.release()
+
+        def write(tmpname):
+            raise IOError('No space left')
+
+        try:
+            coalescer.write(self.filename, write, after)
+            assert(False)
+        except IOError:
+            pass
+        # Nothing has been written
+        self.assertEqual(calls, ['v1'])
+
+    def test_coalesce(self):
+        coalescer = writer.WriteCoalescer(window=0.2)
+        results = self.save_all(coalescer, ['v1', 'v2', 'v3'])
+        self.assertEqual(results, [False, False, True])
+        self.assertEqual(self.writes, ['v3'])
+        self.assertEqual(open(self.filename).read(), 'v3')
+        self.assertEqual(coalescer.stats(), {'saves': 3, 'writes': 1})
+
+        # A new window
+        self.assertEqual(coalescer.write(self.filename,
+                                         self.get_write('v4')), True)
+        self.assertEqual(self.writes, ['v3', 'v4'])
+
+    def test_coalesce_error(self):
+        coalescer = writer.WriteCoalescer(window=0.2)
+
+        def write(tmpname):
+            raise IOError('No space left')
+
+        results = [None, None]
+
+        def save():
+            try:
+                results[0] = coalescer.write(self.filename,
+                                             self.get_write('v1'))
+            except IOError, e:
+                results[0] = e
+
+        thread = threading.Thread(target=save)
+        thread.start()
+        time.sleep(0.05)
+        try:
+            coalescer.write(self.filename, write)
+            assert(False)
+        except IOError, e:
+            results[1] = e
+        thread.join()
+        self.assertTrue(results[0] is results[1])
+        self.assertEqual(self.writes, [])
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_configure(self):
+        coalescer = writer.WriteCoalescer()
+        coalescer.configure(window='0.5', fsync=True)
+        self.assertEqual(coalescer.window, 0.5)
+        self.assertEqual(coalescer.fsync, True)
+        coalescer.configure()
+        self.assertEqual(coalescer.window, 0.5)
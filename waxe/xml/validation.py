@@ -0,0 +1,326 @@
+"""Validate all the XML files of a directory against their dtd.
+
+The files are grouped by dtd and validated by chunks in a process pool, each
+process keeps its own dtd cache so a dtd is parsed once per process. The
+requests share the pool of directory_validator which limits the number of
+directories validated at the same time.
+"""
+import os
+import re
+import sys
+import json
+import time
+import threading
+import multiprocessing
+from optparse import OptionParser
+from lxml import etree
+
+import waxe.xml
+from waxe.xml.cache import dtd_cache, resolve_dtd_url
+
+
+DEFAULT_WORKERS = 2
+DEFAULT_CHUNK_SIZE = 50
+# The number of directories validated at the same time by the requests
+DEFAULT_MAX_RUNNING = 2
+# We only read the beginning of the files to find the dtd
+HEADER_SIZE = 4096
+
+DOCTYPE_REGEX = re.compile(
+    r'<!DOCTYPE\s+\S+\s+(?:SYSTEM|PUBLIC\s+(?:"[^"]*"|\'[^\']*\'))\s+'
+    r'(?:"([^"]*)"|\'([^\']*)\')')
+
+
+class ValidationBusyError(Exception):
+    pass
+
+
+def iter_xml_files(path, extensions=None):
+    """Yields the absolute path of the XML files in path, recursively
+    """
+    if extensions is None:
+        extensions = waxe.xml.EXTENSIONS
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted([d for d in dirnames if not d.startswith('.')])
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            if os.path.splitext(filename)[1] in extensions:
+                yield os.path.join(dirpath, filename)
+
+
+def get_dtd_url(filename):
+    """Returns the resolved dtd url of filename without parsing the whole file
+    or None if there is no doctype.
+    """
+    f = open(filename, 'r')
+    try:
+        header = f.read(HEADER_SIZE)
+    finally:
+        f.close()
+    m = DOCTYPE_REGEX.search(header)
+    if not m:
+        return None
+    url = m.group(1) if m.group(1) is not None else m.group(2)
+    return resolve_dtd_url(url, os.path.dirname(filename))
+
+
+def group_by_dtd(filenames):
+    """Returns a dict {dtd_url: [filename, ...]}, the files without dtd are
+    in the None key.
+    """
+    groups = {}
+    for filename in filenames:
+        try:
+            dtd_url = get_dtd_url(filename)
+        except IOError:
+            dtd_url = None
+        groups.setdefault(dtd_url, []).append(filename)
+    return groups
+
+
+def validate_files(dtd_url, filenames):
+    """Validate the given files against the dtd.
+
+    This function is run in the pool, the result should be picklable.
+
+    :return: the list of (filename, error_msg), error_msg is None for the
+        valid files
+    """
+    if dtd_url is None:
+        return [(filename, 'No dtd defined') for filename in filenames]
+
+    try:
+        entry = dtd_cache.get(dtd_url)
+    except Exception, e:
+        msg = "The dtd %s can't be loaded: %s" % (dtd_url, e)
+        return [(filename, msg) for filename in filenames]
+
+    parser = etree.XMLParser(strip_cdata=False)
+    results = []
+    for filename in filenames:
+        try:
+            tree = etree.parse(filename, parser=parser)
+            entry.validate(tree)
+            results.append((filename, None))
+        except Exception, e:
+            results.append((filename, str(e)))
+    return results
+
+
+def _validate_chunk(args):
+    return validate_files(*args)
+
+
+def iter_chunks(groups, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields (dtd_url, filenames) with at most chunk_size files
+    """
+    for dtd_url in sorted(groups, key=lambda url: url or ''):
+        filenames = groups[dtd_url]
+        for i in range(0, len(filenames), chunk_size):
+            yield dtd_url, filenames[i:i + chunk_size]
+
+
+def validate_directory(path, workers=DEFAULT_WORKERS,
+                       chunk_size=DEFAULT_CHUNK_SIZE, relpath=None, pool=None):
+    """Validate all the XML files of path.
+
+    Yields a dict for each file with the progress counters, the last
+    dict contains the summary:
+
+        {'path': ..., 'dtd_url': ..., 'valid': ..., 'error_msg': ...,
+         'done': 1, 'total': 10}
+        ...
+        {'summary': {'total': 10, 'valid': 9, 'invalid': 1,
+                     'elapsed': 0.5, 'files_per_second': 20.0}}
+
+    :param relpath: function used to display the path of the files, by
+        default the path is relative to the given path.
+    :param pool: the process pool to use, by default a pool of workers
+        processes is created for this validation.
+    """
+    start = time.time()
+    if relpath is None:
+        relpath = lambda filename: os.path.relpath(filename, path)
+
+    groups = group_by_dtd(iter_xml_files(path))
+    total = sum([len(filenames) for filenames in groups.values()])
+    dtd_urls = {}
+    chunks = []
+    for dtd_url, filenames in iter_chunks(groups, chunk_size):
+        chunks.append((dtd_url, filenames))
+        for filename in filenames:
+            dtd_urls[filename] = dtd_url
+
+    own_pool = None
+    if pool is None and workers > 1 and len(chunks) > 1:
+        pool = own_pool = multiprocessing.Pool(min(workers, len(chunks)))
+    if pool is not None and len(chunks) > 1:
+        results = pool.imap_unordered(_validate_chunk, chunks)
+    else:
+        results = (_validate_chunk(chunk) for chunk in chunks)
+
+    done = 0
+    nb_valid = 0
+    try:
+        for chunk_results in results:
+            for filename, error_msg in chunk_results:
+                done += 1
+                if error_msg is None:
+                    nb_valid += 1
+                yield {
+                    'path': relpath(filename),
+                    'dtd_url': dtd_urls[filename],
+                    'valid': error_msg is None,
+                    'error_msg': error_msg,
+                    'done': done,
+                    'total': total,
+                }
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+
+    elapsed = time.time() - start
+    yield {
+        'summary': {
+            'total': total,
+            'valid': nb_valid,
+            'invalid': total - nb_valid,
+            'elapsed': elapsed,
+            'files_per_second': (total / elapsed) if elapsed else 0,
+        }
+    }
+
+
+class _Results(object):
+    """The results of a validation of DirectoryValidator, the validation is
+    released when they are consumed or closed. It can be used as WSGI
+    app_iter: close is called even if the iteration is not started.
+    """
+
+    def __init__(self, validator, results):
+        self.validator = validator
+        self.results = results
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for res in self.results:
+                yield res
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.validator.release()
+
+
+class DirectoryValidator(object):
+    """Validate the directories of the requests in a process pool shared by
+    the requests.
+
+    ValidationBusyError is raised when max_running directories are already
+    being validated.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_running=DEFAULT_MAX_RUNNING):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_running = max_running
+        self.running = 0
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, workers=None, chunk_size=None, max_running=None):
+        if workers is not None:
+            self.workers = int(workers)
+        if chunk_size is not None:
+            self.chunk_size = int(chunk_size)
+        if max_running is not None:
+            self.max_running = int(max_running)
+        self.close()
+
+    def _get_pool(self):
+        if self.workers <= 1:
+            return None
+        # Don't use a pool created by another process, it happens when the
+        # server forks after the configuration.
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = multiprocessing.Pool(self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+            self._pid = None
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+
+    def validate(self, path, relpath=None, wrap=None):
+        """Same as validate_directory, the results should be consumed or
+        closed to release the validation.
+
+        :param wrap: function receiving the iterator of the results and
+            returning the iterator to use, to serialize them for example
+        """
+        with self._lock:
+            if self.running >= self.max_running:
+                raise ValidationBusyError(
+                    'Too many validations are running, try again later')
+            self.running += 1
+            try:
+                pool = self._get_pool()
+            except Exception:
+                self.running -= 1
+                raise
+        results = validate_directory(path, self.workers, self.chunk_size,
+                                     relpath, pool=pool)
+        if wrap is not None:
+            results = wrap(results)
+        return _Results(self, results)
+
+
+directory_validator = DirectoryValidator()
+
+
+def main(argv=None):
+    """Console entry point: validate the XML files of the given directory
+    and write the results as JSON lines.
+    """
+    parser = OptionParser(usage='%prog [options] directory')
+    parser.add_option('-w', '--workers', type='int', default=DEFAULT_WORKERS,
+                      help='number of processes [default: %default]')
+    parser.add_option('-c', '--chunk-size', type='int',
+                      default=DEFAULT_CHUNK_SIZE,
+                      help='number of files validated by task '
+                           '[default: %default]')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      help="don't write the valid files")
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('A directory is required')
+    if not os.path.isdir(args[0]):
+        parser.error('%s is not a directory' % args[0])
+
+    invalid = 0
+    for dic in validate_directory(args[0], options.workers,
+                                  options.chunk_size):
+        if 'summary' in dic:
+            invalid = dic['summary']['invalid']
+        elif options.quiet and dic['valid']:
+            continue
+        sys.stdout.write(json.dumps(dic) + '\n')
+        sys.stdout.flush()
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,17 @@
 import os
-import tempfile
 import xmltool
-from xmltool import dtd, render as xt_render
+from xmltool import render as xt_render
 from lxml import etree
 import json
-import importlib
+from multiprocessing.pool import ThreadPool
 
 from urllib2 import HTTPError, URLError
 from pyramid.view import view_config
-from pyramid.renderers import render, Response
+from pyramid.renderers import Response
+from pyramid.events import BeforeRender, ApplicationCreated
+from pyramid.response import FileResponse
+from pyramid.settings import asbool
+from pyramid.exceptions import ConfigurationError
 import pyramid.httpexceptions as exc
 from waxe.core import browser, utils, resource, events
 from waxe.core.views.base import BaseUserView
@@ -17,33 +20,50 @@ import pyramid_logging
 log = pyramid_logging.getLogger(__name__)
 
 import waxe.xml
+from waxe.xml import form, delta, writer, workers, validation, clipboard
+from waxe.xml import journal
+from waxe.xml.plugins import PluginIndex, load_plugins
+from waxe.xml.hooks import get_hook
+from waxe.xml.metrics import phase, get_metrics_sink, start_serialize
+from waxe.xml import conditional, profiling, fetcher, diskcache, cache
+from waxe.xml.comment import get_comment_modal, warm_comment_modal
+from waxe.xml.fetcher import dtd_fetcher
+from waxe.xml.diskcache import DTDDiskCache
+from waxe.xml.workers import worker_pool, PoolFullError, PoolTimeoutError
+from waxe.xml.validation import directory_validator
+from waxe.xml.cache import (
+    dtd_cache,
+    form_cache,
+    document_cache,
+    element_cache,
+    CachedDocument,
+    renderer_cache,
+    get_file_stamp,
+    resolve_dtd_url,
+    DEFAULT_PREFETCH_WORKERS,
+)
 
 EXTENSIONS = waxe.xml.EXTENSIONS
 ROUTE_PREFIX = waxe.xml.ROUTE_PREFIX
 
+DEFAULT_LAZY_DEPTH = 1
+DEFAULT_BATCH_MAX_FILES = 20
+DEFAULT_BATCH_WORKERS = 4
+TEXT_VALIDATION_TIERED = 'tiered'
+TEXT_VALIDATION_FULL = 'full'
+TEXT_VALIDATION_MODES = (TEXT_VALIDATION_TIERED, TEXT_VALIDATION_FULL)
 
-def _get_tags(dtd_url, text=False):
-    dic = dtd.DTD(url=dtd_url).parse()
-    lis = []
-    texts = []
-    for k, v in dic.items():
-        if issubclass(v, xmltool.elements.TextElement):
-            texts += [k]
-        else:
-            lis += [k]
-
-    if text is True:
-        l = texts
-    else:
-        l = lis
 
-    l.sort()
-    return l
+def _get_tags(dtd_url, text=False):
+    return dtd_cache.get_tags(dtd_url, text=text)
 
 
 # Basic plugin system
 def match(request, str_id, dtd_url):
-    for plugin in request.xml_plugins:
+    plugins = request.xml_plugins
+    if isinstance(plugins, PluginIndex):
+        return plugins.match(request, str_id, dtd_url)
+    for plugin in plugins:
         if plugin.match(request, str_id, dtd_url):
             return plugin
 
@@ -56,53 +76,380 @@ def add_element(request, str_id, dtd_url):
 # end Basic plugin system
 
 
+def get_text_validation(settings):
+    """How the XML files saved as text are validated:
+
+    * tiered: the content is parsed by lxml and validated against the cached
+      dtd, the xmltool object is only created if there is a transform,
+    * full: the xmltool object is always created.
+    """
+    mode = settings.get('waxe.xml.text_validation', TEXT_VALIDATION_TIERED)
+    if mode not in TEXT_VALIDATION_MODES:
+        raise ConfigurationError(
+            'waxe.xml.text_validation should be one of %s' % ', '.join(
+                TEXT_VALIDATION_MODES))
+    return mode
+
+
 def is_valid_filecontent(view, path, filecontent):
     if not os.path.splitext(path)[1] == '.xml':
         return view, path, filecontent
 
     try:
-        xmltool.load_string(filecontent)
         transform = view.request.xmltool_transform
+        mode = get_text_validation(view.request.registry.settings)
+        # The transforms have always received a content loadable by
+        # xmltool, the full load also validates the content.
+        if mode == TEXT_VALIDATION_FULL or transform:
+            func, args = workers.validate_string, (filecontent,)
+        else:
+            absfilename = browser.absolute_path(path, view.root_path)
+            func, args = (workers.check_string,
+                          (filecontent, os.path.dirname(absfilename)))
+        if worker_pool.should_run(len(filecontent)):
+            worker_pool.run(func, *args)
+        else:
+            func(*args)
         if transform:
-            return view, path, transform(filecontent)
+            with phase('transform'):
+                return view, path, transform(filecontent)
         return view, path, filecontent
+    except (PoolFullError, PoolTimeoutError), e:
+        raise exc.HTTPServiceUnavailable(str(e))
     except Exception, e:
         raise exc.HTTPInternalServerError(str(e))
 
 
 class EditorView(BaseUserView):
 
+    def _get_html_renderer_func(self):
+        return get_hook(self.request.registry.settings,
+                        'waxe.xml.xmltool.renderer_func')
+
     def _get_html_renderer(self):
-        if 'waxe.xml.xmltool.renderer_func' not in self.request.registry.settings:
+        func = self._get_html_renderer_func()
+        if func is None:
             return xt_render.ContenteditableRender()
+        return renderer_cache.get(func, self.current_user.login)
 
-        func = self.request.registry.settings['waxe.xml.xmltool.renderer_func']
-        mod, func = func.rsplit('.', 1)
-        return getattr(importlib.import_module(mod), func)(
-            self.current_user.login)
+    def _get_html_renderer_key(self):
+        """Identify the renderer returned by _get_html_renderer
+        """
+        func = self.request.registry.settings.get(
+            'waxe.xml.xmltool.renderer_func')
+        if not func:
+            return None
+        return (func, self.current_user.login)
+
+    def _get_form_attrs(self):
+        return {
+            'data-add-href': self.request.custom_route_path('add_element_json'),
+            'data-comment-href': self.request.custom_route_path('get_comment_modal_json'),
+            'data-action': self.request.custom_route_path('update_json'),
+            'data-copy-href': self.request.custom_route_path('copy_json'),
+            'data-paste-href': self.request.custom_route_path('paste_json'),
+        }
+
+    def _should_use_worker_pool(self, absfilename):
+        return (worker_pool.enabled and
+                worker_pool.should_run(os.path.getsize(absfilename)))
+
+    def _render_file(self, absfilename, form_filename=None, outline=False):
+        """Returns the edit payload of the file and its dtd url. The big
+        files are rendered in the worker pool.
+        """
+        form_attrs = self._get_form_attrs()
+        if self._should_use_worker_pool(absfilename):
+            func = self._get_html_renderer_func()
+            login = self.current_user.login if func else None
+            return worker_pool.run(workers.render_file, absfilename,
+                                   form_filename, form_attrs, func, login,
+                                   outline)
+        return workers.load_and_render(absfilename, form_filename,
+                                       form_attrs, self._get_html_renderer(),
+                                       outline)
+
+    def _get_form_cache_key(self, filename, outline=False):
+        return (filename,
+                self._get_html_renderer_key(),
+                tuple(sorted(self._get_form_attrs().items())),
+                outline)
+
+    def _conditional_response(self, etag, max_age=None):
+        """Set the cache headers of the response. Returns a HTTPNotModified
+        if the client already has the version etag, None otherwise.
+        """
+        if max_age is None:
+            public = False
+        else:
+            settings = self.request.registry.settings
+            max_age = int(settings.get('waxe.xml.http_cache.max_age',
+                                       max_age))
+            public = asbool(settings.get('waxe.xml.http_cache.public'))
+        cache_control = conditional.get_cache_control(max_age, public)
+        if conditional.is_not_modified(self.request, etag):
+            response = exc.HTTPNotModified()
+        else:
+            response = None
+        conditional.set_cache_headers(response or self.request.response,
+                                      etag, cache_control)
+        return response
+
+    def _is_compact(self):
+        return asbool(self.request.GET.get('compact'))
+
+    def _is_outline(self):
+        """The client wants the jstree data as a compact outline, see
+        form.outline_obj
+        """
+        return asbool(self.request.GET.get('outline'))
+
+    def _compact_response(self, obj):
+        """The payload of the compact mode: the form is sent as structured
+        data, see form.compact_obj, and the JSON is minified.
+        """
+        response = self.request.response
+        response.content_type = 'application/json'
+        with phase('render'):
+            compact = form.compact_obj(obj)
+        with phase('serialize'):
+            response.body = json.dumps({
+                'dtd_url': obj.dtd_url,
+                'encoding': getattr(obj, 'encoding', None),
+                'compact': compact,
+            }, separators=(',', ':'))
+        return response
+
+    def _get_edit_etag(self, absfilename, filename):
+        """The ETag of the edit payload: it changes when the file, its dtd
+        or the renderer change. Returns None if it can't be computed, the
+        error will be raised when rendering the file.
+        """
+        try:
+            stamp = get_file_stamp(absfilename)
+            dtd_url = validation.get_dtd_url(absfilename)
+            if not dtd_url:
+                return None
+            profiling.add_tags(self.request, dtd_url=dtd_url)
+            fingerprint = dtd_cache.get(dtd_url).fingerprint
+        except Exception:
+            return None
+        return conditional.make_etag(
+            'edit', stamp, fingerprint,
+            self._get_form_cache_key(filename), self._is_compact(),
+            self._is_outline())
 
     @view_config(route_name='edit_json')
     def edit(self):
+        filename = self.request.GET.get('path')
+        if not filename:
+            raise exc.HTTPClientError('No filename given')
+        root_path = self.root_path
+        absfilename = browser.absolute_path(filename, root_path)
+        etag = self._get_edit_etag(absfilename, filename)
+        if etag:
+            response = self._conditional_response(etag)
+            if response:
+                self.add_opened_file(filename)
+                return response
+        try:
+            if self._is_compact():
+                with phase('load'):
+                    obj = dtd_cache.load(absfilename)
+                res = self._compact_response(obj)
+                self.add_opened_file(filename)
+                return res
+
+            res = None
+            outline = self._is_outline()
+            if form_cache.enabled:
+                stamp = get_file_stamp(absfilename)
+                cache_key = self._get_form_cache_key(filename, outline)
+                res = form_cache.get(absfilename, stamp, cache_key)
+
+            if res is None:
+                res, dtd_url = self._render_file(absfilename, filename,
+                                                 outline)
+                if form_cache.enabled:
+                    dtd_url = resolve_dtd_url(dtd_url,
+                                              os.path.dirname(absfilename))
+                    form_cache.set(absfilename, stamp, cache_key, dtd_url,
+                                   res)
+        except (PoolFullError, PoolTimeoutError), e:
+            raise exc.HTTPServiceUnavailable(str(e))
+        except (HTTPError, URLError), e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(
+                "The dtd of %s can't be loaded." % filename)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(str(e))
+
+        self.add_opened_file(filename)
+        return res
+
+    def _edit_batch_file(self, filename, absfilename, cache_key, form_attrs,
+                         renderer_func, login, html_renderer):
+        """Returns the edit payload of filename or its error message. The dtd
+        comes from the dtd cache and the renderer is shared by the files.
+
+        This method is called in a thread: the request and the user are not
+        used here.
+        """
+        try:
+            res = None
+            if form_cache.enabled:
+                stamp = get_file_stamp(absfilename)
+                res = form_cache.get(absfilename, stamp, cache_key)
+
+            if res is None:
+                if self._should_use_worker_pool(absfilename):
+                    res, dtd_url = worker_pool.run(
+                        workers.render_file, absfilename, filename,
+                        form_attrs, renderer_func, login)
+                else:
+                    obj = dtd_cache.load(absfilename)
+                    res = workers.render_obj(obj, filename, form_attrs,
+                                             html_renderer)
+                    dtd_url = obj.dtd_url
+                if form_cache.enabled:
+                    dtd_url = resolve_dtd_url(dtd_url,
+                                              os.path.dirname(absfilename))
+                    form_cache.set(absfilename, stamp, cache_key, dtd_url,
+                                   res)
+        except (PoolFullError, PoolTimeoutError), e:
+            return {'path': filename, 'error_msg': str(e)}
+        except (HTTPError, URLError), e:
+            log.exception(e)
+            return {'path': filename,
+                    'error_msg': "The dtd of %s can't be loaded." % filename}
+        except Exception, e:
+            log.exception(e)
+            return {'path': filename, 'error_msg': str(e)}
+
+        res = dict(res)
+        res['path'] = filename
+        return res
+
+    @view_config(route_name='edit_batch_json')
+    def edit_batch(self):
+        """Same as edit for many files, the files are loaded in parallel.
+        Each item of the result contains the path and the edit payload or the
+        error_msg of the file.
+        """
+        filenames = self.request.GET.getall('paths')
+        if not filenames:
+            raise exc.HTTPClientError('No filename given')
+        settings = self.request.registry.settings
+        max_files = int(settings.get('waxe.xml.edit_batch.max_files',
+                                     DEFAULT_BATCH_MAX_FILES))
+        if len(filenames) > max_files:
+            raise exc.HTTPClientError(
+                'Too many files, the maximum is %i' % max_files)
+
+        # Everything which depends on the request is computed once here
+        root_path = self.root_path
+        form_attrs = self._get_form_attrs()
+        func = self._get_html_renderer_func()
+        login = self.current_user.login if func else None
+        html_renderer = self._get_html_renderer()
+        args = [(filename,
+                 browser.absolute_path(filename, root_path),
+                 self._get_form_cache_key(filename))
+                for filename in filenames]
+
+        def edit_file(arg):
+            filename, absfilename, cache_key = arg
+            return self._edit_batch_file(filename, absfilename, cache_key,
+                                         form_attrs, func, login,
+                                         html_renderer)
+
+        nb_workers = int(settings.get('waxe.xml.edit_batch.workers',
+                                      DEFAULT_BATCH_WORKERS))
+        nb_workers = max(1, min(nb_workers, len(filenames)))
+        if nb_workers == 1:
+            files = map(edit_file, args)
+        else:
+            pool = ThreadPool(nb_workers)
+            try:
+                files = pool.map(edit_file, args)
+            finally:
+                pool.close()
+                pool.join()
+
+        for dic in files:
+            if 'error_msg' not in dic:
+                self.add_opened_file(dic['path'])
+        return {'files': files}
+
+    def _iter_edit_stream(self, jstree_line, chunks):
+        yield jstree_line
+        try:
+            for html in chunks:
+                yield json.dumps({'content': html}) + '\n'
+        except Exception, e:
+            # The response has already started, we can't change the status
+            log.exception(e, request=self.request)
+            yield json.dumps({'error_msg': str(e)}) + '\n'
+
+    @view_config(route_name='edit_stream_json')
+    def edit_stream(self):
+        """Same as edit but the response is streamed as JSON lines: the first
+        line contains the jstree_data, the following ones contain the form
+        content by top-level subtree.
+        """
         filename = self.request.GET.get('path')
         if not filename:
             raise exc.HTTPClientError('No filename given')
         root_path = self.root_path
         absfilename = browser.absolute_path(filename, root_path)
         try:
-            obj = xmltool.load(absfilename)
+            obj = dtd_cache.load(absfilename)
             obj.root.html_renderer = self._get_html_renderer()
-            html = xmltool.generate_form_from_obj(
-                obj,
-                form_filename=filename,
-                form_attrs={
-                    'data-add-href': self.request.custom_route_path('add_element_json'),
-                    'data-comment-href': self.request.custom_route_path('get_comment_modal_json'),
-                    'data-action': self.request.custom_route_path('update_json'),
-                    'data-copy-href': self.request.custom_route_path('copy_json'),
-                    'data-paste-href': self.request.custom_route_path('paste_json'),
-                }
-            )
-            jstree_data = obj.to_jstree_dict()
+            jstree_line = json.dumps(
+                {'jstree_data': obj.to_jstree_dict()}) + '\n'
+        except (HTTPError, URLError), e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(
+                "The dtd of %s can't be loaded." % filename)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(str(e))
+
+        self.add_opened_file(filename)
+        chunks = form.iter_form_from_obj(
+            obj,
+            form_filename=filename,
+            form_attrs=self._get_form_attrs())
+        return Response(
+            app_iter=self._iter_edit_stream(jstree_line, chunks),
+            content_type='application/x-ndjson')
+
+    def _get_lazy_depth(self):
+        return int(self.request.registry.settings.get(
+            'waxe.xml.lazy_depth', DEFAULT_LAZY_DEPTH))
+
+    @view_config(route_name='edit_lazy_json')
+    def edit_lazy(self):
+        """Same as edit but only the first levels of the form are rendered,
+        the deeper elements should be fetched with get_element_json.
+        """
+        filename = self.request.GET.get('path')
+        if not filename:
+            raise exc.HTTPClientError('No filename given')
+        root_path = self.root_path
+        absfilename = browser.absolute_path(filename, root_path)
+        try:
+            doc = document_cache.load(absfilename)
+            with doc.lock:
+                obj = doc.obj
+                obj.root.html_renderer = self._get_html_renderer()
+                html = form.lazy_form_from_obj(
+                    obj,
+                    self._get_lazy_depth(),
+                    form_filename=filename,
+                    form_attrs=self._get_form_attrs())
+                jstree_data = obj.to_jstree_dict()
         except (HTTPError, URLError), e:
             log.exception(e, request=self.request)
             raise exc.HTTPInternalServerError(
@@ -117,12 +464,89 @@ class EditorView(BaseUserView):
             'jstree_data': jstree_data,
         }
 
+    @view_config(route_name='get_element_json')
+    def get_element_json(self):
+        """Get the HTML of the element elt_id of the file, used to replace
+        the placeholders of the lazy forms.
+        """
+        filename = self.request.GET.get('path')
+        elt_id = self.request.GET.get('elt_id')
+        if not filename or not elt_id:
+            return {'error_msg': 'Bad parameter'}
+        root_path = self.root_path
+        absfilename = browser.absolute_path(filename, root_path)
+        try:
+            doc = document_cache.load(absfilename)
+            with doc.lock:
+                obj = doc.obj
+                try:
+                    elt = form.get_obj_from_str_id(obj, elt_id)
+                except KeyError:
+                    return {'error_msg': 'Element %s not found' % elt_id}
+                obj.root.html_renderer = self._get_html_renderer()
+                if isinstance(elt, xmltool.elements.ContainerElement):
+                    html = form.lazy_container_html(elt,
+                                                    self._get_lazy_depth())
+                else:
+                    html = elt.to_html()
+        except (HTTPError, URLError), e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(
+                "The dtd of %s can't be loaded." % filename)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(str(e))
+
+        return {
+            'elt_id': elt_id,
+            'html': html,
+        }
+
+    def _iter_validation(self, results):
+        try:
+            for dic in results:
+                yield json.dumps(dic) + '\n'
+        except Exception, e:
+            # The response has already started, we can't change the status
+            log.exception(e, request=self.request)
+            yield json.dumps({'error_msg': str(e)}) + '\n'
+
+    @view_config(route_name='validate_json')
+    def validate(self):
+        """Validate all the XML files of the given directory (the root path
+        by default). The results are streamed as JSON lines, one by file, the
+        last line contains the summary. The validations share the pool of
+        directory_validator.
+        """
+        root_path = self.root_path
+        relpath = self.request.GET.get('path') or ''
+        abspath = browser.absolute_path(relpath, root_path)
+        if not os.path.isdir(abspath):
+            raise exc.HTTPClientError('Directory %s not found' % relpath)
+
+        try:
+            app_iter = directory_validator.validate(
+                abspath,
+                relpath=lambda filename: os.path.relpath(filename, root_path),
+                wrap=self._iter_validation)
+        except validation.ValidationBusyError, e:
+            raise exc.HTTPServiceUnavailable(str(e))
+        return Response(
+            app_iter=app_iter,
+            content_type='application/x-ndjson')
+
     @view_config(route_name='get_tags_json')
     def get_tags(self):
         dtd_url = self.request.GET.get('dtd_url', None)
         if not dtd_url:
             raise exc.HTTPClientError('No dtd url given')
         text = bool(self.request.GET.get('text'))
+        etag = conditional.make_etag('tags', dtd_url,
+                                     dtd_cache.get(dtd_url).fingerprint, text)
+        response = self._conditional_response(
+            etag, max_age=conditional.DEFAULT_MAX_AGE)
+        if response:
+            return response
         return _get_tags(dtd_url, text)
 
     @view_config(route_name='new_json')
@@ -135,7 +559,7 @@ class EditorView(BaseUserView):
         if dtd_tag and dtd_url:
             # Create new object from the dtd url and tag
             try:
-                dic = dtd.DTD(url=dtd_url).parse()
+                dic = dtd_cache.parse(dtd_url)
             except (HTTPError, URLError), e:
                 log.exception(e, request=self.request)
                 raise exc.HTTPInternalServerError(
@@ -149,34 +573,28 @@ class EditorView(BaseUserView):
             # Create new object from a template
             absfilename = browser.absolute_path(relpath, self.root_path)
             try:
-                obj = xmltool.load(absfilename)
+                if self._is_compact():
+                    return self._compact_response(dtd_cache.load(absfilename))
+                res, dtd_url = self._render_file(
+                    absfilename, outline=self._is_outline())
+            except (PoolFullError, PoolTimeoutError), e:
+                raise exc.HTTPServiceUnavailable(str(e))
             except Exception, e:
                 log.exception(e, request=self.request)
                 raise exc.HTTPInternalServerError(str(e))
+            return res
 
         if not obj:
             raise exc.HTTPInternalServerError("Can't create new XML")
 
-        obj.root.html_renderer = self._get_html_renderer()
-        html = xmltool.generate_form_from_obj(
-            obj,
-            form_attrs={
-                'data-add-href': self.request.custom_route_path('add_element_json'),
-                'data-comment-href': self.request.custom_route_path('get_comment_modal_json'),
-                'data-action': self.request.custom_route_path('update_json'),
-                'data-copy-href': self.request.custom_route_path('copy_json'),
-                'data-paste-href': self.request.custom_route_path('paste_json'),
-            }
-        )
-        jstree_data = obj.to_jstree_dict()
-        return {
-            'content': html,
-            'jstree_data': jstree_data,
-        }
+        if self._is_compact():
+            return self._compact_response(obj)
 
-    @view_config(route_name='update_json')
-    def update(self):
-        data = self.req_post
+        return workers.render_obj(obj, None, self._get_form_attrs(),
+                                  self._get_html_renderer(),
+                                  self._is_outline())
+
+    def _pop_xml_filename(self, data):
         filename = data.pop('_xml_filename', None)
         if not filename:
             raise exc.HTTPClientError('No filename given')
@@ -188,12 +606,125 @@ class EditorView(BaseUserView):
                 error_msg = "Bad filename extension '%s'." % ext
             error_msg += " It should be '.xml'"
             raise exc.HTTPClientError(error_msg)
+        return filename
+
+    @view_config(route_name='update_json')
+    def update(self):
+        data = self.req_post
+        filename = self._pop_xml_filename(data)
 
         root_path = self.root_path
         absfilename = browser.absolute_path(filename, root_path)
+        transform = self.request.xmltool_transform
+        use_pool = (worker_pool.enabled and
+                    worker_pool.should_run(self.request.content_length or 0))
+        journal_enabled = self.request.registry.xml_journal is not None
+        # The changes made by this save for the journal
+        save = {}
+
+        def write(tmpname):
+            # The dtd url is resolved in the directory of the temporary file
+            # which is the one of the file.
+            if use_pool:
+                worker_pool.run(workers.update_file, tmpname,
+                                dict(data.items()), transform)
+            else:
+                with phase('update'):
+                    xmltool.update(tmpname, data, transform=transform)
+            if journal_enabled and os.path.exists(absfilename):
+                save.update(self._diff_save(absfilename, tmpname))
+
+        def after():
+            # We are still under the lock of the path: the saves are
+            # recorded in the order they are written.
+            if save:
+                save['new_stamp'] = get_file_stamp(absfilename)
+                self._record(absfilename, save['stamp'], save['new_stamp'],
+                             save['changes'])
+
         try:
-            xmltool.update(absfilename, data,
-                           transform=self.request.xmltool_transform)
+            written = writer.write_coalescer.write(absfilename, write, after)
+        except (PoolFullError, PoolTimeoutError), e:
+            raise exc.HTTPServiceUnavailable(str(e))
+        except (HTTPError, URLError), e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(
+                "The dtd of %s can't be loaded." % filename)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(str(e))
+
+        # The save has been replaced by a newer one which has triggered the
+        # event.
+        if written:
+            events.trigger('updated.xml',
+                           view=self,
+                           path=filename)
+            if 'new_stamp' in save:
+                # The object has been loaded from the written file, keep it
+                # for the next saves.
+                document_cache.set(absfilename, CachedDocument(save['obj']),
+                                   stamp=save['new_stamp'])
+        return 'File updated'
+
+    def _diff_save(self, absfilename, tmpname):
+        """The changes between absfilename and tmpname, the new version of
+        the file. The journal of the file is dropped if they can't be
+        computed.
+        """
+        try:
+            stamp = get_file_stamp(absfilename)
+            with phase('load'):
+                doc = document_cache.load(absfilename)
+                obj = dtd_cache.load(tmpname)
+            with doc.lock:
+                changes = journal.diff_objs(doc.obj, obj)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            return {}
+        obj.filename = absfilename
+        return {'stamp': stamp, 'changes': changes, 'obj': obj}
+
+    @view_config(route_name='update_delta_json')
+    def update_delta(self):
+        """Same as update but we only receive the modified values of the
+        form. The changes are applied to the cached object of the file.
+        """
+        data = self.req_post
+        filename = self._pop_xml_filename(data)
+
+        root_path = self.root_path
+        absfilename = browser.absolute_path(filename, root_path)
+        transform = self.request.xmltool_transform
+        try:
+            changes = delta.parse_changes(data)
+            with writer.write_coalescer.path_lock(absfilename):
+                with phase('load'):
+                    doc = document_cache.load(absfilename)
+                with doc.lock:
+                    obj = doc.obj
+                    dtd_url = resolve_dtd_url(obj.dtd_url,
+                                              os.path.dirname(absfilename))
+                    dtd_entry = dtd_cache.get(dtd_url)
+                    modified, undo = delta.apply_changes(obj, changes)
+                    try:
+                        with phase('validate'):
+                            delta.validate_elements(modified, dtd_entry)
+                        stamp = get_file_stamp(absfilename)
+                        with phase('write'):
+                            writer.write_obj(
+                                obj, absfilename, transform=transform,
+                                fsync=writer.write_coalescer.fsync)
+                    except Exception:
+                        delta.revert(undo)
+                        raise
+                    # The stamp of our write, a newer save can't be cached
+                    # with the object of this one.
+                    new_stamp = get_file_stamp(absfilename)
+                    self._record(absfilename, stamp, new_stamp,
+                                 journal.get_changes(undo))
+        except delta.DeltaError, e:
+            raise exc.HTTPClientError(str(e))
         except (HTTPError, URLError), e:
             log.exception(e, request=self.request)
             raise exc.HTTPInternalServerError(
@@ -205,8 +736,116 @@ class EditorView(BaseUserView):
         events.trigger('updated.xml',
                        view=self,
                        path=filename)
+        if not transform:
+            # The object is the same as the file content, keep it for the
+            # next updates.
+            document_cache.set(absfilename, doc, stamp=new_stamp)
         return 'File updated'
 
+    def _record(self, absfilename, before_stamp, after_stamp, changes):
+        """Record the changes of a save of absfilename in its journal if the
+        journal is enabled. It should be called under the lock of the path.
+        """
+        store = self.request.registry.xml_journal
+        if store is None:
+            return None
+        entry = None
+        if changes:
+            entry = journal.JournalEntry(changes,
+                                         user=self.current_user.login)
+        doc_journal = store.get(absfilename, create=True)
+        return doc_journal.record(before_stamp, after_stamp, entry)
+
+    def _get_journal(self, absfilename):
+        store = self.request.registry.xml_journal
+        if store is None:
+            raise exc.HTTPNotFound('The journal is not enabled')
+        if not os.path.isfile(absfilename):
+            raise exc.HTTPNotFound('The file does not exist')
+        return store.get(absfilename, create=True)
+
+    @view_config(route_name='history_json')
+    def history(self):
+        """The versions of the file we can revert to
+        """
+        filename = self.request.GET.get('path')
+        if not filename:
+            raise exc.HTTPClientError('No filename given')
+        absfilename = browser.absolute_path(filename, self.root_path)
+        doc_journal = self._get_journal(absfilename)
+        with doc_journal.lock:
+            doc_journal.sync(get_file_stamp(absfilename))
+            return doc_journal.history()
+
+    @view_config(route_name='revert_json')
+    def revert(self):
+        """Revert the file to a version of its journal: the changes of the
+        newer versions are cancelled on the cached object of the file. The
+        revert is recorded as a new version, so it can be reverted too.
+        """
+        data = self.req_post
+        filename = self._pop_xml_filename(data)
+        try:
+            version = int(data.get('version'))
+        except (TypeError, ValueError):
+            raise exc.HTTPClientError('Bad version')
+
+        absfilename = browser.absolute_path(filename, self.root_path)
+        transform = self.request.xmltool_transform
+        doc_journal = self._get_journal(absfilename)
+        try:
+            # Same order as the saves: the path, the document then the
+            # journal
+            with writer.write_coalescer.path_lock(absfilename):
+                with phase('load'):
+                    doc = document_cache.load(absfilename)
+                with doc.lock:
+                    with doc_journal.lock:
+                        stamp = get_file_stamp(absfilename)
+                        if doc_journal.is_modified(stamp):
+                            doc_journal.sync(stamp)
+                            raise exc.HTTPConflict(
+                                'The file has been modified, the history is '
+                                'lost')
+                        values = doc_journal.get_revert(version)
+                        obj = doc.obj
+                        dtd_url = resolve_dtd_url(
+                            obj.dtd_url, os.path.dirname(absfilename))
+                        dtd_entry = dtd_cache.get(dtd_url)
+                        modified, changes = journal.apply_values(obj, values)
+                        try:
+                            with phase('validate'):
+                                delta.validate_elements(modified, dtd_entry)
+                            with phase('write'):
+                                writer.write_obj(
+                                    obj, absfilename, transform=transform,
+                                    fsync=writer.write_coalescer.fsync)
+                        except Exception:
+                            journal.cancel_changes(obj, changes)
+                            raise
+                        # The stamp of our write, see update_delta
+                        new_stamp = get_file_stamp(absfilename)
+                        new_version = self._record(
+                            absfilename, stamp, new_stamp, changes)
+        except exc.HTTPException:
+            raise
+        except journal.JournalError, e:
+            raise exc.HTTPClientError(str(e))
+        except (HTTPError, URLError), e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(
+                "The dtd of %s can't be loaded." % filename)
+        except Exception, e:
+            log.exception(e, request=self.request)
+            raise exc.HTTPInternalServerError(str(e))
+
+        events.trigger('updated.xml',
+                       view=self,
+                       path=filename)
+        if not transform:
+            document_cache.set(absfilename, doc, stamp=new_stamp)
+        return {'version': new_version}
+
     @view_config(route_name='add_element_json')
     def add_element_json(self):
         elt_id = self.request.GET.get('elt_id')
@@ -218,6 +857,13 @@ class EditorView(BaseUserView):
         if res:
             return res
 
+        if element_cache.enabled:
+            return element_cache.get_data(
+                elt_id,
+                dtd_url,
+                self._get_html_renderer(),
+                self._get_html_renderer_key())
+
         dic = xmltool.factory.get_data_from_str_id_for_html_display(
             elt_id,
             dtd_url=dtd_url,
@@ -231,13 +877,11 @@ class EditorView(BaseUserView):
             return {'error_msg': 'Bad parameter'}
         data = xmltool.factory.getElementData(self.request.POST['elt_id'],
                                               self.request.POST)
-        # Write the content to paste in a temporary file
-        filename = tempfile.mktemp()
-        open(filename, 'w').write(json.dumps(data))
-        self.request.session['clipboard'] = {
-            'filename': filename,
-            'elt_id': self.request.POST['elt_id'],
-        }
+        try:
+            self.request.registry.xml_clipboard.set(
+                self.current_user.login, self.request.POST['elt_id'], data)
+        except clipboard.ClipboardTooBigError, e:
+            return {'error_msg': str(e)}
         return {'info_msg': 'Copied'}
 
     @view_config(route_name='paste_json')
@@ -250,17 +894,16 @@ class EditorView(BaseUserView):
         if not elt_id or not dtd_url:
             return {'error_msg': 'Bad parameter'}
 
-        clipboard = self.request.session.get('clipboard')
-        if not clipboard:
+        entry = self.request.registry.xml_clipboard.get(
+            self.current_user.login)
+        if not entry:
             return {
                 'error_msg': 'Empty clipboard'
             }
-        filename = clipboard['filename']
-        clipboard_data = json.loads(open(filename, 'r').read())
 
         dic = xmltool.factory.get_new_element_data_for_html_display(
             elt_id, data,
-            clipboard_data, dtd_url,
+            entry.data, dtd_url,
             # Don't keep the attributes nor the comments
             skip_extra=True,
             html_renderer=self._get_html_renderer()
@@ -276,9 +919,76 @@ class EditorView(BaseUserView):
     def get_comment_modal_json(self):
         # TODO: remove this function, it should be done in angular
         comment = self.request.GET.get('comment') or ''
-        content = render('comment_modal.mak',
-                         {'comment': comment}, self.request)
-        return {'content': content}
+        modal = get_comment_modal(self.request.registry)
+        etag = conditional.make_etag(
+            'comment_modal', comment, modal.stamp,
+            self.request.registry.settings.get('mako.directories'))
+        response = self._conditional_response(
+            etag, max_age=conditional.DEFAULT_MAX_AGE)
+        if response:
+            return response
+        response = self.request.response
+        response.content_type = 'application/json'
+        response.charset = 'UTF-8'
+        response.body = modal.get_body(comment)
+        return response
+
+    def _check_admin(self):
+        """The monitoring routes are only available to the logins defined
+        in waxe.xml.admins.
+        """
+        admins = self.request.registry.settings.get('waxe.xml.admins', '')
+        if self.current_user.login not in admins.split():
+            raise exc.HTTPForbidden()
+
+    @view_config(route_name='metrics_json')
+    def metrics(self):
+        """The timings of the routes with the counters of the caches, the
+        worker pool and the writes of this process
+        """
+        self._check_admin()
+        registry = self.request.registry
+        sink = getattr(registry, 'xml_metrics', None)
+        caches = {
+            'dtd': dtd_cache.stats(),
+            'form': form_cache.stats(),
+            'document': document_cache.stats(),
+            'element': element_cache.stats(),
+            'renderer': renderer_cache.stats(),
+        }
+        for name in ['clipboard', 'journal']:
+            store = getattr(registry, 'xml_%s' % name, None)
+            if store is not None:
+                caches[name] = store.stats()
+        return {
+            'timings': sink.snapshot() if sink is not None else {},
+            'caches': caches,
+            'workers': worker_pool.stats(),
+            'writes': writer.write_coalescer.stats(),
+        }
+
+    @view_config(route_name='profiles_json')
+    def profiles(self):
+        """The list of the saved profiles, see waxe.xml.profiling
+        """
+        self._check_admin()
+        store = getattr(self.request.registry, 'xml_profiles', None)
+        if store is None:
+            return {'profiles': []}
+        return {'profiles': store.list()}
+
+    @view_config(route_name='get_profile')
+    def get_profile(self):
+        self._check_admin()
+        name = self.request.GET.get('name')
+        store = getattr(self.request.registry, 'xml_profiles', None)
+        path = store.get_path(name) if store else None
+        if path is None:
+            raise exc.HTTPNotFound()
+        response = FileResponse(path, request=self.request,
+                                content_type='application/octet-stream')
+        response.content_disposition = 'attachment; filename="%s"' % name
+        return response
 
 
 def get_dtd_urls(request):
@@ -287,26 +997,87 @@ def get_dtd_urls(request):
     return filter(bool, request.registry.settings['dtd_urls'].split('\n'))
 
 
-def get_xml_plugins(request):
-    if 'waxe.xml.plugins' not in request.registry.settings:
-        return []
-    lis = filter(bool,
-                 request.registry.settings['waxe.xml.plugins'].split('\n'))
+def load_xml_plugins(settings):
+    """Load the plugins defined in waxe.xml.plugins, it should be done once
+    when the application starts.
+    """
+    lis = filter(bool, settings.get('waxe.xml.plugins', '').split('\n'))
+    return PluginIndex(load_plugins(lis))
 
-    mods = []
-    for s in lis:
-        mods.append(importlib.import_module(s))
-    return mods
+
+def get_xml_plugins(request):
+    plugins = getattr(request.registry, 'xml_plugins', None)
+    if plugins is None:
+        # includeme has not been called
+        plugins = load_xml_plugins(request.registry.settings)
+    return plugins
 
 
 def get_xmltool_transform(request):
     """Before writing XML, we can call a function to transform it.
     """
-    if 'waxe.xml.xmltool.transform' not in request.registry.settings:
+    return get_hook(request.registry.settings, 'waxe.xml.xmltool.transform')
+
+
+def get_clipboard_store(settings):
+    """Create the clipboard store, the function creating the store can be
+    defined in waxe.xml.clipboard.factory, it receives the settings.
+    """
+    func = get_hook(settings, 'waxe.xml.clipboard.factory')
+    if func is None:
+        return clipboard.memory_store_factory(settings)
+    return func(settings)
+
+
+def get_journal_store(settings):
+    """Create the store of the journals if waxe.xml.journal is enabled, the
+    function creating the store can be defined in waxe.xml.journal.factory,
+    it receives the settings.
+
+    The default store keeps the journals in memory: it should only be used
+    when the application runs in one process.
+    """
+    if not asbool(settings.get('waxe.xml.journal')):
         return None
-    func = request.registry.settings['waxe.xml.xmltool.transform']
-    mod, func = func.rsplit('.', 1)
-    return getattr(importlib.import_module(mod), func)
+    func = get_hook(settings, 'waxe.xml.journal.factory')
+    if func is None:
+        return journal.memory_store_factory(settings)
+    return func(settings)
+
+
+def invalidate_cached_file(view, path):
+    """Drop the cached data of the updated file.
+    """
+    absfilename = browser.absolute_path(path, view.root_path)
+    form_cache.invalidate(absfilename)
+    document_cache.invalidate(absfilename)
+
+
+def get_dtd_disk_cache(settings):
+    """The cache of the dtds shared by the processes, it's only used if
+    waxe.xml.dtd_disk_cache.directory is defined. The files older than
+    waxe.xml.dtd_disk_cache.max_age seconds are removed.
+    """
+    directory = settings.get('waxe.xml.dtd_disk_cache.directory')
+    if not directory:
+        return None
+    return DTDDiskCache(directory, max_age=int(settings.get(
+        'waxe.xml.dtd_disk_cache.max_age', diskcache.DEFAULT_MAX_AGE)))
+
+
+def prefetch_dtds(settings):
+    """Fetch and parse all the dtd_urls in dtd_cache to not make the first
+    requests pay for it.
+    """
+    urls = filter(bool, settings.get('dtd_urls', '').split('\n'))
+    workers = settings.get('waxe.xml.dtd_prefetch.workers',
+                           DEFAULT_PREFETCH_WORKERS)
+    errors = dtd_cache.prefetch(urls, workers=workers)
+    if errors and asbool(settings.get('waxe.xml.dtd_prefetch.strict')):
+        raise ConfigurationError(
+            "The following dtds can't be loaded: %s" % ', '.join(
+                ['%s (%s)' % (url, e) for url, e in errors]))
+    return errors
 
 
 def includeme(config):
@@ -315,6 +1086,56 @@ def includeme(config):
     if cache_timeout:
         xmltool.cache.CACHE_TIMEOUT = cache_timeout
 
+    dtd_cache.configure(
+        max_size=settings.get('waxe.xml.dtd_cache.max_size'))
+    form_cache.configure(
+        max_size=settings.get('waxe.xml.form_cache.max_size'))
+    document_cache.configure(
+        max_size=settings.get('waxe.xml.document_cache.max_size'))
+    element_cache.configure(
+        max_size=settings.get('waxe.xml.element_cache.max_size'))
+    renderer_cache.configure(
+        max_size=settings.get('waxe.xml.renderer_cache.max_size'))
+    renderer_cache.invalidate()
+    # Raise an error at startup if a hook can't be imported
+    get_hook(settings, 'waxe.xml.xmltool.renderer_func')
+    get_hook(settings, 'waxe.xml.xmltool.transform')
+    get_text_validation(settings)
+    worker_pool.configure(
+        size=settings.get('waxe.xml.worker_pool.size'),
+        threshold=settings.get('waxe.xml.worker_pool.threshold'),
+        timeout=settings.get('waxe.xml.worker_pool.timeout'),
+        max_queue=settings.get('waxe.xml.worker_pool.max_queue'))
+    directory_validator.configure(
+        workers=settings.get('waxe.xml.validate.workers'),
+        chunk_size=settings.get('waxe.xml.validate.chunk_size'),
+        max_running=settings.get('waxe.xml.validate.max_running'))
+    dtd_fetcher.configure(
+        ttl=settings.get('waxe.xml.dtd_fetcher.ttl'),
+        stale_while_revalidate=settings.get(
+            'waxe.xml.dtd_fetcher.stale_while_revalidate'),
+        stale_if_error=settings.get('waxe.xml.dtd_fetcher.stale_if_error'),
+        timeout=settings.get('waxe.xml.dtd_fetcher.timeout'),
+        pool_size=settings.get('waxe.xml.dtd_fetcher.pool_size'))
+    if asbool(settings.get('waxe.xml.dtd_fetcher', True)):
+        fetcher.install()
+    else:
+        fetcher.uninstall()
+    # xmltool parses the dtds of update and new with dtd_cache
+    cache.install()
+    writer.write_coalescer.configure(
+        window=settings.get('waxe.xml.writer.coalesce_window'),
+        fsync=asbool(settings.get('waxe.xml.writer.fsync',
+                                  writer.DEFAULT_FSYNC)))
+    disk_cache = get_dtd_disk_cache(settings)
+    dtd_cache.disk_cache = disk_cache
+    dtd_fetcher.disk_cache = disk_cache
+    if asbool(settings.get('waxe.xml.dtd_prefetch')):
+        prefetch_dtds(settings)
+    config.registry.xml_clipboard = get_clipboard_store(settings)
+    config.registry.xml_journal = get_journal_store(settings)
+    config.registry.xml_plugins = load_xml_plugins(settings)
+
     settings['mako.directories'] += '\nwaxe.xml:templates'
 
     config.set_request_property(get_dtd_urls, 'dtd_urls', reify=True)
@@ -322,14 +1143,21 @@ def includeme(config):
     config.set_request_property(get_xmltool_transform, 'xmltool_transform',
                                 reify=True)
 
-    config.add_route('edit_json', '/edit.json')
-    config.add_route('new_json', '/new.json')
-    config.add_route('update_json', '/update.json')
-    config.add_route('add_element_json', '/add-element.json')
-    config.add_route('get_comment_modal_json', '/get-comment-modal.json')
-    config.add_route('copy_json', '/copy.json')
-    config.add_route('paste_json', '/paste.json')
-    config.add_route('get_tags_json', '/get-tags.json')
+    config.registry.xml_metrics = get_metrics_sink(settings)
+    config.add_subscriber(start_serialize, BeforeRender)
+    config.add_subscriber(warm_comment_modal, ApplicationCreated)
+
+    config.add_tween('waxe.xml.compression.compression_tween_factory')
+    # Above the compression to time it
+    config.add_tween('waxe.xml.metrics.timing_tween_factory',
+                     over='waxe.xml.compression.compression_tween_factory')
+    config.registry.xml_profiles = profiling.get_profile_store(settings)
+    config.add_tween('waxe.xml.profiling.profiling_tween_factory',
+                     under='waxe.xml.metrics.timing_tween_factory',
+                     over='waxe.xml.compression.compression_tween_factory')
+
+    for name, pattern in waxe.xml.EDITOR_ROUTES + waxe.xml.MONITORING_ROUTES:
+        config.add_route(name, pattern)
     config.scan(__name__)
 
     # We have to be sure we don't have any prefix
@@ -350,3 +1178,4 @@ def includeme(config):
 
     # When we update a file as txt, we validate it if it's an XML.
     events.on('before_update.txt', is_valid_filecontent)
+    events.on('updated.xml', invalidate_cached_file)
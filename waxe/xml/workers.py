@@ -0,0 +1,248 @@
+"""Optional process pool used to load, render and validate the big documents
+outside of the request thread.
+"""
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from urllib2 import HTTPError, URLError
+
+import xmltool
+from xmltool import render as xt_render
+
+from waxe.xml import form
+from waxe.xml.metrics import phase
+from waxe.xml.cache import dtd_cache
+
+
+log = logging.getLogger(__name__)
+
+# The pool is disabled by default
+DEFAULT_POOL_SIZE = 0
+# Size in bytes from which a document is handled by the pool
+DEFAULT_THRESHOLD = 1024 * 1024
+# In seconds
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_QUEUE = 10
+
+
+class PoolFullError(Exception):
+    pass
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def get_html_renderer(renderer_func=None, login=None):
+    if renderer_func is None:
+        return xt_render.ContenteditableRender()
+    return renderer_func(login)
+
+
+def render_obj(obj, form_filename, form_attrs, html_renderer, outline=False):
+    """Returns the form and the jstree data of obj, the jstree data is
+    replaced by the compact outline (see form.outline_obj) if outline is
+    True.
+    """
+    obj.root.html_renderer = html_renderer
+    with phase('render'):
+        html = xmltool.generate_form_from_obj(
+            obj,
+            form_filename=form_filename,
+            form_attrs=form_attrs
+        )
+    payload = {
+        'content': html,
+    }
+    with phase('jstree'):
+        if outline:
+            payload['outline'] = form.outline_obj(obj)
+        else:
+            payload['jstree_data'] = obj.to_jstree_dict()
+    return payload
+
+
+def load_and_render(filename, form_filename, form_attrs, html_renderer,
+                    outline=False):
+    """Returns the form and the jstree data of the given file and its dtd url
+    """
+    with phase('load'):
+        obj = dtd_cache.load(filename)
+    payload = render_obj(obj, form_filename, form_attrs, html_renderer,
+                         outline)
+    return payload, obj.dtd_url
+
+
+# The tasks executed in the pool. The parameters and the results should be
+# picklable.
+
+def render_file(filename, form_filename, form_attrs, renderer_func=None,
+                login=None, outline=False):
+    """Same as load_and_render, the renderer can't be sent to the workers so
+    they create it with renderer_func and login.
+    """
+    return load_and_render(filename, form_filename, form_attrs,
+                           get_html_renderer(renderer_func, login), outline)
+
+
+def update_file(filename, data, transform=None):
+    xmltool.update(filename, data, transform=transform)
+
+
+def validate_string(filecontent):
+    with phase('load'):
+        xmltool.load_string(filecontent)
+
+
+def check_string(filecontent, path=None):
+    """Same as validate_string without creating the xmltool object
+    """
+    dtd_cache.validate_string(filecontent, path)
+
+
+def _run(func, args):
+    """Run func in the worker.
+
+    The exceptions are not always picklable, we return them as string
+    """
+    try:
+        return None, func(*args)
+    except (HTTPError, URLError), e:
+        return (True, str(e)), None
+    except Exception, e:
+        return (False, str(e)), None
+
+
+class WorkerPool(object):
+    """Run the tasks in a pool of processes.
+
+    The number of pending tasks is limited by max_queue, PoolFullError is
+    raised when the pool is full. PoolTimeoutError is raised when the result
+    is not available after timeout seconds, the task is still pending until
+    it's finished by the worker.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, threshold=DEFAULT_THRESHOLD,
+                 timeout=DEFAULT_TIMEOUT, max_queue=DEFAULT_MAX_QUEUE):
+        self.size = size
+        self.threshold = threshold
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.total_time = 0
+
+    def configure(self, size=None, threshold=None, timeout=None,
+                  max_queue=None):
+        if size is not None:
+            self.size = int(size)
+        if threshold is not None:
+            self.threshold = int(threshold)
+        if timeout is not None:
+            self.timeout = float(timeout)
+        if max_queue is not None:
+            self.max_queue = int(max_queue)
+        self.close()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def should_run(self, size):
+        """Returns True if a document of the given size should be handled by
+        the pool.
+        """
+        return self.enabled and size >= self.threshold
+
+    def _get_pool(self):
+        # Don't use a pool created by another process, it happens when the
+        # server forks after the configuration.
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = multiprocessing.Pool(self.size)
+            self._pid = os.getpid()
+        return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+                # The tasks are killed
+                self.pending = 0
+            self._pool = None
+            self._pid = None
+
+    def _task_done(self, result):
+        # Called by the pool when the worker has finished the task
+        with self._lock:
+            self.pending -= 1
+
+    def run(self, func, *args):
+        """Run func(*args) in the pool and returns its result.
+
+        The HTTPError and URLError raised by func are raised as URLError, the
+        other exceptions are raised as Exception with the same message.
+        """
+        with self._lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                log.warning('The worker pool is full, %s rejected',
+                            func.__name__)
+                raise PoolFullError('The server is busy, try again later')
+            self.pending += 1
+            self.submitted += 1
+            pool = self._get_pool()
+
+        start = time.time()
+        try:
+            try:
+                with phase('pool'):
+                    error, res = pool.apply_async(
+                        _run, (func, args),
+                        callback=self._task_done).get(self.timeout)
+            except multiprocessing.TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                log.warning('%s timed out after %ss', func.__name__,
+                            self.timeout)
+                raise PoolTimeoutError(
+                    'The document takes too long to be processed')
+        finally:
+            with self._lock:
+                self.total_time += time.time() - start
+
+        with self._lock:
+            if error:
+                self.errors += 1
+            else:
+                self.completed += 1
+
+        if error:
+            is_url_error, msg = error
+            if is_url_error:
+                raise URLError(msg)
+            raise Exception(msg)
+        return res
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'pending': self.pending,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'total_time': self.total_time,
+        }
+
+
+worker_pool = WorkerPool()
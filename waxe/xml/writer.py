@@ -0,0 +1,176 @@
+"""Write the xmltool objects on the filesystem.
+
+The files are written in a temporary file of the same directory which is
+renamed to the final name, so a file is never partially written. With fsync
+the data and the rename are flushed to the disk before returning.
+
+The saves of a file can be coalesced by WriteCoalescer: the saves received
+during a small window are collapsed into the latest one and only this one is
+written.
+"""
+import os
+import stat
+import time
+import tempfile
+import threading
+
+
+# Mode used when we create a new file
+DEFAULT_FILE_MODE = 0644
+# In seconds, 0 disables the coalescing
+DEFAULT_COALESCE_WINDOW = 0
+DEFAULT_FSYNC = False
+# The writes of the same file are serialized, the paths share these locks
+PATH_LOCKS = 64
+
+
+def _fsync(filename, flags=os.O_RDONLY):
+    fd = os.open(filename, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(filename, write, fsync=DEFAULT_FSYNC):
+    """Call write with the name of a temporary file and rename it to
+    filename.
+
+    :param write: function writing the content in the given filename
+    :param fsync: flush the file and its directory to the disk
+    """
+    dirname, basename = os.path.split(filename)
+    fd, tmpname = tempfile.mkstemp(dir=dirname,
+                                   prefix='.%s.' % basename,
+                                   suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmpname)
+        mode = DEFAULT_FILE_MODE
+        if os.path.exists(filename):
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        os.chmod(tmpname, mode)
+        if fsync:
+            _fsync(tmpname, os.O_RDWR)
+        os.rename(tmpname, filename)
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    if fsync:
+        # Make the rename durable
+        _fsync(dirname or '.')
+
+
+def write_obj(obj, filename, transform=None, fsync=DEFAULT_FSYNC):
+    """Write obj as XML in filename atomically.
+
+    .. note:: obj is not validated, it should be done before.
+    """
+    def write(tmpname):
+        obj.write(tmpname, obj.encoding, dtd_url=obj.dtd_url,
+                  validate=False, transform=transform)
+    atomic_write(filename, write, fsync)
+
+
+class _Batch(object):
+    """The saves of a file received during the window
+    """
+
+    def __init__(self):
+        self.write = None
+        self.after = None
+        self.ticket = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class WriteCoalescer(object):
+    """Collapse the saves of a file.
+
+    The first save of a file waits during window seconds, then the latest
+    save received in the meantime is written. The saves which have been
+    replaced are not written.
+    """
+
+    def __init__(self, window=DEFAULT_COALESCE_WINDOW, fsync=DEFAULT_FSYNC):
+        self.window = window
+        self.fsync = fsync
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._path_locks = [threading.Lock() for i in range(PATH_LOCKS)]
+        self.saves = 0
+        self.writes = 0
+
+    def configure(self, window=None, fsync=None):
+        if window is not None:
+            self.window = float(window)
+        if fsync is not None:
+            self.fsync = fsync
+
+    def path_lock(self, filename):
+        """The lock serializing the writes of filename, it should be held
+        by the code writing filename without write.
+        """
+        return self._path_locks[hash(filename) % PATH_LOCKS]
+
+    def _write(self, filename, write, after=None):
+        with self.path_lock(filename):
+            atomic_write(filename, write, self.fsync)
+            if after is not None:
+                after()
+        self.writes += 1
+
+    def write(self, filename, write, after=None):
+        """Save filename, write is called with the name of the temporary
+        file to write if this save is not replaced by a newer one. after is
+        called once the file is renamed, the path is still locked.
+
+        The exception raised by the write is raised in all the saves of the
+        batch.
+
+        :return: True if this save has been written, False if it has been
+            replaced
+        """
+        self.saves += 1
+        if self.window <= 0:
+            self._write(filename, write, after)
+            return True
+
+        ticket = object()
+        with self._lock:
+            batch = self._batches.get(filename)
+            leader = batch is None
+            if leader:
+                batch = self._batches[filename] = _Batch()
+            batch.write = write
+            batch.after = after
+            batch.ticket = ticket
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.ticket is ticket
+
+        time.sleep(self.window)
+        with self._lock:
+            # The next saves go in a new batch
+            del self._batches[filename]
+        try:
+            self._write(filename, batch.write, batch.after)
+        except Exception, e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+        return batch.ticket is ticket
+
+    def stats(self):
+        return {
+            'saves': self.saves,
+            'writes': self.writes,
+        }
+
+
+write_coalescer = WriteCoalescer()